@@ -0,0 +1,90 @@
+"""
+Compares the cache storage backends: the time to persist a whole cache, to persist one changed official, and to cold
+load the cache back from disk. Uses synthetic officials, so it doesn't need Google access.
+
+Usage:
+python benchmarks/cache_backends.py [number of officials] [games per official]
+"""
+__author__ = 'hammer'
+
+import sys
+import datetime
+import tempfile
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+import ohd  # noqa: E402
+from ohd.storage import backends  # noqa: E402
+
+
+def synthetic_cache(num_officials, games_per_official):
+    """
+    Builds the officials, metadata and game_data partitions for the given number of officials
+    :return: a dict of partition: DataFrame
+    """
+    cache_defs = ohd.config.conf.caching.cache_defs
+    off_ids = [f"ohd-{i:06d}" for i in range(num_officials)]
+    officials = pd.DataFrame({col: [f"{col} {i}" for i in range(num_officials)]
+                              for col in cache_defs['officials']['cols']}, index=off_ids)
+    metadata = pd.DataFrame({'last_update': pd.Timestamp.now(), 'modified_time': pd.Timestamp('2019-01-01')},
+                            index=off_ids)
+    num_games = num_officials * games_per_official
+    rng = np.random.RandomState(0)
+    games = pd.DataFrame({col: rng.choice([f"{col} {i}" for i in range(20)], num_games)
+                          for col in cache_defs['game_data']['cols'] if col not in ('off_id', 'Date')})
+    games['off_id'] = np.repeat(off_ids, games_per_official)
+    games['Date'] = pd.Timestamp('2015-01-01') + pd.to_timedelta(rng.randint(0, 2000, num_games), unit='D')
+    games = games.set_index(['off_id', 'Date']).sort_index()
+    return {'officials': officials, 'metadata': metadata, 'game_data': games}
+
+
+def time_backend(backend, partitions, data_dir):
+    """
+    :return: a dict of the timings (in seconds) of the backend
+    """
+    conf = ohd.config.conf
+    conf.init_env('Test', data_dir, cache_backend=backend)
+    conf.logger.setLevel('WARNING')
+    caching = conf.caching
+    timings = dict()
+
+    for key, df in partitions.items():
+        caching.cache[key] = df.copy()
+        caching.mark_dirty(key)
+    start = datetime.datetime.now()
+    caching.persist_cache()
+    timings['full persist'] = (datetime.datetime.now() - start).total_seconds()
+
+    # change one official, and persist just that
+    off_id = partitions['officials'].index[len(partitions['officials']) // 2]
+    games = caching.lookup('game_data', off_id).copy()
+    games['off_id'] = off_id
+    caching.stage('game_data', off_id, games.reset_index().set_index(['off_id', 'Date']))
+    caching.stage('metadata', off_id, {'last_update': pd.Timestamp.now(), 'modified_time': pd.Timestamp.now()})
+    caching.commit()
+    start = datetime.datetime.now()
+    caching.persist_cache()
+    timings['1 official persist'] = (datetime.datetime.now() - start).total_seconds()
+
+    start = datetime.datetime.now()
+    caching.init_cache()
+    for key in partitions:
+        caching.cache[key]
+    timings['cold load'] = (datetime.datetime.now() - start).total_seconds()
+    timings['file size (MB)'] = Path(caching.file).stat().st_size / 2 ** 20
+    return timings
+
+
+if __name__ == '__main__':
+    num_officials = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    games_per_official = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    partitions = synthetic_cache(num_officials, games_per_official)
+    print(f"{num_officials} officials, {len(partitions['game_data'])} games")
+
+    results = dict()
+    for backend in backends:
+        with tempfile.TemporaryDirectory() as data_dir:
+            results[backend] = time_backend(backend, partitions, data_dir)
+    print(pd.DataFrame(results).round(3))
@@ -0,0 +1,393 @@
+"""
+An in-process stand in for the parts of Google Sheets (through pygsheets) and Drive that the OHD module uses, with
+configurable latency per API call, and generators for synthetic Registers and OHDs.
+It raises the same exceptions as the real thing (HttpError 404s, WorksheetNotFound, and 429s when its quota is used
+up), so the error paths can be run offline too. Like pygsheets, it can retry failed calls itself before they get to the
+quota governor, but by default it doesn't, the same as the client session.py builds.
+
+Usage:
+client = FakeClient(latency=0.2, quota=(60, 60))
+register_id = make_register(client, num_officials=1000)
+conf.google.client = client
+"""
+__author__ = 'hammer'
+
+import re
+import json
+import time
+import random
+import datetime
+import threading
+import collections
+import pandas as pd
+
+from ohd.config import conf
+
+
+def http_error(status, message, retry_after=None):
+    """
+    :return: a googleapiclient HttpError, as the API would raise it
+    """
+    import httplib2
+    from googleapiclient.errors import HttpError
+    content = json.dumps({'error': {'code': int(status), 'message': message}}).encode('utf-8')
+    headers = {'status': str(status)}
+    if retry_after is not None:
+        headers['retry-after'] = str(retry_after)
+    return HttpError(httplib2.Response(headers), content)
+
+
+def column_number(letters):
+    """
+    :return: the 0 based column number of a column in A1 notation, eg 'A' is 0 and 'AA' is 26
+    """
+    number = 0
+    for letter in letters.upper():
+        number = number * 26 + ord(letter) - ord('A') + 1
+    return number - 1
+
+
+def trim(rows):
+    """
+    Drops the trailing empty cells of each row, and the trailing empty rows, like the Sheets API does
+    """
+    trimmed = list()
+    for row in rows:
+        row = list(row)
+        while row and row[-1] == '':
+            row.pop()
+        trimmed.append(row)
+    while trimmed and not trimmed[-1]:
+        trimmed.pop()
+    return trimmed
+
+
+class FakeWorksheet:
+    def __init__(self, spreadsheet, title, values):
+        self.spreadsheet = spreadsheet
+        self.title = title
+        self.values = values
+
+    def __repr__(self):
+        return f"<FakeWorksheet {self.title!r} {len(self.values)} rows>"
+
+    def get_all_values(self, include_tailing_empty=True, include_tailing_empty_rows=True):
+        self.spreadsheet.client.api_call('get_all_values')
+        rows = [list(row) for row in self.values]
+        if not include_tailing_empty_rows:
+            while rows and not any(rows[-1]):
+                rows.pop()
+        if not include_tailing_empty:
+            rows = trim(rows) if include_tailing_empty_rows else [trim([row])[0] if any(row) else [] for row in rows]
+        return rows
+
+    def get_as_df(self):
+        self.spreadsheet.client.api_call('get_as_df')
+        if not self.values:
+            return pd.DataFrame()
+        header = self.values[0]
+        return pd.DataFrame([list(row) for row in self.values[1:]], columns=header)
+
+    def get_range(self, a1_range):
+        """
+        :return: the trimmed rows of a range of this worksheet, eg 'B2:B11', 'A:N' or 'A1'
+        """
+        match = re.fullmatch(r'([A-Z]+)(\d*)(?::([A-Z]+)(\d*))?', a1_range.upper())
+        if not match:
+            raise http_error(400, f"Unable to parse range: {self.title}!{a1_range}")
+        first_col, first_row, last_col, last_row = match.groups()
+        last_col = last_col or first_col
+        if not last_row and not match.group(3):
+            last_row = first_row
+        first_row = int(first_row) - 1 if first_row else 0
+        last_row = int(last_row) if last_row else len(self.values)
+        cols = slice(column_number(first_col), column_number(last_col) + 1)
+        return trim(row[cols] for row in self.values[first_row:last_row])
+
+
+class FakeSpreadsheet:
+    def __init__(self, client, doc_id, title):
+        self.client = client
+        self.id = doc_id
+        self.title = title
+        self.sheets = list()
+        self.modified_time = datetime.datetime.utcnow()
+
+    def __repr__(self):
+        return f"<FakeSpreadsheet {self.title!r} {self.id}>"
+
+    def add_worksheet(self, title, values):
+        self.sheets.append(FakeWorksheet(self, title, values))
+        return self.sheets[-1]
+
+    def worksheets(self):
+        return list(self.sheets)
+
+    def worksheet_by_title(self, title):
+        import pygsheets
+        for ws in self.sheets:
+            if ws.title == title:
+                return ws
+        raise pygsheets.WorksheetNotFound(title)
+
+    def touch(self):
+        """
+        Marks the spreadsheet as modified now
+        """
+        self.modified_time = datetime.datetime.utcnow()
+
+
+class FakeSheetAPI:
+    """
+    The pygsheets SheetAPIWrapper (client.sheet)
+    """
+    def __init__(self, client, retries=0, check=False, seconds_per_quota=100):
+        """
+        :param retries: the number of times googleapiclient retries a 429 or 5xx error, after an exponential backoff
+        :param check: if True, a 429 that's still failing after the retries sleeps for seconds_per_quota and is tried
+        once more, like pygsheets does
+        :param seconds_per_quota: the number of seconds slept for a 429
+        """
+        self.client = client
+        self.retries = retries
+        self.check = check
+        self.seconds_per_quota = seconds_per_quota
+
+    def execute(self, request):
+        """
+        Runs an API call the way pygsheets' _execute_requests() and googleapiclient's execute(num_retries) do
+        :param request: a function that makes the call
+        :return: the call's response
+        """
+        from googleapiclient.errors import HttpError
+        try:
+            return self.execute_with_retries(request)
+        except HttpError as e:
+            if e.resp['status'] == '429' and self.check:
+                with self.client.lock:
+                    self.client.calls['quota_sleeps'] += 1
+                time.sleep(self.seconds_per_quota)
+                return self.execute_with_retries(request)
+            raise
+
+    def execute_with_retries(self, request):
+        from googleapiclient.errors import HttpError
+        for attempt in range(self.retries + 1):
+            try:
+                return request()
+            except HttpError as e:
+                if attempt == self.retries or conf.quota.http_status(e) not in conf.quota.retry_statuses:
+                    raise
+                with self.client.lock:
+                    self.client.calls['client_retries'] += 1
+                time.sleep(random.random() * 2 ** attempt)
+
+    def values_batch_get(self, spreadsheet_id, value_ranges, major_dimension='ROWS'):
+        return self.execute(lambda: self.get_values(spreadsheet_id, value_ranges, major_dimension))
+
+    def get_values(self, spreadsheet_id, value_ranges, major_dimension):
+        self.client.api_call('values_batch_get')
+        spreadsheet = self.client.get_doc(spreadsheet_id)
+        results = list()
+        for value_range in value_ranges:
+            title, _, a1_range = value_range.rpartition('!')
+            if not title:
+                title, a1_range = a1_range, ''
+            title = title.strip("'")
+            try:
+                ws = spreadsheet.worksheet_by_title(title)
+            except Exception:
+                raise http_error(400, f"Unable to parse range: {value_range}")
+            values = ws.get_range(a1_range) if a1_range else trim(ws.values)
+            result = {'range': value_range, 'majorDimension': major_dimension}
+            if values:
+                result['values'] = values
+            results.append(result)
+        return results
+
+
+class FakeDriveRequest:
+    def __init__(self, client, file_id):
+        self.client = client
+        self.file_id = file_id
+
+    def response(self):
+        spreadsheet = self.client.get_doc(self.file_id)
+        return {'id': spreadsheet.id, 'modifiedTime': spreadsheet.modified_time.isoformat() + 'Z'}
+
+    def execute(self):
+        self.client.api_call('drive_files_get')
+        return self.response()
+
+
+class FakeDriveBatch:
+    def __init__(self, client, callback):
+        self.client = client
+        self.callback = callback
+        self.requests = list()
+
+    def add(self, request, request_id=None):
+        self.requests.append((request_id or request.file_id, request))
+
+    def execute(self):
+        self.client.api_call('drive_batch')
+        for request_id, request in self.requests:
+            try:
+                self.callback(request_id, request.response(), None)
+            except Exception as e:
+                self.callback(request_id, None, e)
+
+
+class FakeDriveService:
+    """
+    The googleapiclient Drive v3 service (client.drive.service)
+    """
+    def __init__(self, client):
+        self.client = client
+
+    def files(self):
+        return self
+
+    def get(self, fileId, **kwargs):
+        return FakeDriveRequest(self.client, fileId)
+
+    def new_batch_http_request(self, callback=None):
+        return FakeDriveBatch(self.client, callback)
+
+
+class FakeClient:
+    """
+    Stands in for an authorized pygsheets.Client
+    """
+    def __init__(self, latency=0.0, jitter=0.0, quota=None, error_rate=0.0, retries=0, check=False,
+                 seconds_per_quota=100):
+        """
+        :param latency: the number of seconds each API call takes
+        :param jitter: the max random number of seconds added to the latency of each call
+        :param quota: a tuple of (number of calls, seconds), calls over the quota fail with a 429 and a Retry-After
+        :param error_rate: the fraction of calls that fail with a 503
+        :param retries, check, seconds_per_quota: how the Sheets calls are retried by the client, see FakeSheetAPI. The
+        defaults are how session.py builds the real client, pygsheets' own defaults are retries=3, check=True
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.quota = quota
+        self.error_rate = error_rate
+        self.recent_calls = collections.deque()
+        self.docs = dict()
+        self.calls = collections.Counter()
+        self.lock = threading.Lock()
+        self.sheet = FakeSheetAPI(self, retries, check, seconds_per_quota)
+        self.drive = collections.namedtuple('FakeDrive', ['service'])(FakeDriveService(self))
+
+    def api_call(self, name):
+        """
+        Counts an API call, and waits for as long as it would take. Raises a 429 if the call is over the quota, or a
+        503 for the error_rate fraction of calls.
+        """
+        with self.lock:
+            self.calls[name] += 1
+            if self.quota:
+                max_calls, seconds = self.quota
+                now = time.monotonic()
+                while self.recent_calls and self.recent_calls[0] <= now - seconds:
+                    self.recent_calls.popleft()
+                if len(self.recent_calls) >= max_calls:
+                    self.calls['rate_limited'] += 1
+                    raise http_error(429, "Quota exceeded", retry_after=round(self.recent_calls[0] + seconds - now, 3))
+                self.recent_calls.append(now)
+            if self.error_rate and random.random() < self.error_rate:
+                self.calls['server_errors'] += 1
+                raise http_error(503, "The service is currently unavailable")
+        if self.latency or self.jitter:
+            time.sleep(self.latency + random.uniform(0, self.jitter))
+
+    def get_doc(self, doc_id):
+        if doc_id not in self.docs:
+            raise http_error(404, f"Requested entity was not found: {doc_id}")
+        return self.docs[doc_id]
+
+    def create(self, title, doc_id=None):
+        doc_id = doc_id or f"fake-{len(self.docs):06d}-{random.getrandbits(64):016x}"
+        self.docs[doc_id] = FakeSpreadsheet(self, doc_id, title)
+        return self.docs[doc_id]
+
+    def open_by_key(self, key):
+        def request():
+            self.api_call('open_by_key')
+            return self.get_doc(key)
+        return self.sheet.execute(request)
+
+
+##########
+# Synthetic data
+associations = ['WFTDA', 'MRDA', 'JRDA', 'Other']
+game_types = ['Sanctioned', 'Regulation', 'Playoff', 'Championship', 'Other']
+positions = ['HR', 'IPR', 'JR', 'OPR', 'ALTR', 'HNSO', 'JT', 'SO', 'SK', 'PBM', 'PBT', 'PW', 'IWB', 'JW', 'PLT', 'LT',
+             'ALTN', 'THR', 'ATHR', 'THNSO', 'ATHNSO']
+locations = [('Seattle', 'WA', 'USA'), ('Ghent', '', 'Belgium'), ('Manchester', '', 'UK'), ('Melbourne', 'VIC', 'Australia'),
+             ('Toronto', 'ON', 'Canada'), ('Austin', 'TX', 'USA'), ('Berlin', '', 'Germany')]
+certs = ['', '', '', 'Level 1', 'Level 2', 'Level 3', 'Recognized']
+
+
+def make_ohd(client, number, num_games, rng):
+    """
+    Creates a synthetic v3 OHD for an official
+    :return: the FakeSpreadsheet
+    """
+    name = f"Official {number}"
+    city, region, country = rng.choice(locations)
+    doc = client.create(f"OHD - {name}")
+    doc.add_worksheet('Learn More', [['About the OHD']])
+    profile = [['Profile', '', '', ''],
+               ['Preferred Name', name, '', ''],
+               ['Pronouns', rng.choice(['she/her', 'he/him', 'they/them']), '', ''],
+               ['Derby Name', f"Derby {number}", 'Officiating Number', str(number)],
+               ['Legal Name', f"Legal {number}", 'Email', f"official{number}@example.com"],
+               ['Location', f"{city}, {region}, {country}", 'Phone', ''],
+               ['League', f"{city} Roller Derby", 'Insurance', rng.choice(['WFTDA', 'USARS', ''])],
+               ['Ref Cert', rng.choice(certs), 'Associations', rng.choice(associations)],
+               ['Ref Endorsements', '', '', ''],
+               ['NSO Cert', rng.choice(certs), '', ''],
+               ['NSO Endorsements', '', '', '']]
+    doc.add_worksheet('Profile', profile)
+    history = [conf.caching.history_tab_list]
+    start = datetime.date(2012, 1, 1)
+    for game in range(num_games):
+        date = start + datetime.timedelta(days=rng.randint(0, 365 * 8))
+        city, region, country = rng.choice(locations)
+        history.append([date.strftime('%Y-%m-%d'), f"Event {rng.randint(1, 500)}", f"{city}, {region}, {country}",
+                        f"{city} Roller Derby", f"Team {rng.randint(1, 200)}", f"Team {rng.randint(1, 200)}",
+                        rng.choice(associations), rng.choice(game_types), rng.choice(positions),
+                        rng.choice([''] + positions), rng.choice(['', 'CRG', 'Stats Book']), '', '', ''])
+    # the real docs have a block of empty rows at the end
+    history.extend([[''] * len(conf.caching.history_tab_list)] * 20)
+    doc.add_worksheet('Game History', history)
+    return doc
+
+
+def make_register(client, num_officials, games_per_official=(0, 60), tab_name='History Register', seed=0,
+                  missing=0.0):
+    """
+    Creates a synthetic History Register, and an OHD for each official in it
+    :param client: the FakeClient to create the docs in
+    :param num_officials: the number of officials in the Register
+    :param games_per_official: the (min, max) number of games in each official's history
+    :param tab_name: the name of the Register tab
+    :param seed: the random seed, the same seed makes the same Register
+    :param missing: the fraction of officials whose OHD doesn't exist (so loading them is a 404)
+    :return: the Register doc ID
+    """
+    rng = random.Random(seed)
+    register = client.create('OHD History Register')
+    rows = [conf.caching.reg_tab_list]
+    for number in range(num_officials):
+        if rng.random() < missing:
+            doc_id = f"missing-{number:06d}"
+        else:
+            doc_id = make_ohd(client, number, rng.randint(*games_per_official), rng).id
+        rows.append([f"official{number}@example.com", f"Derby {number}", f"Legal {number}",
+                     f"https://docs.google.com/spreadsheets/d/{doc_id}", doc_id, '2019-01-01', '2019-06-01',
+                     str(1546300800 + number), '3.0', '', ''])
+    register.add_worksheet(tab_name, rows)
+    return register.id
@@ -0,0 +1,59 @@
+"""
+Measures how long "import ohd" and a cache only start up take, in fresh interpreters, and checks that the Google client
+stack isn't imported when it isn't needed. Exits with an error if it was imported, or the start up was too slow.
+
+Usage:
+python benchmarks/import_time.py [max seconds for a cache only start up]
+"""
+__author__ = 'hammer'
+
+import sys
+import json
+import statistics
+import subprocess
+from pathlib import Path
+
+repeats = 5
+# the modules that should only be imported when Google is actually used
+google_modules = ['pygsheets', 'googleapiclient', 'httplib2', 'google.auth']
+
+# start up in cache only mode, and report the time taken and which of the Google modules got imported
+startup_code = f"""
+import sys, json, time, tempfile
+start = time.perf_counter()
+import ohd
+imported = time.perf_counter()
+ohd.config.conf.init_env('Test', tempfile.mkdtemp())
+ohd.config.conf.logger.setLevel('WARNING')
+ready = time.perf_counter()
+print(json.dumps({{'import ohd': imported - start, 'cache only start up': ready - start,
+                  'google modules': [m for m in {google_modules!r} if m in sys.modules]}}))
+"""
+
+
+def run_startup():
+    """
+    :return: the timings and the Google modules imported by one start up, in a fresh interpreter
+    """
+    root = Path(__file__).resolve().parents[1]
+    output = subprocess.run([sys.executable, '-c', startup_code], cwd=str(root), check=True, stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL, universal_newlines=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+if __name__ == '__main__':
+    max_seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 2.0
+    runs = [run_startup() for _ in range(repeats)]
+    for timing in ['import ohd', 'cache only start up']:
+        times = [run[timing] for run in runs]
+        print(f"{timing}: median {statistics.median(times):.3f}s, max {max(times):.3f}s over {repeats} runs")
+
+    failed = False
+    google_imported = sorted(set(m for run in runs for m in run['google modules']))
+    if google_imported:
+        print(f"FAIL: the Google client stack was imported in cache only mode: {google_imported}")
+        failed = True
+    if statistics.median(run['cache only start up'] for run in runs) > max_seconds:
+        print(f"FAIL: the cache only start up took longer than {max_seconds}s")
+        failed = True
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,92 @@
+"""
+Times matching officials' league names to the league locations with util.match_leagues(), against scoring every league
+for every name (the way the old fuzzy match did), and reports how often they agree. The league names are synthetic, so
+it doesn't need Google access.
+
+Usage:
+python benchmarks/match_leagues.py [number of leagues] [number of officials]
+"""
+__author__ = 'hammer'
+
+import sys
+import random
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+import ohd  # noqa: E402
+
+syllables = ['ra', 'to', 'ci', 'ty', 'go', 'tham', 'win', 'dy', 'tex', 'as', 'ro', 'se', 'den', 'ver', 'lon', 'don',
+             'vic', 'an', 'gel', 'ar', 'ch', 'ri', 'val', 'jet', 'min', 'ne', 'so', 'cri', 'me', 'bay', 'de', 'troit']
+suffixes = ['Roller Derby', 'Rollergirls', 'Roller Girls', 'Derby Dames', 'Rollers', 'Derby League']
+
+
+def make_names(num_leagues, num_officials, seed=0):
+    """
+    :return: a dict of league locations, a list of officials' league names (variations of the league names), and the
+    league each one is a variation of
+    """
+    rng = random.Random(seed)
+    locations = dict()
+    places = set()
+    while len(locations) < num_leagues:
+        place = ' '.join(''.join(rng.sample(syllables, rng.randint(2, 3))).title() for _ in range(rng.randint(1, 2)))
+        if place in places:
+            continue
+        places.add(place)
+        name = f"{place} {rng.choice(suffixes)}"
+        locations[name] = [name] + [''] * 8
+    leagues = list(locations)
+    names = list()
+    truth = list()
+    for _ in range(num_officials):
+        name = rng.choice(leagues)
+        truth.append(name)
+        variation = rng.random()
+        if variation < 0.3:
+            name = name.upper()
+        elif variation < 0.5:
+            name = name.rsplit(' ', 1)[0] + ' ' + rng.choice(suffixes)
+        elif variation < 0.6:
+            name = name + '!'
+        elif variation < 0.7:
+            # a typo
+            position = rng.randrange(len(name))
+            name = name[:position] + name[position + 1:]
+        names.append(name)
+    return locations, names, truth
+
+
+def match_all(names, locations):
+    """
+    :return: the best match for each name, scoring every league
+    """
+    index = ohd.util.LeagueIndex(locations)
+    matches = list()
+    for name in names:
+        tokens = index.tokenize(name)
+        scores = [index.token_set_ratio(tokens, league_tokens) for league_tokens in index.tokens]
+        matches.append(index.names[max(range(len(scores)), key=scores.__getitem__)])
+    return matches
+
+
+if __name__ == '__main__':
+    num_leagues = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    num_officials = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    locations, names, truth = make_names(num_leagues, num_officials)
+
+    start = timeit.default_timer()
+    matches = ohd.util.match_leagues(names, locations)
+    cold = timeit.default_timer() - start
+    warm = timeit.timeit(lambda: ohd.util.match_leagues(names, locations), number=5) / 5
+    correct = sum(match == league for match, league in zip(matches, truth))
+    print(f"{num_officials} officials, {num_leagues} leagues: match_leagues {cold * 1000:.1f}ms (memoized "
+          f"{warm * 1000:.1f}ms), {correct} correct")
+
+    sample = names[:100]
+    start = timeit.default_timer()
+    sample_matches = match_all(sample, locations)
+    seconds = (timeit.default_timer() - start) * num_officials / len(sample)
+    correct = sum(match == league for match, league in zip(sample_matches, truth))
+    print(f"scoring every league: {seconds * 1000:.1f}ms (estimated), {correct} of {len(sample)} correct, "
+          f"match_leagues {sum(match == league for match, league in zip(matches, truth[:len(sample)]))} correct")
@@ -0,0 +1,33 @@
+"""
+Times parsing the values of a history doc (the Profile cells and the Game History tab) into the official's info and a
+DataFrame of typed games, for officials with different numbers of games. Doesn't need Google access.
+
+Usage:
+python benchmarks/parse_history.py [numbers of games, eg 10 300 3000]
+"""
+__author__ = 'hammer'
+
+import sys
+import random
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+import ohd  # noqa: E402
+import fakesheets  # noqa: E402
+
+repeats = 50
+
+if __name__ == '__main__':
+    from ohd import official
+
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10, 300, 3000]
+    ohd.config.conf.logger.setLevel('WARNING')
+    client = fakesheets.FakeClient()
+    ranges = [official.learn_more_range, official.profile_name_range, official.profile_contact_range,
+              official.game_history_range]
+    for num_games in sizes:
+        doc = fakesheets.make_ohd(client, 1, num_games, random.Random(0))
+        values = [vr.get('values', []) for vr in client.sheet.values_batch_get(doc.id, ranges)]
+        seconds = timeit.timeit(lambda: official.parse_history_values(doc.id, values), number=repeats) / repeats
+        print(f"{num_games} games: {seconds * 1000:.2f}ms per doc")
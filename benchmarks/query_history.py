@@ -0,0 +1,90 @@
+"""
+Times a query_history() qualification query over every official at once, against filtering each official's games one
+at a time (the way the old query_history() did), and checks they get the same counts. The cache is filled with
+synthetic games, so it doesn't need Google access.
+
+Usage:
+python benchmarks/query_history.py [numbers of officials, eg 1000 10000]
+"""
+__author__ = 'hammer'
+
+import sys
+import timeit
+import datetime
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+import ohd  # noqa: E402
+import fakesheets  # noqa: E402
+
+repeats = 5
+include = {'standard': [True], 'assn': ['WFTDA', 'MRDA']}
+exclude = {'type': ['Other'], 'role': ['THR', 'ATHR', 'THNSO', 'ATHNSO']}
+intervals = {'start': datetime.date(2020, 1, 1), 'interval': 12, 'max_interval': 5}
+
+
+def make_games(num_officials, games_per_official=30, seed=0):
+    """
+    Fills the game_data partition with random games
+    """
+    rng = np.random.default_rng(seed)
+    num_games = num_officials * games_per_official
+    games = pd.DataFrame({
+        'off_id': np.repeat([f"off-{i:06d}" for i in range(num_officials)], games_per_official),
+        'Date': pd.Timestamp('2012-01-01') + pd.to_timedelta(rng.integers(0, 365 * 8, num_games), unit='D'),
+        'Association': rng.choice(fakesheets.associations, num_games),
+        'Game Type': rng.choice(fakesheets.game_types, num_games),
+        'Position': rng.choice(fakesheets.positions, num_games),
+        '2nd Position': rng.choice([''] + fakesheets.positions, num_games)})
+    caching = ohd.config.conf.caching
+    for off_id, frame in games.groupby('off_id'):
+        caching.stage('game_data', off_id, frame.set_index(['off_id', 'Date']))
+    caching.commit('game_data')
+
+
+def loop_query(edges):
+    """
+    :return: the counts of the query, filtering each official's games in turn
+    """
+    games = ohd.config.conf.caching.cache['game_data']
+    counts = dict()
+    for off_id, frame in games.groupby(level=0, observed=True):
+        buckets = [0] * intervals['max_interval']
+        for date, assn, game_type, position, position_2 in zip(frame.index.get_level_values('Date'),
+                                                               frame['Association'], frame['Game Type'],
+                                                               frame['Position'], frame['2nd Position']):
+            if game_type == ohd.query.other_game_type or assn not in include['assn']:
+                continue
+            if game_type in exclude['type'] and (position in exclude['role'] or position_2 in exclude['role']):
+                continue
+            for bucket in range(intervals['max_interval']):
+                if edges[bucket + 1] < date <= edges[bucket]:
+                    buckets[bucket] += 1
+        counts[off_id] = buckets
+    return pd.DataFrame.from_dict(counts, orient='index')
+
+
+if __name__ == '__main__':
+    sizes = [int(arg) for arg in sys.argv[1:]] or [1000, 10000]
+    conf = ohd.config.conf
+    start = pd.Timestamp(intervals['start'])
+    edges = [start - pd.DateOffset(months=intervals['interval'] * k) for k in range(intervals['max_interval'] + 1)]
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as data_dir:
+            conf.init_env('Test', data_dir)
+            conf.logger.setLevel('WARNING')
+            make_games(size)
+            counts = ohd.query.query_history(include, exclude, intervals)
+            expected = loop_query(edges)
+            assert (counts.loc[expected.index].to_numpy() == expected.to_numpy()).all()
+            for use_indexes in [False, True]:
+                seconds = timeit.timeit(lambda: ohd.query.query_history(include, exclude, intervals,
+                                                                        use_indexes=use_indexes),
+                                        number=repeats) / repeats
+                print(f"{size} officials, query_history (use_indexes={use_indexes}): {seconds * 1000:.1f}ms")
+            seconds = timeit.timeit(lambda: loop_query(edges), number=1)
+            print(f"{size} officials, one official at a time: {seconds * 1000:.1f}ms")
@@ -0,0 +1,148 @@
+"""
+End to end performance benchmarks, run offline against the fake Google Sheets in fakesheets.py.
+For each Register size it times: a Register refresh, a cold load of all the history docs (nothing cached), a warm load
+of the Register and the docs (everything cached, so it should make no API calls), persisting the cache, and
+re-initializing the cache from disk.
+
+Usage:
+python benchmarks/run_benchmarks.py [--sizes 100 1000 10000] [--latency 0.05] [--workers 8] [--backend sqlite]
+                                   [--quota 600] [--error-rate 0.01] [--client-retries 3 --quota-sleep 100]
+"""
+__author__ = 'hammer'
+
+import sys
+import argparse
+import datetime
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+import ohd  # noqa: E402
+import fakesheets  # noqa: E402
+
+
+def timed(label, results, items, func, *args, **kwargs):
+    """
+    Runs func, and adds its runtime and throughput to the results
+    :return: whatever func returns
+    """
+    start = datetime.datetime.now()
+    output = func(*args, **kwargs)
+    seconds = (datetime.datetime.now() - start).total_seconds()
+    results.append({'stage': label, 'items': items, 'seconds': seconds,
+                    'items/s': items / seconds if seconds else float('inf')})
+    return output
+
+
+def latency_stats(label, metric, **labels):
+    """
+    :return: a row of the latency stats of a metric
+    """
+    histogram = ohd.config.conf.metrics.get(metric, **labels)
+    stats = histogram.summary() if histogram else {'count': 0}
+    row = {'stage': label, 'count': stats['count']}
+    for stat in ['p50', 'p95', 'p99', 'max', 'mean']:
+        row[f"{stat} ms"] = stats[stat] * 1000 if stats['count'] else float('nan')
+    return row
+
+
+def run(size, latency, workers, backend, data_dir, quota=None, error_rate=0.0, client_retries=0, quota_sleep=None):
+    """
+    Runs the benchmarks for one Register size
+    :param client_retries: the number of times the fake client retries errors itself, before the quota governor sees
+    them (0, as the client session.py builds does)
+    :param quota_sleep: if set, the fake client sleeps this many seconds on a 429 and tries again, like pygsheets does
+    with check=True
+    :return: a tuple of (list of stage timings, list of per doc latency stats, API call counts, warm run API call counts,
+    the quota governor's counters, the memory used by each cache partition)
+    """
+    conf = ohd.config.conf
+    client = fakesheets.FakeClient()
+    reg_id = fakesheets.make_register(client, size, tab_name='History Register', missing=0.01)
+    client.latency = latency
+    client.error_rate = error_rate
+    client.sheet.retries = client_retries
+    client.sheet.check = quota_sleep is not None
+    client.sheet.seconds_per_quota = quota_sleep or 0
+
+    conf.init_env('Test', data_dir, cache_backend=backend)
+    conf.logger.setLevel('WARNING')
+    conf.runtime.reg_id = reg_id
+    conf.caching.cache_only_mode = False
+    conf.google.client = client
+    conf.google.cred_file = Path(data_dir) / 'service-account.json'
+    conf.google.cred_file.write_text('{}')
+    conf.metrics.reset()
+    # the fake API allows quota requests per minute, and the governor is set to the same, without a quota there's no limit
+    if quota:
+        client.quota = (quota, 60)
+    conf.quota.set_quota('sheets', quota or 10 ** 9, burst=max(1, (quota or 10 ** 9) // 60))
+    conf.quota.backoff_base = 0.05
+    conf.quota.reset()
+
+    results = list()
+    register = timed('register refresh', results, size, ohd.load_register, force_refresh=True)
+    ids = register['History ID']
+    timed('cold history load', results, size, ohd.load_histories, ids, max_workers=workers)
+    api_latency = latency_stats(f"{size}: doc from sheet", 'history_doc', source='sheet')
+    cold_calls = dict(client.calls)
+    timed('warm register load', results, size, ohd.load_register)
+    timed('warm history load', results, size, ohd.load_histories, ids, max_workers=workers)
+    warm_calls = {call: count - cold_calls.get(call, 0) for call, count in client.calls.items()
+                  if count > cold_calls.get(call, 0)}
+    cache_latency = latency_stats(f"{size}: doc from cache", 'cache_fetch', source='cache', result='hit')
+
+    caching = conf.caching
+    memory = caching.memory_usage()
+    for key in caching.cache_defs:
+        caching.mark_dirty(key)
+    timed('full persist_cache', results, len(caching.cache['game_data']), caching.persist_cache)
+    off_id = ids.iloc[len(ids) // 2]
+    caching.mark_dirty('game_data', off_id)
+    caching.mark_dirty('officials', off_id)
+    timed('1 official persist_cache', results, 1, caching.persist_cache)
+
+    def cold_init():
+        caching.init_cache()
+        for cache_key in caching.cache_defs:
+            caching.cache[cache_key]
+    timed('init_cache (all partitions)', results, len(caching.cache['game_data']), cold_init)
+
+    for row in results:
+        row['size'] = size
+    return results, [api_latency, cache_latency], dict(client.calls), warm_calls, conf.quota.summary(), memory
+
+
+if __name__ == '__main__':
+    import pandas as pd
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument('--latency', type=float, default=0.05, help="seconds per fake API call")
+    parser.add_argument('--workers', type=int, default=8, help="max_workers for load_histories")
+    parser.add_argument('--backend', default='sqlite', help="the cache storage backend")
+    parser.add_argument('--quota', type=int, help="the Sheets API requests per minute allowed, by default no limit")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="the fraction of fake API calls that fail")
+    parser.add_argument('--client-retries', type=int, default=0,
+                        help="the number of times the client retries errors itself, pygsheets' default is 3")
+    parser.add_argument('--quota-sleep', type=float,
+                        help="seconds the client sleeps on a 429 before trying again, pygsheets' default is 100")
+    args = parser.parse_args()
+
+    stages = list()
+    latencies = list()
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as data_dir:
+            size_stages, size_latencies, calls, warm_calls, quota, memory = run(size, args.latency, args.workers,
+                                                                                args.backend, data_dir, args.quota,
+                                                                                args.error_rate, args.client_retries,
+                                                                                args.quota_sleep)
+        stages.extend(size_stages)
+        latencies.extend(size_latencies)
+        print(f"{size} officials, API calls: {calls}, warm run API calls: {warm_calls}")
+        print(f"{size} officials, quota governor: {quota}")
+        print(f"{size} officials, cache memory (MB): { {key: round(mb / 2 ** 20, 2) for key, mb in memory.items()} }")
+
+    pd.set_option('display.width', 200)
+    print(pd.DataFrame(stages).set_index(['size', 'stage']).round(3))
+    print(pd.DataFrame(latencies).set_index('stage').round(2))
@@ -15,14 +15,29 @@ conf.import_keys()
 __author__ = 'hammer'
 __version__ = '2.0.0-alpha'
 
+import importlib
 from . import config
 # from . import util
 
 # from util import get_names
 # from util import get_version
-from .util import authenticate_with_google
-from .register import load_register
-# from .register import load_histories
-from .official import load_history_doc
+
+# The rest of the package is imported the first time it's used, so that "import ohd" is quick, and the Google client
+# stack is only imported if it's actually needed (never in cache only mode)
+_lazy_modules = ['util', 'register', 'official', 'storage', 'crawl', 'reports', 'query', 'weights', 'geo', 'oldcert',
+                 'session']
+_lazy_functions = {'authenticate_with_google': 'util',
+                   'load_register': 'register',
+                   'load_histories': 'register',
+                   'load_history_doc': 'official',
+                   'query_history': 'query'}
+
+
+def __getattr__(name):
+    if name in _lazy_modules:
+        return importlib.import_module(f".{name}", __name__)
+    if name in _lazy_functions:
+        return getattr(importlib.import_module(f".{_lazy_functions[name]}", __name__), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 # TODO: refactor Central Officiating Informatics Library (COIL): coil.officials coil.leagues
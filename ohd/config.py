@@ -5,12 +5,16 @@ All the configuration items for the application, and the runtime config object.
 __author__ = 'hammer'
 
 import json
+import atexit
 import logging
-import pygsheets
-import sqlalchemy
+import contextlib
+import functools
+import itertools
 import datetime
 import pandas as pd
 from pathlib import Path
+from .metrics import Metrics
+from .quota import Governor
 # from . import util
 
 
@@ -24,6 +28,8 @@ class Conf:
         self.caching = self.Cache()
         self.logging = self.Logging()
         self.logger = self.logging.logger
+        self.metrics = Metrics()  # timings of each stage of loading the data, see metrics.py
+        self.quota = Governor()  # rate limits and retries all the calls to the Google APIs, see quota.py
 
     def __repr__(self):
         return f"Conf object, env: {self.runtime.label}"
@@ -40,17 +46,15 @@ class Conf:
         # Authenticated connection
         client = None
 
-        # runtime performance data
-        runtime_api = list()  # for collecting the average time to process a google doc from API
-        runtime_cache = list()  # for collecting the average time to process a google doc from the cache
-
         def get_client(self):
             """
-            Returns the active connection to the Google Docs API, refreshing it if needed
-            :return: an active
+            Returns the active connection to the Google Docs API, the process's shared session (see session.py)
+            unless a client has been set
+            :return: an active, authorized pygsheets client
             """
             if not self.client:
-                self.client = pygsheets.authorize(service_file=self.cred_file)
+                from .session import session  # the Google client stack is slow to import, so only load it when it's needed
+                self.client = session.get_client(self.cred_file)
             return self.client
 
     ##########
@@ -65,8 +69,14 @@ class Conf:
         reg_tab_name = None
         reg_tab_name_prod = 'History Register'
         reg_tab_name_test = 'Test History Register'  # This is the test tab name, in either test or prod docs, so it's likely to only be set explicitly
+        locations_id = None  # the Google Sheet ID of the league locations, see util.load_locations()
+        locations_tab_name = 'Locations'
+        # the league locations tab format (columns), the first column is the league name
+        locations_tab_list = ['League', 'City', 'State / Province', 'Country', 'Association', 'Type', 'Website',
+                              'Latitude', 'Longitude']
 
         stale_days = 10  # the number of days old cached data is before it's considered stale
+        max_evict_fraction = 0.25  # the largest fraction of the cached officials a Register refresh can evict at once
         force_refresh = False  # if True, then fetch data live, regardless of what's in the cache
 
         label = 'Production'
@@ -79,8 +89,19 @@ class Conf:
         """
         file = None
         cache = None
-        engine = None
+        backend = 'sqlite'  # the name of the storage backend for the cache on disk, one of storage.backends
+        storage = None
+        dirty = dict()  # cache items changed since the last persist, by partition (None means the whole partition)
+        staged = dict()  # cache items waiting to be added by commit(), by partition
+        batches = 0  # the number of batch() blocks currently open
+        checkpoint_every = 50  # the number of staged items a checkpoint() waits for, outside a batch()
+        sorted = set()  # the partitions that are currently sorted by their index
+        dictionaries = dict()  # the values of each category column, by column name, see categorize()
+        versions = dict()  # the version of each partition, changed every time the partition is, see version()
+        changes = dict()  # the version each item last changed at, by partition, see changed_since()
+        version_counter = itertools.count()
         cache_only_mode = True  # Flag set to force cache values to be used
+        stale_while_revalidate = False  # Flag set to use stale cache values, while they're refreshed in the background
 
         # OHD Register sheet format (columns)
         reg_tab_list = ['Email Address', 'Derby Name', 'Legal Name', 'History URL', 'History ID', 'Created', 'Last Game',
@@ -98,84 +119,522 @@ class Conf:
                                        'Insurance_Derby', 'Association_Affiliations_raw']
 
         # cache / final data columns
+        # 'categories' are the columns of repetitive strings that are kept as categoricals, with one dictionary of values
+        # per column name, shared by all the partitions and stored in the categories partition (so only the codes of the
+        # values are stored in the other partitions). A dictionary is rewritten whenever it gets a new value, so only the
+        # columns with a few distinct values are categories, free text (eg names) is kept as strings
         cache_defs = dict()
+        cache_defs['categories'] = {'cols': ['values'],
+                                    'dates': []}
         # TODO: Index cols as well?
-        cache_defs['metadata'] = {'cols': ['last_update'],
-                                  'dates': ['last_update']}
+        # metadata is keyed by cache item (eg an OHD doc ID) or by partition name (eg 'register'), and updates to an item
+        # are merged into what's already recorded for it, see touch()
+        cache_defs['metadata'] = {'cols': ['last_update', 'modified_time'],
+                                  'dates': ['last_update', 'modified_time'],
+                                  'merge': True}
         cache_defs['register'] = {'cols': reg_tab_list,
                                   'dates': []}
         cache_defs['officials'] = {'cols': history_officials_data_list,
-                                   'dates': []}
+                                   'dates': [],
+                                   'categories': ['Pronoun_raw', 'Cert_Ref_raw', 'Endorsements_Ref_raw', 'Cert_NSO_raw',
+                                                  'Endorsements_NSO_raw', 'Insurance_Derby',
+                                                  'Association_Affiliations_raw']}
         cache_defs['game_data'] = {'cols': ['off_id'] + history_tab_list,
                                    'index': ['off_id', 'Date'],
-                                   'dates': ['Date']}
+                                   'dates': ['Date'],
+                                   'categories': ['Event Location', 'Event Host', 'Association', 'Game Type', 'Position',
+                                                  '2nd Position', 'Software']}
+        # geocoded addresses, keyed by normalized address, see geo.py. Addresses that couldn't be found have no latitude
+        # and longitude, so they aren't looked up again
+        cache_defs['geocode'] = {'cols': ['latitude', 'longitude', 'source'],
+                                 'dates': []}
+        # the queue of history docs to load, see crawl.py
+        cache_defs['crawl'] = {'cols': ['state', 'priority', 'attempts', 'retry_after'],
+                               'dates': ['retry_after'],
+                               'categories': ['state']}
+
+        class Partitions(dict):
+            """
+            The in-memory cache partitions, each one is only loaded from storage the first time it's used
+            """
+            def __init__(self, loader):
+                super().__init__()
+                self.loader = loader
+
+            def __missing__(self, key):
+                if key not in conf.caching.cache_defs:
+                    raise KeyError(key)
+                self[key] = self.loader(key)
+                return self.committed(key)
+
+            def __getitem__(self, key):
+                # the staged items of a partition are added the first time it's used after they were staged
+                if key in conf.caching.staged:
+                    conf.caching.commit(key)
+                return super().__getitem__(key)
+
+            def committed(self, key):
+                """
+                :return: a partition, without adding the items staged for it
+                """
+                return super().__getitem__(key)
 
         def init_cache(self):
             """
             Initalizes a connection to the cache, and creates an empty cache if there is no cache.
+            The partitions of the cache are loaded the first time they are used, so the cost of starting up the cache is
+            the loading of its partitions, which is timed by the load_partition metric (labelled with the partition).
             The environment will need to be initialized first.
             """
+            from .storage import backends
+
             try:
                 file = Path(self.file)
             except TypeError:
                 # self.logger.error("Environment hasn't been configured, run init_env()")
                 raise Exception("Environment needs to be configured first")
-            engine = sqlalchemy.create_engine(f"sqlite:///{file}")
-            cache = dict()
-            self.engine = engine
-
-            # load each of the defined caches
-            cache_defs = self.cache_defs
-            for key in cache_defs:
-                conf.logger.debug(f"initializing cache:{key}")
-                if engine.has_table(key):
-                    conf.logger.debug(f"Getting {key} from database")
-                    cache[key] = pd.read_sql_table(key, engine, index_col='index', parse_dates=cache_defs[key]['dates'])
-                else:
-                    conf.logger.debug(f"Making {key} from scratch")
-                    df = pd.DataFrame(columns=cache_defs[key]['cols'])
-                    if 'index' in cache_defs[key]:
-                        conf.logger.debug(f"making index of: {cache_defs[key]['index']}")
-                        df = df.set_index(cache_defs[key]['index'])
-                    cache[key] = df
-            self.cache = cache
+            self.storage = backends[self.backend](file, self.cache_defs)
+            self.dirty = dict()
+            self.staged = dict()
+            self.sorted = set()
+            self.dictionaries = dict()
+            self.versions = {key: next(self.version_counter) for key in self.cache_defs}
+            self.changes = {key: (version, dict()) for key, version in self.versions.items()}
+            self.load_times = dict()
+            self.cache = self.Partitions(self.load_partition)
             # conf.logger.debug("Pre-persist")
             # self.persist_cache()
             # conf.logger.debug("Post-persist")
 
-        def fetch(self, cache_key, item):
+        def load_partition(self, key):
+            """
+            Loads a partition of the cache from storage, or creates an empty one if it hasn't been stored
+            :param key: the partition of the cache to load
+            :return: the partition DataFrame
+            """
+            start = datetime.datetime.now()
+            cache_defs = self.cache_defs
+            conf.logger.debug(f"initializing cache:{key}")
+            if self.storage.has_partition(key):
+                conf.logger.debug(f"Getting {key} from {self.backend} storage")
+                df = self.storage.read(key)
+                missing = [col for col in cache_defs[key]['cols'] if col not in df.columns and col not in df.index.names]
+                if missing:
+                    # the cache on disk is from an older version, add the new columns and rewrite it on next persist
+                    conf.logger.debug(f"Adding {missing} to the {key} cache")
+                    df = df.reindex(columns=list(df.columns) + missing)
+                    self.mark_dirty(key)
+                df = self.decode(key, df)
+            else:
+                conf.logger.debug(f"Making {key} from scratch")
+                df = self.empty_partition(key)
+            self.load_times[key] = datetime.datetime.now() - start
+            conf.metrics.observe('load_partition', self.load_times[key], source='cache', partition=key)
+            conf.logger.debug(f"Loaded {len(df)} items into the {key} cache in {self.load_times[key].total_seconds():.2f}s, "
+                              f"using {df.memory_usage(deep=True).sum() / 2 ** 20:.1f}MB")
+            return df
+
+        def empty_partition(self, key):
+            """
+            Makes an empty DataFrame in the format of a cache partition
+            :param key: the partition of the cache
+            :return: the empty DataFrame
+            """
+            df = pd.DataFrame(columns=self.cache_defs[key]['cols'])
+            if 'index' in self.cache_defs[key]:
+                conf.logger.debug(f"making index of: {self.cache_defs[key]['index']}")
+                df = df.set_index(self.cache_defs[key]['index'])
+            return self.categorize(key, df)
+
+        def read_games(self, off_ids):
+            """
+            Reads the game data of just the given officials from storage, without loading the whole game_data
+            partition. If game_data has already been loaded, it's used instead (it may have unpersisted changes).
+            :param off_ids: a list of OHD Google Doc IDs
+            :return: a DataFrame of the officials' games, indexed by (off_id, Date)
+            """
+            off_ids = list(off_ids)
+            if 'game_data' in self.cache:
+                df = self.cache['game_data']
+                return df[df.index.get_level_values(0).isin(off_ids)]
+            games = None
+            if self.storage.has_partition('game_data'):
+                games = self.storage.read_items('game_data', off_ids)
+            if games is None:
+                return self.empty_partition('game_data')
+            return self.decode('game_data', games)
+
+        def dictionary(self, col):
+            """
+            :param col: the name of a category column
+            :return: the column's dictionary, an Index of all the values it has had, in the order they were first seen
+            """
+            if col not in self.dictionaries:
+                item = self.lookup('categories', col)
+                self.dictionaries[col] = pd.Index(json.loads(item['values']) if item is not None else [], dtype=object)
+            return self.dictionaries[col]
+
+        def categorize(self, key, df):
+            """
+            Converts the category columns of a partition to categoricals, with the column's dictionary as the categories,
+            the date columns to datetimes, and downcasts the numeric columns. New values are added to the end of the
+            dictionary, so the codes of the values already in it never change.
+            :param key: the partition of the cache the DataFrame belongs to
+            :param df: a DataFrame of the partition's rows
+            :return: the converted DataFrame
+            """
+            df = df.copy(deep=False)
+            for col in self.cache_defs[key].get('categories', []):
+                if col not in df.columns:
+                    continue
+                values = df[col]
+                dictionary = self.dictionary(col)
+                if isinstance(values.dtype, pd.CategoricalDtype):
+                    if values.cat.categories.equals(dictionary):
+                        continue
+                    new = values.cat.categories
+                else:
+                    new = pd.Index(values.dropna().unique())
+                new = new[~new.isin(dictionary)]
+                if len(new):
+                    dictionary = dictionary.append(pd.Index(new, dtype=object))
+                    self.dictionaries[col] = dictionary
+                    self.stage('categories', col, {'values': json.dumps(list(dictionary), default=str)})
+                if isinstance(values.dtype, pd.CategoricalDtype):
+                    df[col] = values.cat.set_categories(dictionary)
+                else:
+                    df[col] = pd.Categorical(values, categories=dictionary)
+            for col in self.cache_defs[key]['dates']:
+                # a date column that's all blank (eg a new partition) would otherwise be an object or float column, and
+                # so would anything it's concatenated with
+                if col in df.columns and not pd.api.types.is_datetime64_dtype(df[col]):
+                    df[col] = pd.to_datetime(df[col], errors='coerce')
+            for col in df.columns:
+                if pd.api.types.is_integer_dtype(df[col]):
+                    df[col] = pd.to_numeric(df[col], downcast='integer')
+                elif pd.api.types.is_float_dtype(df[col]):
+                    df[col] = pd.to_numeric(df[col], downcast='float')
+            if 'categories' in self.staged and key != 'categories':
+                self.commit('categories')
+            return df
+
+        def encode(self, key, df):
+            """
+            Converts a partition to the format it's stored in: the category columns as their codes in the dictionary,
+            and the numbers at full width
+            :param key: the partition of the cache
+            :param df: the partition DataFrame
+            :return: the converted DataFrame
+            """
+            df = df.copy(deep=False)
+            for col in df.columns:
+                if isinstance(df[col].dtype, pd.CategoricalDtype):
+                    values = df[col]
+                    if not values.cat.categories.equals(self.dictionary(col)):
+                        values = self.categorize(key, df[[col]])[col]
+                    df[col] = values.cat.codes.astype('int64')
+                elif pd.api.types.is_integer_dtype(df[col]):
+                    df[col] = df[col].astype('int64')
+                elif pd.api.types.is_float_dtype(df[col]):
+                    df[col] = df[col].astype('float64')
+            return df
+
+        def decode(self, key, df):
+            """
+            Converts a partition read from storage back to categoricals, the reverse of encode(). Category columns stored
+            as strings (by an older version) are converted too, as are the codes of columns that are no longer category
+            columns, and the partition is flagged to be rewritten.
+            :param key: the partition of the cache
+            :param df: the partition DataFrame, as read from storage
+            :return: the converted DataFrame
+            """
+            df = df.copy(deep=False)
+            categories = self.cache_defs[key].get('categories', [])
+            for col in categories:
+                if col in df.columns and pd.api.types.is_integer_dtype(df[col]):
+                    df[col] = pd.Categorical.from_codes(df[col], categories=self.dictionary(col))
+                elif col in df.columns and len(df):
+                    self.mark_dirty(key)
+            for col in df.columns.difference(categories):
+                # a column that used to be a category column is stored as codes, so it's converted back to strings
+                if pd.api.types.is_integer_dtype(df[col]) and self.lookup('categories', col) is not None:
+                    df[col] = pd.Categorical.from_codes(df[col], categories=self.dictionary(col)).astype(object)
+                    self.mark_dirty(key)
+            return self.categorize(key, df)
+
+        def version(self, cache_key):
+            """
+            :param cache_key: a partition of the cache
+            :return: the version of the partition, which is different every time the partition changes (or the cache is
+            re-initialized), so it can be used to tell if results computed from the partition are still valid
+            """
+            if cache_key in self.staged:
+                self.commit(cache_key)
+            return self.versions.get(cache_key)
+
+        def changed_since(self, cache_key, version):
+            """
+            :param cache_key: a partition of the cache
+            :param version: a version of the partition, as returned by version()
+            :return: a list of the items of the partition that changed (or were removed) since that version, or None if
+            that can't be known, because the whole partition was replaced or the cache re-initialized since
+            """
+            if cache_key in self.staged:
+                self.commit(cache_key)
+            reset_version, items = self.changes[cache_key]
+            if version is None or version < reset_version:
+                return None
+            return [item for item, item_version in items.items() if item_version > version]
+
+        def memory_usage(self):
+            """
+            :return: a dict of the memory used (in bytes) by each of the loaded cache partitions
+            """
+            return {key: int(df.memory_usage(deep=True).sum()) for key, df in self.cache.items()}
+
+        def fetch(self, cache_key, item, allow_stale=False):
             """
             Queries the cache and returns an item from the cache, if it is found and if it is considered sufficicently current.
             :param cache_key: the partition of the cache to search
             :param item: the cache item key to fetch
-            :return: the cached item, if found, and None if no current item found
+            :param allow_stale: if True, stale items are returned too, flagged as stale (for stale-while-revalidate)
+            :return: the cached item, if found, and None if no current item found. If allow_stale is set, a tuple of
+            (the cached item or None, True if the item is stale)
             """
-            if item in self.cache[cache_key].index:
+            value = self.lookup(cache_key, item)
+            stale = False
+            if value is not None:
                 if conf.runtime.force_refresh:
                     # ignore cache, force the loading of data
-                    return None
-                if self.cache_only_mode:
+                    value = None
+                elif self.cache_only_mode:
                     # force the use of cached values
-                    return self.cache[cache_key].loc[item]
-                if cache_key == 'game_data':
+                    pass
+                elif cache_key == 'game_data':
                     # game data recency isn't tracked in the metadata, so bypass the stale check
-                    return self.cache[cache_key].loc[item]
-                cache_expiry = datetime.datetime.now() - datetime.timedelta(days=conf.runtime.stale_days)
-                if self.cache['metadata'].loc[item]['last_update'] > cache_expiry:
-                    # return the cached value only if it's not "stale"
-                    return self.cache[cache_key].loc[item]
-            return None
+                    pass
+                elif self.is_stale(item):
+                    # only return the cached value if it's not "stale", unless the caller will take it anyway
+                    stale = True
+                    if not allow_stale:
+                        value = None
+            if allow_stale:
+                return value, stale
+            return value
+
+        def lookup(self, cache_key, item):
+            """
+            Finds an item in a cache partition, regardless of how current it is. The partitions are kept sorted by their
+            index, so this is a hash or binary search lookup rather than a scan, however big the partition gets. Items
+            that are staged are found too, without committing them.
+            :param cache_key: the partition of the cache to search
+            :param item: the cache item key to find (for game_data, the off_id)
+            :return: the item (for game_data, a DataFrame of the official's games indexed by Date) or None if not found
+            """
+            df = self.cache.committed(cache_key)
+            if cache_key not in self.sorted:
+                df = df.sort_index()
+                self.cache[cache_key] = df
+                self.sorted.add(cache_key)
+                # the items are the same, but anything that relies on the order of the rows needs to know it changed
+                self.versions[cache_key] = next(self.version_counter)
+            staged = self.staged.get(cache_key, dict()).get(item)
+            if isinstance(staged, pd.DataFrame):
+                # staged games replace all the official's committed ones
+                return staged.droplevel(0) if not staged.empty else None
+            try:
+                loc = df.index.get_loc(item)
+            except KeyError:
+                loc = None
+            if staged is not None:
+                value = pd.Series(staged, index=df.columns, dtype=object, name=item)
+                if loc is not None and self.cache_defs[cache_key].get('merge'):
+                    value = value.where(value.notna(), df.iloc[loc])
+                return value
+            if loc is None:
+                return None
+            if isinstance(df.index, pd.MultiIndex):
+                return df.iloc[loc].droplevel(0)
+            return df.iloc[loc]
+
+        def touch(self, items, when=None, **fields):
+            """
+            Records in the metadata that cache items, or whole partitions, are up to date. Only the given fields are
+            changed, anything else already recorded for an item (eg its modified_time) is kept.
+            :param items: a cache item key (eg an OHD doc ID) or partition name (eg 'register'), or a list of them
+            :param when: the time they were brought up to date, by default now
+            :param fields: any other metadata columns to record, eg modified_time
+            """
+            if isinstance(items, str) or not hasattr(items, '__iter__'):
+                items = [items]
+            values = {'last_update': when or datetime.datetime.now(), **fields}
+            for item in items:
+                self.stage('metadata', item, dict(values))
+
+        def age(self, item):
+            """
+            :param item: a cache item key or partition name
+            :return: the time since the item was last brought up to date, as a timedelta, or None if it never has been
+            """
+            metadata = self.lookup('metadata', item)
+            if metadata is None or pd.isna(metadata['last_update']):
+                return None
+            return datetime.datetime.now() - metadata['last_update']
+
+        def is_stale(self, item, stale_days=None):
+            """
+            :param item: a cache item key or partition name
+            :param stale_days: the number of days before the item is stale, by default conf.runtime.stale_days
+            :return: True if the item is older than stale_days, or has never been brought up to date
+            """
+            if stale_days is None:
+                stale_days = conf.runtime.stale_days
+            age = self.age(item)
+            return age is None or age > datetime.timedelta(days=stale_days)
+
+        def stage(self, cache_key, item, value):
+            """
+            Collects a new or updated cache item, to be added to the in-memory cache with the rest of the batch by commit().
+            Staging is cheap, the partitions are only rebuilt once per commit rather than once per item. Staging an item
+            of a partition that merges (like metadata) again only replaces the columns that are staged again.
+            :param cache_key: the partition of the cache the item belongs to
+            :param item: the cache item key
+            :param value: a dict of the item's columns, or for game_data a DataFrame indexed by (off_id, Date)
+            """
+            staged = self.staged.setdefault(cache_key, dict())
+            if self.cache_defs[cache_key].get('merge') and item in staged:
+                value = {**staged[item], **value}
+            staged[item] = value
+
+        @contextlib.contextmanager
+        def batch(self):
+            """
+            A block that stages items, eg by loading docs with official.load_history_doc(), and only commits and persists
+            them once, at the end:
+            with conf.caching.batch():
+                for doc_id in doc_ids:
+                    ohd.load_history_doc(doc_id)
+            """
+            self.batches += 1
+            try:
+                yield self
+            finally:
+                self.batches -= 1
+                if not self.batches:
+                    self.persist_cache()
+
+        def checkpoint(self):
+            """
+            Called after staging an item: commits and persists the staged items once checkpoint_every of them have built
+            up in a partition, unless in a batch(), which does it once at the end. So the partitions are rebuilt once
+            per checkpoint_every items, rather than once per item.
+            """
+            if not self.batches and max(map(len, self.staged.values()), default=0) >= self.checkpoint_every:
+                self.persist_cache()
+
+        def commit(self, cache_keys=None):
+            """
+            Adds all the staged items to the in-memory cache, replacing any existing entries with the same key (or for
+            partitions that merge, like metadata, updating just the columns that were staged), and flags them to be
+            persisted. Each partition is rebuilt with a single concat.
+            :param cache_keys: a partition, or list of partitions, to commit. If None, all the staged items are committed
+            """
+            if isinstance(cache_keys, str):
+                cache_keys = [cache_keys]
+            for cache_key in list(self.staged):
+                if cache_keys is not None and cache_key not in cache_keys:
+                    continue
+                items = self.staged.pop(cache_key, None)
+                if not items:
+                    continue
+                df = self.cache[cache_key]
+                keys = list(items)
+                if isinstance(df.index, pd.MultiIndex):
+                    keep = df[~df.index.get_level_values(0).isin(keys)]
+                    new = [frame for frame in items.values() if not frame.empty]
+                    new = [pd.concat(new, sort=False)] if new else []
+                else:
+                    keep = df[~df.index.isin(keys)]
+                    new = pd.DataFrame.from_dict(items, orient='index')
+                    new.index.name = df.index.name
+                    if self.cache_defs[cache_key].get('merge'):
+                        # keep the recorded values of any columns the staged items don't set
+                        new = new.combine_first(df[df.index.isin(keys)])
+                    new = [new]
+                # the new rows go first, so the dictionaries have all their values before the kept rows are aligned to them
+                new = [self.categorize(cache_key, frame.reindex(columns=df.columns)) for frame in new]
+                keep = self.categorize(cache_key, keep)
+                frames = [frame for frame in [keep] + new if not frame.empty]
+                if frames:
+                    self.cache[cache_key] = pd.concat(frames, sort=False).reindex(columns=df.columns)
+                else:
+                    self.cache[cache_key] = keep
+                conf.logger.debug(f"Committed {len(keys)} items to the {cache_key} cache")
+                self.sorted.discard(cache_key)
+                self.mark_dirty(cache_key, keys)
+
+        def evict(self, cache_key, items):
+            """
+            Removes items from a cache partition, and flags them to be deleted from disk by the next persist_cache()
+            :param cache_key: the partition of the cache the items belong to
+            :param items: a list of cache item keys to remove (for game_data, off_ids)
+            """
+            items = list(items)
+            if not items:
+                return
+            df = self.cache[cache_key]
+            keys = df.index.get_level_values(0) if isinstance(df.index, pd.MultiIndex) else df.index
+            self.cache[cache_key] = df[~keys.isin(items)]
+            self.mark_dirty(cache_key, items)
+            conf.logger.debug(f"Evicted {len(items)} items from the {cache_key} cache")
+
+        def mark_dirty(self, cache_key, items=None):
+            """
+            Flags items in a cache partition as changed, so the next persist_cache() writes them to disk, and changes the
+            partition's version.
+            Items that are no longer in the in-memory partition will be deleted from disk.
+            :param cache_key: the partition of the cache the items belong to
+            :param items: a cache item key, or list of keys, that changed. If None, the whole partition will be rewritten
+            """
+            version = next(self.version_counter)
+            self.versions[cache_key] = version
+            if items is None:
+                self.dirty[cache_key] = None
+                self.changes[cache_key] = (version, dict())
+                return
+            if isinstance(items, str) or not hasattr(items, '__iter__'):
+                items = [items]
+            self.changes[cache_key][1].update(dict.fromkeys(items, version))
+            if cache_key not in self.dirty:
+                self.dirty[cache_key] = set()
+            if self.dirty[cache_key] is not None:
+                self.dirty[cache_key].update(items)
 
         def persist_cache(self):
             """
-            Persists the in memory cache to disk.
+            Persists the changed items of the in memory cache to disk, through the storage backend, after committing the
+            staged ones.
+            Partitions flagged for a full rewrite (or not yet on disk) are replaced, otherwise only the dirty keys are
+            deleted and re-inserted, so the time to persist depends on what changed rather than the size of the cache.
             """
-            # save each of the defined caches to disk
-            cache_defs = self.cache_defs
-            for key in cache_defs:
-                if not self.cache[key].empty:
-                    logging.debug(f"Persisting {key} to the cache")
-                    self.cache[key].to_sql(key, self.engine, if_exists='replace')
+            from .storage import Change
+
+            self.commit()
+            changes = dict()
+            for key in self.cache_defs:
+                if key not in self.dirty:
+                    continue
+                df, keys = self.cache[key], self.dirty[key]
+                full = functools.partial(self.encode, key, df)
+                if keys is None or not self.storage.has_partition(key):
+                    changes[key] = Change(full(), None, len(df), full)
+                else:
+                    # only the changed rows are encoded, the whole partition is only encoded if it's rewritten
+                    changes[key] = Change(self.encode(key, self.storage.changed_rows(df, keys)), keys, len(df), full)
+            if changes:
+                with conf.metrics.timer('persist', source='cache'):
+                    self.storage.write(changes)
+            self.dirty = dict()
 
     ##########
     # SECTION: Logging
@@ -188,7 +647,7 @@ class Conf:
 
     ##########
     # SECTION: Helper functions
-    def init_env(self, env_name, data_dir="./data", with_keys=False, stale_days_override=None):
+    def init_env(self, env_name, data_dir="./data", with_keys=False, stale_days_override=None, cache_backend=None):
         """
         At runtime, initialize the Config object to match the runtime environment configuration.
         This should be the first thing when using the OHD module.
@@ -196,6 +655,7 @@ class Conf:
         :param data_dir: directory where data files will be looked for; by default "./data"
         :param with_keys: if True, will import the API keys from the data_dir
         :param stale_days_override: An override for the stale_days parameter
+        :param cache_backend: An override for the cache storage backend ('sqlite' or 'hdf')
         """
         self.logger.debug(f"Configuring runtime as: {env_name}")
         # runtime env specific config goes here
@@ -232,6 +692,8 @@ class Conf:
             self.logger.error(f"Tried setting the runtime environment to {env_name} but that environment configuration was not found.")
             raise Exception(f"Configuration for the {env_name} environment cannot be found.")
 
+        self.metrics.default_labels['environment'] = self.runtime.label
+
         # Action flags
         if with_keys:
             self.import_keys()
@@ -240,8 +702,12 @@ class Conf:
         if stale_days_override:
             self.runtime.stale_days = stale_days_override
 
+        if cache_backend:
+            self.caching.backend = cache_backend
+
         # Initialize the cache
-        self.caching.file = data_path / f"ohd-cache-{env_name}.db"
+        from .storage import backends
+        self.caching.file = data_path / f"ohd-cache-{env_name}.{backends[self.caching.backend].extension}"
         self.caching.init_cache()
 
     def import_keys(self, api_keyfile=None, service_account=None):
@@ -263,9 +729,16 @@ class Conf:
             service_account = Path(service_account)
         else:
             service_account = self.runtime.data_dir / 'service-account.json'
-        self.runtime.cache_only_mode = False
+        self.caching.cache_only_mode = False
         self.google.cred_file = service_account
 
 
 # runtime config object
 conf = Conf()
+
+
+@atexit.register
+def _persist_staged():
+    # anything still staged (eg the last few docs loaded by load_history_doc() outside a batch) is persisted on exit
+    if conf.caching.staged and conf.caching.storage is not None:
+        conf.caching.persist_cache()
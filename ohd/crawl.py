@@ -0,0 +1,165 @@
+"""
+This module contains the crawl of the whole History Register.
+The history docs to load are kept in a queue in the cache (the crawl partition), so a crawl can be spread over several
+runs, each with a budget, and the next run carries on where the last one stopped (even if it crashed or hit the quota).
+
+Each doc in the queue has a state:
+- pending: waiting to be loaded, the highest priority (most out of date) first
+- in-flight: being loaded by a crawl, if a crawl finds any it means the last one didn't finish them, so they're pending
+- done: loaded, and only queued again once it's stale
+- error: failed to load, it's retried after its retry_after time
+
+Usage:
+reg, work = ohd.load_register(with_changes=True)
+ohd.crawl.queue_docs(reg, work)
+summary = ohd.crawl.crawl(time_budget=datetime.timedelta(minutes=30))
+"""
+__author__ = 'hammer'
+
+from .config import conf
+from . import register
+
+import datetime
+import pandas as pd
+
+
+def queue_docs(reg, work=None):
+    """
+    Brings the crawl queue up to date with the History Register. Officials that are new to the queue, or done but stale
+    in the cache, are queued as pending with a priority of the number of days since they were cached (inf if they never
+    have been), and officials in the work list are queued with its priority. Officials no longer in the Register are
+    removed from the queue.
+    :param reg: the History Register DataFrame
+    :param work: the Register work list, as returned by load_register(with_changes=True)
+    :return: the number of docs pending in the queue
+    """
+    queue = conf.caching.cache['crawl']
+    ids = reg['History ID']
+    ids = pd.Index(ids[ids.astype(bool) & ids.notna()].unique())
+
+    last_update = conf.caching.cache['metadata']['last_update'].reindex(ids)
+    priority = ((datetime.datetime.now() - last_update) / pd.Timedelta(days=1)).fillna(float('inf'))
+    requeue = priority > conf.runtime.stale_days
+    if work is not None:
+        work = work[(work['change'] != 'removed') & work.index.isin(ids)]
+        priority[work.index] = work['priority']
+        requeue[work.index] = True
+    state = queue['state'].reindex(ids)
+    # docs that failed wait for their retry, unless the Register shows they changed
+    requeue &= state.isna() | (state == 'done') | (ids.isin(work.index) if work is not None else False)
+
+    attempts = queue['attempts'].reindex(ids).fillna(0)
+    for doc_id in ids[requeue.values]:
+        conf.caching.stage('crawl', doc_id, {'state': 'pending', 'priority': float(priority[doc_id]),
+                                             'attempts': int(attempts[doc_id]), 'retry_after': pd.NaT})
+    conf.caching.commit('crawl')
+    conf.caching.evict('crawl', queue.index[~queue.index.isin(ids)])
+    conf.caching.persist_cache()
+
+    pending = (conf.caching.cache['crawl']['state'] == 'pending').sum()
+    conf.logger.debug(f"Queued {requeue.sum()} docs to crawl, {pending} pending")
+    return pending
+
+
+def next_batch(size):
+    """
+    :param size: the max number of docs in the batch
+    :return: the IDs of the next docs to load: pending, or in error and due a retry, the highest priority first
+    """
+    queue = conf.caching.cache['crawl']
+    retry_due = (queue['state'] == 'error') & ~(queue['retry_after'] > datetime.datetime.now())
+    ready = queue[(queue['state'] == 'pending') | retry_due]
+    return ready.sort_values('priority', ascending=False, kind='mergesort').index[:size]
+
+
+def set_state(doc_ids, state, retry_delay=None):
+    """
+    Stages a new state for docs in the crawl queue
+    :param doc_ids: a list of doc IDs in the queue
+    :param state: the new state
+    :param retry_delay: for errors, the delay before the first retry, which is doubled for each attempt after that
+    """
+    queue = conf.caching.cache['crawl']
+    now = datetime.datetime.now()
+    for doc_id in doc_ids:
+        item = queue.loc[doc_id]
+        attempts = int(item['attempts'])
+        retry_after = pd.NaT
+        if state == 'error':
+            attempts += 1
+            retry_after = now + retry_delay * 2 ** (attempts - 1)
+        elif state == 'done':
+            attempts = 0
+        conf.caching.stage('crawl', doc_id, {'state': state, 'priority': float(item['priority']),
+                                             'attempts': attempts, 'retry_after': retry_after})
+
+
+def crawl(time_budget=None, call_budget=None, batch_size=50, max_workers=8, retry_delay=datetime.timedelta(hours=1)):
+    """
+    Loads the docs in the crawl queue, a batch at a time, until the queue is empty or the budget runs out.
+    The queue is checkpointed to the cache before and after every batch.
+    :param time_budget: a timedelta, no more batches are started once the crawl has taken this long
+    :param call_budget: the max number of docs to fetch from Google (about one API call each)
+    :param batch_size: the number of docs in each batch
+    :param max_workers: the max number of docs to fetch from Google at the same time
+    :param retry_delay: the delay before retrying a doc that failed to load, doubled for each failed attempt
+    :return: a summary dict of the number of docs loaded by source, the number still pending, the runtime, and why the
+    crawl stopped (done/time/calls/errors/no credentials)
+    """
+    start = datetime.datetime.now()
+    summary = {'cache': 0, 'sheet': 0, 'error': 0}
+    caching = conf.caching
+
+    # a previous crawl didn't finish these docs, so they go back to pending
+    queue = caching.cache['crawl']
+    set_state(queue.index[queue['state'] == 'in-flight'], 'pending')
+    caching.commit('crawl')
+
+    calls = 0
+    while True:
+        if time_budget is not None and datetime.datetime.now() - start >= time_budget:
+            stopped = 'time'
+            break
+        size = batch_size
+        if call_budget is not None:
+            size = min(size, call_budget - calls)
+            if size <= 0:
+                stopped = 'calls'
+                break
+        batch = next_batch(size)
+        if not len(batch):
+            stopped = 'done'
+            break
+        if not conf.google.client and conf.google.cred_file is None:
+            conf.logger.warning("Need to crawl the queued docs but no Google credentials were available")
+            stopped = 'no credentials'
+            break
+
+        set_state(batch, 'in-flight')
+        caching.commit('crawl')
+        caching.persist_cache()
+
+        results, batch_summary = register.load_histories(batch, max_workers=max_workers, persist_every=batch_size,
+                                                         refresh=batch)
+        set_state([doc_id for doc_id, result in results.items() if result[2] != 'error'], 'done')
+        set_state([doc_id for doc_id, result in results.items() if result[2] == 'error'], 'error', retry_delay)
+        caching.commit('crawl')
+        caching.persist_cache()
+
+        for source in summary:
+            summary[source] += batch_summary[source]
+        calls += batch_summary['sheet'] + batch_summary['error']
+        conf.logger.info(f"Crawled {len(batch)} docs: {batch_summary['sheet']} from Google, {batch_summary['cache']} "
+                         f"from cache, {batch_summary['error']} errors")
+        if batch_summary['error'] == len(batch):
+            # most likely out of quota, or offline, so stop until the next run
+            stopped = 'errors'
+            break
+
+    summary['pending'] = len(next_batch(None))
+    summary['stopped'] = stopped
+    summary['runtime'] = datetime.datetime.now() - start
+    conf.logger.info(f"Finished {__name__} in {summary['runtime'].total_seconds():.2f}s ({stopped}): "
+                     f"{summary['sheet']} from Google, {summary['cache']} from cache, {summary['error']} errors, "
+                     f"{summary['pending']} still to crawl")
+    return summary
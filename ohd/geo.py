@@ -0,0 +1,328 @@
+"""
+This module contains the geographic lookups: geocoding addresses, and finding the officials and leagues near a place.
+- addresses are geocoded through a pluggable geocoder (the Google Maps Geocoding API, or a table of known places to work
+  offline), and the results are kept in the geocode cache partition, keyed by normalized address, so each address is
+  only ever looked up once
+- coordinates are kept as NumPy arrays of radians, and distances are great circle (haversine) distances in miles
+- a SpatialIndex (a grid of latitude/longitude cells) finds the points within a radius of a place, or the k nearest,
+  by only measuring the distance to the points in the nearby cells
+
+Usage:
+ohd.geo.geocoder = ohd.geo.TableGeocoder.from_locations(ohd.util.load_locations())  # or the default, Google Maps
+host = ohd.geo.geocode_one('Manchester, UK')
+local = ohd.geo.officials_near(host, 500)
+"""
+__author__ = 'hammer'
+
+from .config import conf
+
+import re
+import numpy as np
+import pandas as pd
+
+earth_radius = 3958.8  # miles
+
+geocoder = None  # the geocoder for addresses that aren't in the cache, by default a GoogleGeocoder
+_google_geocoder = None  # the default geocoder, made the first time it's needed
+
+
+class GeocodeError(Exception):
+    """
+    Raised when the geocoding API fails, with the equivalent HTTP status, so the quota governor can retry it
+    """
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+class GoogleGeocoder:
+    """
+    Geocodes addresses with the Google Maps Geocoding API
+    """
+    url = 'https://maps.googleapis.com/maps/api/geocode/json'
+    name = 'google'
+
+    def __init__(self, api_key=None):
+        """
+        :param api_key: the Maps API key, by default conf.google.maps_api_key
+        """
+        self.api_key = api_key or conf.google.maps_api_key
+        if not self.api_key:
+            raise Exception("Need a Google Maps API key to geocode addresses, see conf.import_keys()")
+        self.session = None
+
+    def request(self, address):
+        response = self.session.get(self.url, params={'address': address, 'key': self.api_key}, timeout=30)
+        response.raise_for_status()
+        result = response.json()
+        if result['status'] == 'OVER_QUERY_LIMIT':
+            raise GeocodeError(f"Over the geocoding quota looking up {address}", status=429)
+        if result['status'] not in ('OK', 'ZERO_RESULTS'):
+            raise GeocodeError(f"Couldn't geocode {address}: {result['status']}")
+        return result['results']
+
+    def __call__(self, address):
+        """
+        :param address: an address
+        :return: a tuple of its (latitude, longitude) in degrees, or None if it couldn't be found
+        """
+        if self.session is None:
+            import requests
+            self.session = requests.Session()
+        results = conf.quota.call(self.request, address, api='maps')
+        if not results:
+            return None
+        location = results[0]['geometry']['location']
+        return location['lat'], location['lng']
+
+
+class TableGeocoder:
+    """
+    Geocodes addresses from a table of known places, without any API calls, eg to work offline
+    """
+    name = 'table'
+
+    def __init__(self, places):
+        """
+        :param places: a dict of address: (latitude, longitude) in degrees
+        """
+        self.places = {normalize_address(address): point for address, point in places.items()}
+
+    @classmethod
+    def from_locations(cls, locations):
+        """
+        :param locations: the league locations, as returned by util.load_locations()
+        :return: a TableGeocoder of the locations' coordinates, by league name and by "City, State / Province, Country"
+        """
+        cols = conf.runtime.locations_tab_list
+        lat, lon = cols.index('Latitude'), cols.index('Longitude')
+        places = dict()
+        for league, row in locations.items():
+            try:
+                point = float(row[lat]), float(row[lon])
+            except (TypeError, ValueError, IndexError):
+                continue
+            places[league] = point
+            places[', '.join(row[cols.index('City'):cols.index('Country') + 1])] = point
+        return cls(places)
+
+    def __call__(self, address):
+        return self.places.get(normalize_address(address))
+
+
+def normalize_address(address):
+    """
+    :return: the address in lower case, with the blank parts and extra spaces removed, eg "Ghent, , Belgium" becomes
+    "ghent, belgium"
+    """
+    parts = [re.sub(r'\s+', ' ', part).strip() for part in str(address).lower().split(',')]
+    return ', '.join(part for part in parts if part)
+
+
+def geocode(addresses):
+    """
+    Geocodes a list of addresses, from the geocode cache, looking up the addresses that aren't cached with the geocoder.
+    In cache only mode the default Google geocoder isn't used, but a geocoder that's been set (eg a TableGeocoder)
+    still is.
+    :param addresses: a list (or Series) of addresses
+    :return: a DataFrame of the latitude and longitude (in degrees, NaN if the address couldn't be found) of each
+    address, indexed like addresses
+    """
+    global _google_geocoder
+    caching = conf.caching
+    addresses = pd.Series(addresses, dtype=object)
+    distinct = addresses.fillna('').unique()
+    keys = addresses.fillna('').map(dict(zip(distinct, map(normalize_address, distinct))))
+    cached = caching.cache['geocode']
+    missing = pd.Index(keys.unique()).difference(cached.index)
+    missing = missing[missing != '']
+    if len(missing):
+        lookup = geocoder
+        if lookup is None and caching.cache_only_mode:
+            conf.logger.warning(f"Can't geocode {len(missing)} addresses with the Google Maps API in cache only mode")
+        else:
+            if lookup is None:
+                if _google_geocoder is None:
+                    _google_geocoder = GoogleGeocoder()
+                lookup = _google_geocoder
+            source = getattr(lookup, 'name', type(lookup).__name__)
+            with conf.metrics.timer('geocode', source=source):
+                for key in missing:
+                    point = lookup(key)
+                    latitude, longitude = point if point is not None else (np.nan, np.nan)
+                    caching.stage('geocode', key, {'latitude': latitude, 'longitude': longitude, 'source': source})
+            caching.commit('geocode')
+            caching.persist_cache()
+            cached = caching.cache['geocode']
+            conf.logger.debug(f"Geocoded {len(missing)} addresses")
+    points = cached[['latitude', 'longitude']].reindex(keys.to_numpy())
+    points.index = addresses.index
+    return points.astype(float)
+
+
+def geocode_one(address):
+    """
+    :return: a tuple of the (latitude, longitude) of an address, in degrees, or None if it couldn't be found
+    """
+    point = geocode([address]).iloc[0]
+    return None if point.isna().any() else (point['latitude'], point['longitude'])
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """
+    :return: the great circle distance in miles between points, all in radians (arrays are broadcast)
+    """
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * earth_radius * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+class SpatialIndex:
+    """
+    A grid index of points on the globe, for radius and k nearest queries that only measure the distance to the points
+    in the cells near the query, rather than to every point
+    """
+    def __init__(self, latitudes, longitudes, ids, cell_degrees=1.0):
+        """
+        :param latitudes: the latitudes of the points, in degrees (points without coordinates are left out)
+        :param longitudes: the longitudes of the points, in degrees
+        :param ids: the ID of each point, eg History IDs
+        :param cell_degrees: the size of the grid cells
+        """
+        latitudes = np.asarray(latitudes, dtype=float)
+        longitudes = np.asarray(longitudes, dtype=float)
+        known = ~(np.isnan(latitudes) | np.isnan(longitudes))
+        self.ids = pd.Index(ids)[known]
+        self.lat = np.radians(latitudes[known])
+        self.lon = np.radians(longitudes[known])
+        self.cell_size = np.radians(cell_degrees)
+        self.num_cols = int(np.ceil(2 * np.pi / self.cell_size))
+        self.num_rows = int(np.ceil(np.pi / self.cell_size))
+        # the points sorted by cell, the points in cell c are order[bounds[c]:bounds[c + 1]]
+        cells = self.cell(self.row(self.lat), self.col(self.lon))
+        self.order = np.argsort(cells, kind='stable')
+        self.bounds = np.searchsorted(cells[self.order], np.arange(self.num_rows * self.num_cols + 1))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def row(self, lat):
+        return np.clip(((lat + np.pi / 2) // self.cell_size).astype(int), 0, self.num_rows - 1)
+
+    def col(self, lon):
+        return ((lon + np.pi) // self.cell_size).astype(int) % self.num_cols
+
+    def cell(self, row, col):
+        return row * self.num_cols + col
+
+    def candidates(self, lat, lon, radius):
+        """
+        :return: the positions of the points in the cells that could be within radius miles of (lat, lon) in radians
+        """
+        angle = radius / earth_radius
+        rows = range(int(self.row(np.array(lat - angle))), int(self.row(np.array(lat + angle))) + 1)
+        if lat + angle >= np.pi / 2 or lat - angle <= -np.pi / 2 or angle >= np.pi / 2:
+            cols = [(0, self.num_cols - 1)]  # the circle covers a pole, so all the longitudes
+        else:
+            # the widest the circle gets in longitude
+            half_width = np.arcsin(min(1.0, np.sin(angle) / np.cos(lat)))
+            first, last = int(self.col(np.array(lon - half_width))), int(self.col(np.array(lon + half_width)))
+            if 2 * half_width + self.cell_size >= 2 * np.pi:
+                cols = [(0, self.num_cols - 1)]
+            elif first <= last:
+                cols = [(first, last)]
+            else:
+                cols = [(first, self.num_cols - 1), (0, last)]  # it wraps around the antimeridian
+        ranges = [self.order[self.bounds[self.cell(row, first)]:self.bounds[self.cell(row, last) + 1]]
+                  for row in rows for first, last in cols]
+        return np.concatenate(ranges) if ranges else np.zeros(0, dtype=int)
+
+    def within(self, latitude, longitude, radius):
+        """
+        :param latitude: the latitude of the place, in degrees
+        :param longitude: the longitude of the place, in degrees
+        :param radius: the radius in miles
+        :return: a Series of the distance (in miles) of the points within the radius, indexed by ID, nearest first
+        """
+        lat, lon = np.radians(latitude), np.radians(longitude)
+        positions = self.candidates(lat, lon, radius)
+        distances = haversine(lat, lon, self.lat[positions], self.lon[positions])
+        inside = distances <= radius
+        result = pd.Series(distances[inside], index=self.ids[positions[inside]], name='distance')
+        return result.sort_values(kind='mergesort')
+
+    def nearest(self, latitude, longitude, k=10):
+        """
+        :param latitude: the latitude of the place, in degrees
+        :param longitude: the longitude of the place, in degrees
+        :param k: the number of points to find
+        :return: a Series of the distance (in miles) of the k nearest points, indexed by ID, nearest first
+        """
+        # search ever bigger circles until there are k points in one, the k nearest are all inside it
+        radius = 2 * np.degrees(self.cell_size) * 69.0
+        while True:
+            found = self.within(latitude, longitude, radius)
+            if len(found) >= min(k, len(self)) or radius >= np.pi * earth_radius:
+                return found.iloc[:k]
+            radius *= 2
+
+
+# the spatial indexes of the officials and leagues: name -> (versions, SpatialIndex)
+_indexes = dict()
+
+
+def officials_index():
+    """
+    :return: the SpatialIndex of the officials' locations (from their profiles), rebuilt when the officials or geocode
+    partitions change
+    """
+    versions = (conf.caching.version('officials'), conf.caching.version('geocode'))
+    if 'officials' not in _indexes or _indexes['officials'][0] != versions:
+        officials = conf.caching.cache['officials']
+        points = geocode(officials['Location_raw'].astype(object))
+        versions = (conf.caching.version('officials'), conf.caching.version('geocode'))
+        _indexes['officials'] = (versions, SpatialIndex(points['latitude'], points['longitude'], officials.index))
+    return _indexes['officials'][1]
+
+
+def leagues_index(locations=None):
+    """
+    :param locations: the league locations, as returned by util.load_locations(), by default conf.runtime.locations
+    :return: the SpatialIndex of the leagues, by league name
+    """
+    locations = locations if locations is not None else conf.runtime.locations or dict()
+    key = (id(locations), len(locations))
+    if 'leagues' not in _indexes or _indexes['leagues'][0] != key:
+        from . import util
+
+        rows = util.locations_frame(locations)
+        _indexes['leagues'] = (key, SpatialIndex(rows['Latitude'], rows['Longitude'], rows.index))
+    return _indexes['leagues'][1]
+
+
+def officials_near(place, radius):
+    """
+    Finds the officials within a radius of a place, eg to staff an event
+    :param place: an address, or a tuple of (latitude, longitude) in degrees
+    :param radius: the radius in miles
+    :return: a Series of the distance (in miles) of each official in the radius, indexed by History ID, nearest first
+    """
+    if isinstance(place, str):
+        place = geocode_one(place)
+        if place is None:
+            return pd.Series([], dtype=float, name='distance')
+    return officials_index().within(place[0], place[1], radius)
+
+
+def leagues_near(place, radius, locations=None):
+    """
+    Finds the leagues within a radius of a place
+    :param place: an address, or a tuple of (latitude, longitude) in degrees
+    :param radius: the radius in miles
+    :param locations: the league locations, by default conf.runtime.locations
+    :return: a Series of the distance (in miles) of each league in the radius, indexed by league name, nearest first
+    """
+    if isinstance(place, str):
+        place = geocode_one(place)
+        if place is None:
+            return pd.Series([], dtype=float, name='distance')
+    return leagues_index(locations).within(place[0], place[1], radius)
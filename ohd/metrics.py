@@ -0,0 +1,205 @@
+"""
+METRICS:
+Timing metrics for each stage of loading the OHD data, kept as bounded histograms so they use the same memory however
+long the run is. Each metric is labelled (eg source=sheet/cache/error, environment) and can be exported at the end of
+a run as JSON or in the Prometheus text format.
+
+Usage:
+with conf.metrics.timer('tab_read', source='sheet'):
+    values = util.batch_get_values(client, doc_id, ranges)
+conf.metrics.export(conf.runtime.data_dir / 'metrics.prom')
+"""
+__author__ = 'hammer'
+
+import json
+import math
+import bisect
+import time
+import threading
+from pathlib import Path
+
+
+# The upper bounds of the histogram buckets, in seconds: log spaced from 0.5ms, each 1.5 times bigger than the last,
+# up to about 2 hours. Anything longer goes in a last (+Inf) bucket.
+bucket_bounds = [0.0005 * 1.5 ** i for i in range(40)]
+
+
+class Histogram:
+    """
+    A histogram of durations (in seconds), with log spaced buckets
+    """
+    bounds = bucket_bounds
+    num_buckets = len(bucket_bounds)
+
+    def __init__(self):
+        self.counts = [0] * (self.num_buckets + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    def observe(self, seconds):
+        """
+        Adds a duration to the histogram
+        """
+        bucket = bisect.bisect_left(self.bounds, seconds)
+        self.counts[bucket] += 1
+        self.count += 1
+        self.sum += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q):
+        """
+        Estimates a quantile, by interpolating within the bucket it falls in
+        :param q: the quantile, eg 0.95
+        :return: the estimated duration in seconds, or None if there are no observations
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for bucket, bucket_count in enumerate(self.counts):
+            if bucket_count and cumulative + bucket_count >= rank:
+                lower = self.bounds[bucket - 1] if bucket > 0 else 0.0
+                upper = self.bounds[bucket] if bucket < self.num_buckets else self.max
+                estimate = lower + (upper - lower) * (rank - cumulative) / bucket_count
+                return min(max(estimate, self.min), self.max)
+            cumulative += bucket_count
+        return self.max
+
+    def summary(self):
+        """
+        :return: a dict of the count, sum, mean, p50, p95, p99 and max
+        """
+        return {'count': self.count,
+                'sum': self.sum,
+                'mean': self.sum / self.count if self.count else None,
+                'p50': self.quantile(0.5),
+                'p95': self.quantile(0.95),
+                'p99': self.quantile(0.99),
+                'max': self.max if self.count else None}
+
+
+class Timer:
+    """
+    Times a block of code and records it in a metric when the block ends. The labels can be changed inside the block
+    (eg once the source is known), and the source is set to 'error' if the block raises an exception.
+    """
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            self.labels['source'] = 'error'
+        self.metrics.observe(self.name, time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+class Metrics:
+    """
+    The registry of all the timing metrics, safe to use from multiple threads
+    """
+    prefix = 'ohd'
+
+    def __init__(self):
+        self.histograms = dict()
+        self.default_labels = dict()  # labels added to every metric, eg the environment
+        self.lock = threading.Lock()
+
+    def observe(self, name, seconds, **labels):
+        """
+        Records a duration
+        :param name: the name of the stage, eg 'tab_read'
+        :param seconds: the duration in seconds (or a timedelta)
+        :param labels: the labels of the metric, eg source='sheet'
+        """
+        if hasattr(seconds, 'total_seconds'):
+            seconds = seconds.total_seconds()
+        labels = {**self.default_labels, **labels}
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(seconds)
+
+    def timer(self, name, **labels):
+        """
+        :return: a context manager that records the time taken by its block
+        """
+        return Timer(self, name, labels)
+
+    def reset(self):
+        with self.lock:
+            self.histograms = dict()
+
+    def get(self, name, **labels):
+        """
+        :return: the histogram of a metric with exactly these labels (plus the default ones), or None
+        """
+        labels = {**self.default_labels, **labels}
+        return self.histograms.get((name, tuple(sorted(labels.items()))))
+
+    def summary(self, name=None):
+        """
+        :param name: only include this metric
+        :return: a list of dicts, one per metric and set of labels, with the histogram summary stats
+        """
+        with self.lock:
+            items = sorted(self.histograms.items())
+        return [{'name': metric, 'labels': dict(labels), **histogram.summary()}
+                for (metric, labels), histogram in items if name is None or metric == name]
+
+    def to_json(self):
+        return json.dumps(self.summary(), indent=2)
+
+    def to_prometheus(self):
+        """
+        :return: the metrics in the Prometheus text exposition format, as histograms
+        """
+        with self.lock:
+            items = sorted(self.histograms.items())
+        lines = list()
+        typed = set()
+        for (metric, labels), histogram in items:
+            full_name = f"{self.prefix}_{metric}_seconds"
+            if full_name not in typed:
+                lines.append(f"# TYPE {full_name} histogram")
+                typed.add(full_name)
+            label_text = ','.join(f'{k}="{v}"' for k, v in labels)
+            sep = ',' if label_text else ''
+            cumulative = 0
+            for bound, bucket_count in zip(histogram.bounds + [math.inf], histogram.counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == math.inf else f"{bound:.6g}"
+                lines.append(f'{full_name}_bucket{{{label_text}{sep}le="{le}"}} {cumulative}')
+            lines.append(f"{full_name}_sum{{{label_text}}} {histogram.sum:.6f}")
+            lines.append(f"{full_name}_count{{{label_text}}} {histogram.count}")
+        return '\n'.join(lines) + '\n'
+
+    def export(self, file):
+        """
+        Writes the metrics to a file, in the Prometheus text format if the file ends in .prom, otherwise as JSON
+        :param file: the path of the file to write
+        """
+        file = Path(file)
+        text = self.to_prometheus() if file.suffix == '.prom' else self.to_json()
+        file.write_text(text)
+
+    def log_summary(self, logger):
+        """
+        Logs a line for each metric, with its count and percentiles
+        """
+        for row in self.summary():
+            if not row['count']:
+                continue
+            labels = ', '.join(f"{k}={v}" for k, v in row['labels'].items())
+            logger.info(f"{row['name']} ({labels}): {row['count']} in {row['sum']:.2f}s, p50 {row['p50']:.3f}s, "
+                        f"p95 {row['p95']:.3f}s, p99 {row['p99']:.3f}s, max {row['max']:.3f}s")
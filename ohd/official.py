@@ -4,17 +4,49 @@ Module for reading, storing and processing officials data.
 __author__ = 'hammer'
 
 from .config import conf
+from .quota import CircuitOpenError
 from . import util
 
+import queue
 import datetime
+import threading
 import pandas as pd
-import pygsheets.exceptions as pygerror
-from googleapiclient.errors import HttpError
+from concurrent.futures import ThreadPoolExecutor, wait
 
 
 # TODO: ws.copy_to() looks like it can copy a ws from one wb to a different one - test it out for better remote updating of the OHDs from the template
 
 
+# The cells of the OHD Profile tab that hold the official's info, and the info they hold
+profile_name_range = 'Profile!B2:B11'
+profile_name_fields = ['Name_Preferred_raw', 'Pronoun_raw', 'Name_Derby', 'Name_Legal', 'Location_raw',
+                       'Affiliated_League_raw', 'Cert_Ref_raw', 'Endorsements_Ref_raw', 'Cert_NSO_raw',
+                       'Endorsements_NSO_raw']
+profile_contact_range = 'Profile!D4:D8'
+profile_contact_fields = ['Officiating_Number', 'Email_Address', 'Phone_Number', 'Insurance_Derby',
+                          'Association_Affiliations_raw']
+# Reading any cell of the 'Learn More' tab fails if the tab is missing, which means it's not a current v3 OHD
+learn_more_range = "'Learn More'!A1"
+game_history_range = "'Game History'!A:N"
+
+
+def parse_profile_values(doc_id, names, contacts):
+    """
+    Creates a dict of the Official's Profile info, from the cell values of the Profile tab
+    :param doc_id: the Google Sheets ID
+    :param names: the list of values in the profile_name_range cells
+    :param contacts: the list of values in the profile_contact_range cells
+    :return: a dict of all the officials info
+    """
+    offinfo = dict()
+    offinfo['ID'] = doc_id
+    offinfo.update(zip(profile_name_fields, names))
+    offinfo.update(zip(profile_contact_fields, contacts))
+    conf.logger.debug(f"Successfully loaded {offinfo['Name_Preferred_raw']}'s info")
+
+    return offinfo
+
+
 def parse_officials_info(off_wb):
     """
     This takes a OHD and creates a dict of the Official's Profile info for adding into a DataFrame row of all the
@@ -24,75 +56,72 @@ def parse_officials_info(off_wb):
     """
     # ws = off_wb.worksheet_by_title('Profile')
     df = util.read_tab_as_df(off_wb, 'Profile')
-    offinfo = dict()
-    offinfo['ID'] = off_wb.id
-    offinfo['Name_Preferred_raw'] = df.iloc[0, 1]
-    offinfo['Pronoun_raw'] = df.iloc[1, 1]
-    offinfo['Name_Derby'] = df.iloc[2, 1]
-    offinfo['Name_Legal'] = df.iloc[3, 1]
-    offinfo['Location_raw'] = df.iloc[4, 1]
-    offinfo['Affiliated_League_raw'] = df.iloc[5, 1]
-    offinfo['Cert_Ref_raw'] = df.iloc[6, 1]
-    offinfo['Endorsements_Ref_raw'] = df.iloc[7, 1]
-    offinfo['Cert_NSO_raw'] = df.iloc[8, 1]
-    offinfo['Endorsements_NSO_raw'] = df.iloc[9, 1]
-    offinfo['Officiating_Number'] = df.iloc[2, 3]
-    offinfo['Email_Address'] = df.iloc[3, 3]
-    offinfo['Phone_Number'] = df.iloc[4, 3]
-    offinfo['Insurance_Derby'] = df.iloc[5, 3]
-    offinfo['Association_Affiliations_raw'] = df.iloc[6, 3]
-    conf.logger.debug(f"Successfully loaded {offinfo['Name_Preferred_raw']}'s info")
-
-    return offinfo
+    names = list(df.iloc[0:len(profile_name_fields), 1])
+    contacts = list(df.iloc[2:2 + len(profile_contact_fields), 3])
+    return parse_profile_values(off_wb.id, names, contacts)
 
 
-def load_history_doc(doc_id: str):
+def parse_history_values(doc_id, values):
     """
-    Load a single history doc from the Google Doc ID, and returns a tuple of DataFrames (official's information, game data)
+    Takes the values of the ranges read by fetch_history_doc() and parses them into the official's info and games
     :param doc_id: the Google Sheets ID
-    :return: a tuple of DataFrames (official's information, game data, source (sheet/cache))
+    :param values: the list of rows of each range, in the order of the ranges requested
+    :return: a tuple of (official's information, game data DataFrame)
     """
-    start = datetime.datetime.now()
-    conf.logger.debug(f"Starting to load the history data")
-    source = 'sheet'
+    _, names, contacts, history = values
+    official = parse_profile_values(doc_id,
+                                    util.column_values(names, len(profile_name_fields)),
+                                    util.column_values(contacts, len(profile_contact_fields)))
+    off_gh = util.values_as_df(history, num_columns=len(conf.caching.history_tab_list),
+                               schema=conf.caching.cache_defs['game_data'])
+    return official, off_gh
 
-    cached_official = conf.caching.fetch('officials', doc_id)
-    cached_games = conf.caching.fetch('game_data', doc_id)
 
-    if cached_official is not None and cached_games is not None:
-        # found valid cache entries
-        source = 'cache'
-        official = cached_official
-        games = cached_games
-        time_to_load = datetime.datetime.now() - start
-        conf.google.runtime_cache.append(time_to_load)
-    else:
-        official = pd.DataFrame(columns=conf.caching.history_officials_data_list)
-        games = pd.DataFrame(columns=conf.caching.history_tab_list)
+def fetch_history_doc(doc_id: str, client=None):
+    """
+    Fetch and parse a single history doc from Google, without touching the cache. This is safe to call from worker
+    threads, all the cache updates are done by store_history_doc(), and each thread uses its own copy of the client
+    (see util.thread_client())
+    :param doc_id: the Google Sheets ID
+    :param client: the authorized Google Sheets client to use, by default the shared client in the config
+    :return: a tuple of (official's information, game data DataFrame, source (sheet/error)), the source is error if there
+    are no Google credentials to fetch it with
+    """
+    # the Google client stack is slow to import, so only load it when it's needed
+    import pygsheets.exceptions as pygerror
+    from googleapiclient.errors import HttpError
+
+    official = pd.DataFrame(columns=conf.caching.history_officials_data_list)
+    games = pd.DataFrame(columns=conf.caching.history_tab_list)
 
+    if client is None:
         client = conf.google.client
-        if not client:
-            client = util.authenticate_with_google()
+    if not client:
+        client = util.authenticate_with_google()
+    if not client:
+        conf.logger.warning(f"Can't fetch the history doc {doc_id}, no Google credentials were available")
+        return official, games, 'error'
+    client = util.thread_client(client)
 
-        last_checkpoint = datetime.datetime.now()
-        conf.logger.debug(f"Attempting to load sheet of Official ID {doc_id}")
+    conf.logger.debug(f"Attempting to load sheet of Official ID {doc_id}")
+    with conf.metrics.timer('history_doc', source='sheet') as timer:
         try:
-            off_wb = client.open_by_key(doc_id)
-            if all(ws.title != 'Learn More' for ws in off_wb.worksheets()):
-                conf.logger.warning(f"Document found that is not a current v3 OHD = {doc_id}")
-                conf.logger.info(f"Finished {__name__} in {(datetime.datetime.now() - start).total_seconds():.2f}s")
-                return official, games, 'error'
-
-            # load the official's info into the cache
-            official = parse_officials_info(off_wb)
-
-            off_gh = util.read_tab_as_df(off_wb, 'Game History', num_columns=len(conf.caching.history_tab_list))
+            # fetch the Profile cells and the Game History in a single request
+            ranges = [learn_more_range, profile_name_range, profile_contact_range, game_history_range]
+            try:
+                values = util.batch_get_values(client, doc_id, ranges)
+            except HttpError as e:
+                if e.resp['status'] in ['400'] and 'Unable to parse range' in str(e):
+                    conf.logger.warning(f"Document found that is not a current v3 OHD = {doc_id}")
+                    timer.labels['source'] = 'error'
+                    return official, games, 'error'
+                raise
 
-            # change the datatype of Date to be a date, and make the Date the index
-            if 'Date' not in off_gh.columns:
-                raise Exception(f"Couldn't load the Games History tab for {doc_id}.")
-            off_gh['Date'] = pd.to_datetime(off_gh['Date'])
-            # off_gh = off_gh.set_index('Date')
+            # load the official's info into the cache, the Date is parsed as a date by the game_data schema
+            with conf.metrics.timer('parse', source='sheet'):
+                official, off_gh = parse_history_values(doc_id, values)
+                if 'Date' not in off_gh.columns:
+                    raise Exception(f"Couldn't load the Games History tab for {doc_id}.")
 
             if not off_gh.empty:
                 conf.logger.debug(f"ID = {doc_id}, shape = {off_gh.shape}")
@@ -100,36 +129,257 @@ def load_history_doc(doc_id: str):
             else:
                 conf.logger.warning(f"Can't add empty game history for {doc_id}.")
 
-            time_to_load = datetime.datetime.now() - last_checkpoint
-            conf.google.runtime_api.append(time_to_load)
-            last_checkpoint = datetime.datetime.now()
             # TODO: fix up the exceptions
         except pygerror.WorksheetNotFound:
             conf.logger.error(f"Worksheet was not found in {doc_id}")
+            timer.labels['source'] = 'error'
         except ValueError as e:
             conf.logger.error(f"Mismatched value errors on {doc_id}, skipping it, error message = {e}")
+            timer.labels['source'] = 'error'
             # TODO: figure out this error and fix it
         except HttpError as e:
+            timer.labels['source'] = 'error'
             if e.resp['status'] in ['404']:
                 conf.logger.warning(f"Could not load document {doc_id} because of known HTTP error {e}")
+            elif conf.quota.http_status(e) in conf.quota.retry_statuses:
+                # still rate limited or failing after the retries, so don't cache it, it can be loaded next time
+                conf.logger.warning(f"Could not load document {doc_id}, even after retrying, because of {e}")
+                return official, games, 'error'
             else:
                 conf.logger.warning(f"Could not load document {doc_id} because of unknown HTTP error {e}")
+        except CircuitOpenError as e:
+            conf.logger.warning(f"Skipped loading document {doc_id} because of {e}")
+            timer.labels['source'] = 'error'
+            return official, games, 'error'
         except OSError as e:
             conf.logger.warning(f"Error connecting to {doc_id} because of {e}\nCould be no internet or expired connection?")
+            timer.labels['source'] = 'error'
             return official, games, 'error'
         except Exception as e:
             conf.logger.warning(f"Could not load document {doc_id} because of {e}")
+            timer.labels['source'] = 'error'
+
+    return official, games, 'sheet'
+
+
+def store_history_doc(doc_id: str, official, games, loaded_at, modified_time=None):
+    """
+    Stage a freshly fetched history doc to be added to the in-memory cache by the next conf.caching.commit().
+    This should only be called from one thread at a time.
+    :param doc_id: the Google Sheets ID
+    :param official: the official's information, as returned by fetch_history_doc()
+    :param games: the game data DataFrame, as returned by fetch_history_doc()
+    :param loaded_at: the datetime the doc was loaded, recorded as the cache item's last update
+    :param modified_time: the doc's Drive modified time from before it was loaded, if known
+    :return: the game data, indexed by (off_id, Date) if there are any games
+    """
+    if not isinstance(official, dict):
+        # the Profile couldn't be parsed, so only the ID is known
+        official = {'ID': doc_id}
+    conf.caching.stage('metadata', doc_id, {'last_update': loaded_at, 'modified_time': modified_time})
+    conf.caching.stage('officials', doc_id, official)
+    if not games.empty:
+        games['off_id'] = doc_id
+        games = games.set_index(['off_id', 'Date'])
+        conf.logger.debug(f"Added {len(games)} games to {official['Name_Preferred_raw']}")
+    conf.caching.stage('game_data', doc_id, games)
+    return games
+
+
+def fetch_cached_history_doc(doc_id: str):
+    """
+    Look up a history doc in the cache. In stale-while-revalidate mode (conf.caching.stale_while_revalidate), a stale
+    entry is returned as well, and the doc is refreshed in the background by the revalidator.
+    :param doc_id: the Google Sheets ID
+    :return: a tuple of (official's information, game data, True if it's stale) if there is a usable cache entry,
+    otherwise None
+    """
+    with conf.metrics.timer('cache_fetch', source='cache') as timer:
+        revalidator.apply()
+        cached_official, stale = conf.caching.fetch('officials', doc_id, allow_stale=True)
+        if stale and not (conf.caching.stale_while_revalidate and revalidator.submit(doc_id)):
+            # a stale entry is only used if it's going to be refreshed
+            cached_official = None
+        if cached_official is None:
+            timer.labels['result'] = 'miss'
+            return None
+        # the games are cached along with the official, so an official without any games is still a cache hit
+        cached_games = conf.caching.fetch('game_data', doc_id)
+        if cached_games is None:
+            cached_games = pd.DataFrame(columns=conf.caching.history_tab_list).set_index('Date')
+        timer.labels['result'] = 'stale' if stale else 'hit'
+        return cached_official, cached_games, stale
+
+
+class Revalidator:
+    """
+    Refreshes stale history docs in the background, for the stale-while-revalidate mode. The docs are checked and
+    fetched on worker threads, and the results are added to the cache by apply(), which is called by the thread that
+    uses the cache (the cache is only ever updated from one thread).
+    """
+    def __init__(self, max_workers=2):
+        """
+        :param max_workers: the max number of docs to refresh at the same time
+        """
+        self.max_workers = max_workers
+        self.pool = None
+        self.futures = dict()
+        self.done = queue.Queue()
+        self.lock = threading.Lock()
+
+    def submit(self, doc_id):
+        """
+        Queues a doc to be refreshed, unless it's already queued
+        :param doc_id: the Google Sheets ID
+        :return: True if the doc is (or already was) queued, False if it can't be refreshed (no Google credentials)
+        """
+        if not conf.google.client and conf.google.cred_file is None:
+            return False
+        with self.lock:
+            if doc_id in self.futures:
+                return True
+            if self.pool is None:
+                self.pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='revalidate')
+            metadata = conf.caching.lookup('metadata', doc_id)
+            cached_time = metadata['modified_time'] if metadata is not None else None
+            self.futures[doc_id] = self.pool.submit(self.refresh, doc_id, cached_time)
+        conf.logger.debug(f"Queued {doc_id} to be refreshed in the background")
+        return True
+
+    def refresh(self, doc_id, cached_time):
+        """
+        Runs on a worker thread: checks if the doc has been modified since it was cached, and if so, fetches it
+        """
+        loaded_at = datetime.datetime.now()
+        try:
+            client = util.thread_client(conf.google.get_client())
+            modified_time = util.get_modified_times(client, [doc_id]).get(doc_id)
+            if modified_time is not None and pd.notna(cached_time) and modified_time <= cached_time:
+                self.done.put((doc_id, None, loaded_at, modified_time))
+                return
+            official, games, source = fetch_history_doc(doc_id, client)
+            self.done.put((doc_id, (official, games, source), loaded_at, modified_time))
+        except Exception as e:
+            conf.logger.warning(f"Couldn't refresh {doc_id} in the background because of {e}")
+            self.done.put((doc_id, (None, None, 'error'), loaded_at, None))
+
+    def apply(self):
+        """
+        Adds the docs that have been refreshed since the last call to the cache, and persists them.
+        :return: the number of docs refreshed
+        """
+        refreshed = 0
+        while True:
+            try:
+                doc_id, fetched, loaded_at, modified_time = self.done.get_nowait()
+            except queue.Empty:
+                break
+            with self.lock:
+                self.futures.pop(doc_id, None)
+            if fetched is None:
+                # it hasn't changed, so the cached doc is current again
+                conf.caching.touch(doc_id, loaded_at)
+            elif fetched[2] != 'error':
+                official, games, _ = fetched
+                store_history_doc(doc_id, official, games, loaded_at, modified_time)
+            else:
+                continue
+            refreshed += 1
+        if refreshed:
+            conf.caching.commit()
+            conf.caching.persist_cache()
+            conf.logger.debug(f"Refreshed {refreshed} stale docs in the background")
+        return refreshed
+
+    def wait(self, timeout=None):
+        """
+        Waits for the queued docs to be refreshed, and adds them to the cache
+        :param timeout: the max number of seconds to wait
+        :return: the number of docs refreshed
+        """
+        with self.lock:
+            futures = list(self.futures.values())
+        wait(futures, timeout=timeout)
+        return self.apply()
+
+
+# the background refreshes of stale docs, see Revalidator
+revalidator = Revalidator()
+
+
+def revalidate_history_docs(doc_ids, client):
+    """
+    Checks the Drive modified time of docs that are due to be refetched. Docs that are in the cache and haven't been
+    modified since they were cached are marked as current again, so they don't need to be fetched.
+    :param doc_ids: a list of Google Sheets IDs
+    :param client: the authorized Google Sheets client to use
+    :return: a tuple of (list of the unchanged doc IDs, dict of doc ID: modified time for all the docs found)
+    """
+    unchanged = list()
+    try:
+        modified = util.get_modified_times(client, doc_ids)
+    except Exception as e:
+        conf.logger.warning(f"Could not check the modified times of {len(doc_ids)} docs because of {e}")
+        return unchanged, dict()
+
+    if conf.runtime.force_refresh:
+        # everything gets refetched, the modified times are only needed for the cache
+        return unchanged, modified
+
+    for doc_id, modified_time in modified.items():
+        metadata = conf.caching.lookup('metadata', doc_id)
+        if metadata is None or conf.caching.lookup('officials', doc_id) is None:
+            continue
+        cached_time = metadata['modified_time']
+        if pd.notna(cached_time) and modified_time <= cached_time:
+            unchanged.append(doc_id)
+    if unchanged:
+        conf.caching.touch(unchanged)
+    conf.logger.debug(f"{len(unchanged)} of {len(doc_ids)} docs haven't changed since they were cached")
+
+    return unchanged, modified
+
+
+def load_history_doc(doc_id: str):
+    """
+    Load a single history doc from the Google Doc ID, and returns a tuple of DataFrames (official's information, game data)
+    A fetched doc is staged for the cache, and committed and persisted with the rest at the next checkpoint, or at the end
+    of the conf.caching.batch() it's loaded in, see Conf.Cache.checkpoint()
+    :param doc_id: the Google Sheets ID
+    :return: a tuple of DataFrames (official's information, game data, source (sheet/cache/stale/error))
+    """
+    start = datetime.datetime.now()
+    conf.logger.debug(f"Starting to load the history data")
+
+    cached = fetch_cached_history_doc(doc_id)
+    if cached is not None:
+        # found valid cache entries
+        official, games, stale = cached
+        source = 'stale' if stale else 'cache'
+    else:
+        client = conf.google.client
+        if not client:
+            client = util.authenticate_with_google()
+        if not client:
+            # nothing is staged for the cache, so the doc can be loaded once there are credentials
+            conf.logger.warning(f"Need to fetch the history doc {doc_id} but no Google credentials were available")
+            conf.logger.info(f"Finished {__name__} in {(datetime.datetime.now() - start).total_seconds():.2f}s")
+            return (pd.DataFrame(columns=conf.caching.history_officials_data_list),
+                    pd.DataFrame(columns=conf.caching.history_tab_list), 'error')
+        unchanged, modified = revalidate_history_docs([doc_id], client)
+        if unchanged:
+            official, games, _ = fetch_cached_history_doc(doc_id)
+            conf.caching.checkpoint()
+            conf.logger.info(f"Finished {__name__} in {(datetime.datetime.now() - start).total_seconds():.2f}s")
+            return official, games, 'cache'
+
+        official, games, source = fetch_history_doc(doc_id, client)
+        if source == 'error':
+            conf.logger.info(f"Finished {__name__} in {(datetime.datetime.now() - start).total_seconds():.2f}s")
+            return official, games, source
 
-        conf.caching.cache['metadata'].loc[doc_id] = start
-        conf.caching.cache['officials'].loc[doc_id] = official
-        if not games.empty:
-            games['off_id'] = doc_id
-            games = games.set_index(['off_id', 'Date'])
-            conf.caching.cache['game_data'] = conf.caching.cache['game_data'].append(games)
-            conf.logger.debug(f"Added {len(games)} games to {official['Name_Preferred_raw']}")
-        # TODO: is this too often to persist the cache? yes. over 250 persists, it slows from .1s to 1.5s
-        conf.caching.persist_cache()
-        conf.logger.info(f"Persisted {len(conf.caching.cache['officials'])} officials in cache, in {(datetime.datetime.now() - last_checkpoint).total_seconds():.2f}s")
+        games = store_history_doc(doc_id, official, games, start, modified.get(doc_id))
+        conf.caching.checkpoint()
 
     conf.logger.info(f"Finished {__name__} in {(datetime.datetime.now() - start).total_seconds():.2f}s")
     return official, games, source
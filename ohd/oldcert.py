@@ -0,0 +1,152 @@
+"""
+This module contains the loading of the OldCert officials (the officials certified under the old WFTDA certification
+program), and their export as GeoJSON, for pro-tem analysis of where the officials are located globally.
+There's no demographic information for them, except for their name, league, and OldCert level(s).
+
+All the OldCert tabs are read with one batched API request into a single DataFrame, and the officials (a name at a
+league) are combined with a groupby, so the runtime scales linearly with the number of rows. The GeoJSON is written a
+feature at a time, so it doesn't need to hold all the features in memory.
+
+Usage:
+certs, skipped = ohd.oldcert.load_old_cert(locations)
+ohd.oldcert.write_geojson(certs, 'oldcert.geojson')
+ohd.oldcert.league_population(certs, locations).to_csv('leaguepop.csv', index=False)
+"""
+__author__ = 'hammer'
+
+from .config import conf
+from . import util
+
+import json
+import numpy as np
+import pandas as pd
+
+old_cert_doc_id = '1Nv0UMugPqGEaDAwdz8dQtCIgzlR8gfM3i6Tp7ZSXzjo'
+# the OldCert tabs, and whether they list refs or NSOs
+old_cert_tabs = {'OldCert Ref 1': 'ref', 'OldCert Ref 2': 'ref', 'OldCert Ref 3': 'ref', 'OldCert Ref 4': 'ref',
+                 'OldCert NSO 1': 'nso', 'OldCert NSO 2': 'nso', 'OldCert NSO 3': 'nso', 'OldCert NSO 4': 'nso'}
+old_cert_cols = ['Name', 'League', 'Cert']  # the columns of each tab, after a header row
+
+
+def read_old_cert(doc_id=old_cert_doc_id, tabs=None, client=None):
+    """
+    Reads all the OldCert tabs, with one API request
+    :param doc_id: the Google Sheet ID of the OldCert doc
+    :param tabs: a dict of tab name: 'ref' or 'nso', by default old_cert_tabs
+    :param client: the authorized pygsheets client, by default the configured one
+    :return: a DataFrame of every row of the tabs, with the old_cert_cols columns and the Type (ref/nso) of the tab
+    """
+    tabs = tabs or old_cert_tabs
+    client = client or conf.google.client or util.authenticate_with_google()
+    ranges = [f"'{tab}'!A:C" for tab in tabs]
+    frames = list()
+    for (tab, kind), values in zip(tabs.items(), util.batch_get_values(client, doc_id, ranges)):
+        # the tabs' own headers vary, so they're replaced
+        df = util.values_as_df([old_cert_cols] + values[1:], num_columns=len(old_cert_cols))
+        df['Type'] = kind
+        frames.append(df)
+    rows = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=old_cert_cols + ['Type'])
+    conf.logger.debug(f"Read {len(rows)} OldCert rows from {len(tabs)} tabs")
+    return rows
+
+
+def combine_certs(rows, locations=None):
+    """
+    Matches the leagues of the OldCert rows to the league locations, and combines the rows into one per official (a
+    name at a league), with their highest ref and NSO cert levels
+    :param rows: the OldCert rows, as returned by read_old_cert()
+    :param locations: the league locations, as returned by util.load_locations(), by default conf.runtime.locations
+    :return: a tuple of the DataFrame of officials (with the league's coordinates, in degrees and radians) and a dict of
+    the number of rows skipped by reason
+    """
+    league = rows['League'].str.strip()
+    independent = (league == '') | (league == 'Independent')
+    rows = rows[~independent].assign(League=util.match_leagues(league[~independent], locations).to_numpy())
+    unknown = rows['League'].isna()
+    rows = rows[~unknown]
+    skipped = {'Independent': int(independent.sum()), 'Unknown League': int(unknown.sum())}
+
+    level = pd.to_numeric(rows['Cert'].str.extract(r'Level\s*(\d)', expand=False), errors='coerce').fillna(0)
+    is_ref = rows['Type'] == 'ref'
+    certs = pd.DataFrame({'description': rows['Name'].str.strip(), 'league': rows['League'],
+                          'isref': is_ref, 'isnso': ~is_ref,
+                          'refcert': level.where(is_ref, 0).astype(int),
+                          'nsocert': level.where(~is_ref, 0).astype(int)})
+    # a duplicate is the same official listed again as the same type, being both a ref and an NSO isn't one
+    skipped['Duplicate'] = int(certs.duplicated(['description', 'league', 'isref']).sum())
+    certs = certs.groupby(['description', 'league'], sort=False).agg(
+        {'isref': 'any', 'isnso': 'any', 'refcert': 'max', 'nsocert': 'max'}).reset_index()
+    certs['maxcert'] = certs[['refcert', 'nsocert']].max(axis=1)
+    certs['association'] = 'WFTDA'
+
+    leagues = util.locations_frame(locations)
+    certs['latitude'] = leagues['Latitude'].reindex(certs['league']).to_numpy()
+    certs['longitude'] = leagues['Longitude'].reindex(certs['league']).to_numpy()
+    certs['lat_rad'] = np.radians(certs['latitude'])
+    certs['long_rad'] = np.radians(certs['longitude'])
+    conf.logger.debug(f"Found {certs['isref'].sum()} refs and {certs['isnso'].sum()} NSOs, skipped {skipped}")
+    return certs, skipped
+
+
+def load_old_cert(locations=None, doc_id=old_cert_doc_id, client=None):
+    """
+    Loads the OldCert officials, see read_old_cert() and combine_certs()
+    :return: a tuple of the DataFrame of officials, and a dict of the number of rows skipped by reason
+    """
+    return combine_certs(read_old_cert(doc_id, client=client), locations)
+
+
+def league_population(certs, locations=None):
+    """
+    :param certs: the OldCert officials, as returned by load_old_cert()
+    :param locations: the league locations, by default conf.runtime.locations
+    :return: a DataFrame of every league, in the order of the locations, with its country, its name, and its number of
+    officials, uncertified officials, low certified (level 1-2) officials, and high certified (level 3+) officials
+    """
+    leagues = util.locations_frame(locations)
+    level = pd.cut(certs['maxcert'], [-np.inf, 0, 2, np.inf], labels=['uncertified', 'low_cert', 'high_cert'])
+    counts = pd.crosstab(certs['league'], level).reindex(columns=level.cat.categories, fill_value=0)
+    counts.insert(0, 'officials', counts.sum(axis=1))
+    population = counts.reindex(leagues.index, fill_value=0)
+    population.insert(0, 'country', leagues['Country'])
+    population.insert(1, 'league', leagues.index)
+    return population.reset_index(drop=True)
+
+
+def features(certs, chunk_size=1000):
+    """
+    :param certs: the OldCert officials, as returned by load_old_cert()
+    :param chunk_size: the number of officials converted to Python values at a time
+    :return: a generator of the GeoJSON Feature dicts of the officials with coordinates
+    """
+    props = ['description', 'league', 'association', 'isref', 'isnso', 'refcert', 'nsocert', 'maxcert']
+    for start in range(0, len(certs), chunk_size):
+        chunk = certs.iloc[start:start + chunk_size]
+        chunk = chunk[chunk['latitude'].notna() & chunk['longitude'].notna()]
+        values = {col: chunk[col].tolist() for col in props + ['longitude', 'latitude']}
+        for number in range(len(chunk)):
+            yield {'type': 'Feature',
+                   # GeoJSON wants long/lat in that order
+                   'geometry': {'type': 'Point',
+                                'coordinates': [values['longitude'][number], values['latitude'][number]]},
+                   'properties': {prop: values[prop][number] for prop in props}}
+
+
+def write_geojson(certs, file):
+    """
+    Writes the officials with coordinates to a GeoJSON FeatureCollection file, a feature at a time
+    :param certs: the OldCert officials, as returned by load_old_cert()
+    :param file: the path of the file to write
+    :return: the number of features written
+    """
+    count = 0
+    with open(file, 'w') as out:
+        out.write('{"type": "FeatureCollection", "features": [\n')
+        for feature in features(certs):
+            if count:
+                out.write(',\n')
+            out.write(json.dumps(feature))
+            count += 1
+        out.write('\n]}\n')
+    conf.logger.debug(f"Wrote {count} features to {file}")
+    return count
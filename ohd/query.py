@@ -0,0 +1,222 @@
+"""
+This module contains the game history query engine.
+A query is made of filter dicts, the same as the old query_history() took: an inclusion filter, an exclusion filter,
+and the intervals to bucket the games into, eg
+    include = {'standard': [True], 'assn': ['WFTDA', 'MRDA']}
+    exclude = {'type': ['Other'], 'role': ['THR', 'ATHR', 'THNSO', 'ATHNSO']}
+    intervals = {'start': datetime.date.today(), 'interval': 12, 'max_interval': 5}
+A filter matches the games that match all of its keys, and a key matches any of its values. The keys are:
+- assn: the Association
+- type: the Game Type
+- role: the position worked, either the Position or the 2nd Position
+- standard: True for games of the standard game types (any Game Type but 'Other'), False for the 'Other' games
+- or the name of any game_data column
+The intervals count back from start, interval months at a time, so bucket 0 is the most recent interval, and games
+older than max_interval intervals (or after start) aren't counted.
+
+The filters are compiled into boolean masks over the whole game_data partition, so a query for every official is one
+pass over the games. The masks of the indexed columns come from secondary indexes, built the first time a column is
+queried and kept until game_data changes.
+
+Usage:
+counts = ohd.query.query_history(include, exclude, intervals)  # the number of games per official per interval
+qualified = ohd.query.qualifies([3, 3, 2], include, exclude, intervals)
+"""
+__author__ = 'hammer'
+
+from .config import conf
+
+import numpy as np
+import pandas as pd
+
+# the filter keys, and the game_data columns they match
+filter_columns = {'assn': ['Association'],
+                  'type': ['Game Type'],
+                  'role': ['Position', '2nd Position']}
+other_game_type = 'Other'  # the Game Type of the games that aren't standard, see the 'standard' filter key
+indexed_columns = ['Association', 'Game Type', 'Position']  # the columns with secondary indexes
+
+# the secondary indexes: column -> (game_data version, SecondaryIndex)
+_indexes = dict()
+
+
+class SecondaryIndex:
+    """
+    The row positions of each value of a categorical column, so the rows with a value can be found without a scan
+    """
+    def __init__(self, values):
+        """
+        :param values: a categorical Series
+        """
+        codes = values.cat.codes.to_numpy()
+        self.categories = values.cat.categories
+        self.size = len(codes)
+        self.order = np.argsort(codes, kind='stable')
+        # the rows with code c are order[bounds[c + 1]:bounds[c + 2]], code -1 being the blank values
+        self.bounds = np.searchsorted(codes[self.order], np.arange(-1, len(self.categories) + 1))
+
+    def mask(self, values):
+        """
+        :param values: a list of values
+        :return: a boolean array of the rows with any of the values
+        """
+        mask = np.zeros(self.size, dtype=bool)
+        for code in self.categories.get_indexer(pd.Index(values, dtype=object)):
+            if code >= 0:
+                mask[self.order[self.bounds[code + 1]:self.bounds[code + 2]]] = True
+        return mask
+
+
+def secondary_index(col):
+    """
+    :param col: a game_data column in indexed_columns
+    :return: the column's SecondaryIndex, built if game_data has changed since it was last used
+    """
+    version = conf.caching.version('game_data')
+    if col not in _indexes or _indexes[col][0] != version:
+        _indexes[col] = (version, SecondaryIndex(conf.caching.cache['game_data'][col]))
+    return _indexes[col][1]
+
+
+def column_mask(games, col, values, use_indexes=True):
+    """
+    :param games: the game_data partition
+    :param col: the name of a column
+    :param values: a list of values
+    :return: a boolean array of the games with any of the values in the column
+    """
+    if use_indexes and col in indexed_columns and games is conf.caching.cache['game_data']:
+        return secondary_index(col).mask(values)
+    series = games[col]
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        # look the values up by their codes, the last entry of the table is for the blank values (code -1)
+        table = np.zeros(len(series.cat.categories) + 1, dtype=bool)
+        codes = series.cat.categories.get_indexer(pd.Index(values, dtype=object))
+        table[codes[codes >= 0]] = True
+        return table[series.cat.codes.to_numpy()]
+    return series.isin(values).to_numpy()
+
+
+def compile_filter(criteria):
+    """
+    Compiles a filter dict into a list of terms, each a list of the columns to match, the values to match them with, and
+    whether the term matches the games with those values (True) or the games without them (False)
+    :param criteria: a filter dict, eg {'assn': ['WFTDA', 'MRDA']}
+    :return: a list of (columns, values, matches) tuples
+    """
+    terms = list()
+    for key, values in (criteria or {}).items():
+        if isinstance(values, str) or not hasattr(values, '__iter__'):
+            values = [values]
+        if key == 'standard':
+            flags = {bool(value) for value in values}
+            if len(flags) == 1:
+                # standard games are the ones that aren't Other (both True and False matches every game)
+                terms.append((['Game Type'], [other_game_type], not flags.pop()))
+            continue
+        columns = filter_columns.get(key, [key])
+        missing = [col for col in columns if col not in conf.caching.cache_defs['game_data']['cols']]
+        if missing:
+            raise ValueError(f"Can't filter games on {key}, there's no {missing[0]} column")
+        terms.append((columns, list(values), True))
+    return terms
+
+
+def filter_mask(games, criteria, use_indexes=True):
+    """
+    :param games: the game_data partition
+    :param criteria: a filter dict
+    :return: a boolean array of the games that match all the keys of the filter
+    """
+    mask = np.ones(len(games), dtype=bool)
+    for columns, values, matches in compile_filter(criteria):
+        term = np.zeros(len(games), dtype=bool)
+        for col in columns:
+            term |= column_mask(games, col, values, use_indexes)
+        mask &= term if matches else ~term
+    return mask
+
+
+def select_games(include=None, exclude=None, use_indexes=True):
+    """
+    :param include: a filter dict of the games to include, by default all of them
+    :param exclude: a filter dict of the games to exclude, by default none of them
+    :param use_indexes: if True, use the secondary indexes of the indexed columns
+    :return: a boolean array over game_data of the games the query selects
+    """
+    games = conf.caching.cache['game_data']
+    mask = filter_mask(games, include, use_indexes)
+    if exclude:
+        mask &= ~filter_mask(games, exclude, use_indexes)
+    return mask
+
+
+def interval_buckets(dates, start=None, interval=12, max_interval=1):
+    """
+    :param dates: a DatetimeIndex of game dates
+    :param start: the end of the most recent interval, by default today
+    :param interval: the length of each interval, in months
+    :param max_interval: the number of intervals
+    :return: an array of the interval each date falls in (0 the most recent), -1 for dates outside all the intervals
+    """
+    start = pd.Timestamp(start) if start is not None else pd.Timestamp.now().normalize()
+    # the interval boundaries, oldest first: bucket k is (edges[m - k - 1], edges[m - k]]
+    edges = pd.DatetimeIndex([start - pd.DateOffset(months=interval * k) for k in range(max_interval, -1, -1)])
+    position = np.searchsorted(edges.to_numpy(), dates.to_numpy(), side='left')
+    buckets = max_interval - position
+    buckets[(position == 0) | (position > max_interval)] = -1
+    return buckets
+
+
+def query_history(include=None, exclude=None, intervals=None, off_ids=None, use_indexes=True):
+    """
+    Runs a query over the games of every official at once
+    :param include: a filter dict of the games to include, by default all of them
+    :param exclude: a filter dict of the games to exclude, by default none of them
+    :param intervals: a dict of the start, interval (months) and max_interval of the buckets to count the games in, by
+    default all the games are counted in one bucket
+    :param off_ids: the officials to return the counts of, by default every official in the cache
+    :param use_indexes: if True, use the secondary indexes of the indexed columns
+    :return: a DataFrame of the number of games that match the query, indexed by History ID, with a column for each
+    interval (0 the most recent)
+    """
+    games = conf.caching.cache['game_data']
+    mask = select_games(include, exclude, use_indexes)
+    if intervals:
+        num_buckets = intervals.get('max_interval', 1)
+        buckets = interval_buckets(games.index.get_level_values('Date'), intervals.get('start'),
+                                   intervals.get('interval', 12), num_buckets)
+        mask &= buckets >= 0
+    else:
+        num_buckets = 1
+        buckets = np.zeros(len(games), dtype=np.int64)
+
+    # count the selected games of each official in each bucket with one bincount, over the official's position in the
+    # index level and the bucket
+    if isinstance(games.index, pd.MultiIndex):
+        officials = games.index.levels[0]
+        codes = np.asarray(games.index.codes[0], dtype=np.int64)
+    else:
+        officials, codes = pd.Index([]), np.zeros(0, dtype=np.int64)
+    counts = np.bincount(codes[mask] * num_buckets + buckets[mask], minlength=len(officials) * num_buckets)
+    counts = pd.DataFrame(counts.reshape(len(officials), num_buckets), index=officials, columns=range(num_buckets))
+
+    if off_ids is None:
+        # the index level can still have officials whose games were all removed
+        with_games = np.bincount(codes, minlength=len(officials)) > 0
+        off_ids = conf.caching.cache['officials'].index.union(officials[with_games])
+    counts = counts.reindex(off_ids, fill_value=0)
+    counts.index.name = 'off_id'
+    return counts
+
+
+def qualifies(min_games, include=None, exclude=None, intervals=None, off_ids=None, use_indexes=True):
+    """
+    Checks which officials qualify, with enough games that match a query
+    :param min_games: the minimum number of games, either in total, or a list of the minimum for each interval
+    :return: a boolean Series indexed by History ID, True for the officials that qualify
+    """
+    counts = query_history(include, exclude, intervals, off_ids, use_indexes)
+    if isinstance(min_games, (list, tuple)):
+        return (counts >= np.asarray(min_games)).all(axis=1)
+    return counts.sum(axis=1) >= min_games
@@ -0,0 +1,252 @@
+"""
+QUOTA:
+The governor that all the calls to the Google APIs go through, so a run uses as much of the API quota as it's allowed,
+without tripping over it.
+- a token bucket for each API, refilled at the quota's rate, so calls are spaced out rather than rejected. The rate
+  adapts: it's cut back each time the API says we're over the quota (429), and creeps back up as calls succeed
+- calls that fail with a rate limit (429) or server (5xx) error are retried, after the Retry-After the API asked for or
+  an exponential backoff with jitter, and a 429 pauses all the calls to that API, not just the one that failed
+- a circuit breaker that stops all calls for a while after repeated failures, rather than failing every doc in a run
+
+Usage:
+values = conf.quota.call(client.sheet.values_batch_get, doc_id, ranges)
+conf.quota.log_summary(conf.logger)
+"""
+__author__ = 'hammer'
+
+import time
+import random
+import threading
+import collections
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised for calls made while the circuit breaker is open, after too many calls in a row have failed
+    """
+
+
+class TokenBucket:
+    """
+    Allows calls at an average rate, with bursts of up to capacity calls
+    """
+    slow_down_factor = 0.7  # the rate is multiplied by this after a 429
+    speed_up_step = 0.01  # the fraction of the max rate it goes back up by after each successful call
+    min_rate_fraction = 0.05  # the rate never goes below this fraction of the max rate
+
+    def __init__(self, rate, capacity):
+        """
+        :param rate: the number of tokens added per second
+        :param capacity: the max number of tokens in the bucket
+        """
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def reserve(self, cost=1):
+        """
+        Takes tokens from the bucket, even if there aren't enough yet. Must be called with the governor's lock held.
+        :param cost: the number of tokens to take
+        :return: the number of seconds to wait before they can be used
+        """
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= cost
+        wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        return max(wait, self.paused_until - now)
+
+    def pause(self, seconds):
+        """
+        Holds back all the calls for a number of seconds, eg after the API says the quota has been used up
+        """
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = min(self.tokens, 0)
+
+    def slow_down(self):
+        self.rate = max(self.max_rate * self.min_rate_fraction, self.rate * self.slow_down_factor)
+
+    def speed_up(self):
+        self.rate = min(self.max_rate, self.rate + self.max_rate * self.speed_up_step)
+
+
+class Governor:
+    """
+    Rate limits, retries and circuit breaks the calls to the Google APIs, safe to use from multiple threads
+    """
+    # the requests per minute allowed for each API, and the burst size. The Sheets read quota is 60 per minute per user
+    # (the service account) and the Drive quota is much higher, each request in a Drive batch counts. The Maps
+    # Geocoding API allows 50 requests a second
+    quotas = {'sheets': (60, 10), 'drive': (12000, 1000), 'maps': (3000, 50)}
+
+    max_retries = 5  # the number of times a call is retried after a rate limit or server error
+    backoff_base = 1.0  # seconds, the first retry waits up to this long, doubling for each retry after that
+    backoff_max = 64.0  # seconds, the longest wait between retries
+    retry_statuses = {429, 500, 502, 503, 504}
+
+    failure_threshold = 5  # the number of failed calls in a row that opens the circuit breaker
+    cooldown = 120.0  # seconds the circuit breaker stays open, before letting calls try again
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = dict()
+        self.counters = collections.Counter()
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.reset()
+
+    def reset(self):
+        """
+        Refills the buckets, closes the circuit breaker and zeroes the counters, eg after changing the quotas
+        """
+        with self.lock:
+            self.buckets = {api: TokenBucket(per_minute / 60.0, burst) for api, (per_minute, burst) in self.quotas.items()}
+            self.counters = collections.Counter()
+            self.consecutive_failures = 0
+            self.open_until = 0.0
+
+    def set_quota(self, api, per_minute, burst=None):
+        """
+        Changes the rate an API is called at
+        :param api: the name of the API, eg 'sheets'
+        :param per_minute: the number of requests per minute
+        :param burst: the max number of requests that can be made at once, by default the same as now
+        """
+        with self.lock:
+            burst = burst or self.quotas.get(api, (per_minute, 1))[1]
+            self.quotas = {**self.quotas, api: (per_minute, burst)}
+            self.buckets[api] = TokenBucket(per_minute / 60.0, burst)
+
+    @staticmethod
+    def response(error):
+        """
+        :return: the HTTP response of an API error, or None
+        """
+        resp = getattr(error, 'resp', None)
+        return resp if resp is not None else getattr(error, 'response', None)
+
+    @staticmethod
+    def http_status(error):
+        """
+        :return: the HTTP status of an API error (eg a googleapiclient HttpError, or a requests HTTPError), or None if
+        it isn't one
+        """
+        resp = Governor.response(error)
+        status = getattr(resp, 'status', None) or getattr(resp, 'status_code', None) or getattr(error, 'status', None)
+        try:
+            return int(status)
+        except (TypeError, ValueError):
+            return None
+
+    @staticmethod
+    def retry_after(error):
+        """
+        :return: the number of seconds the API asked us to wait before retrying, or None
+        """
+        resp = Governor.response(error)
+        try:
+            return float(getattr(resp, 'headers', resp).get('retry-after'))
+        except (AttributeError, TypeError, ValueError):
+            return None
+
+    def backoff(self, attempt):
+        """
+        :return: the number of seconds to wait before a retry: an exponential backoff with full jitter
+        """
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def call(self, func, *args, api='sheets', cost=1, **kwargs):
+        """
+        Calls a Google API function, once there is quota for it, retrying it if it's rate limited or the API fails
+        :param func: the function that makes the API request
+        :param args: the arguments of the function
+        :param api: the API the request uses up the quota of, eg 'sheets' or 'drive'
+        :param cost: the number of requests it counts as (eg the number of requests in a batch)
+        :param kwargs: the keyword arguments of the function
+        :return: whatever func returns
+        """
+        attempt = 0
+        while True:
+            with self.lock:
+                if time.monotonic() < self.open_until:
+                    self.counters['rejected'] += 1
+                    raise CircuitOpenError(f"Not calling the {api} API, too many calls in a row failed")
+                wait = self.buckets[api].reserve(cost)
+                self.counters[f'{api}_calls'] += 1
+                if wait > 0:
+                    self.counters['throttled'] += 1
+                    self.counters['throttled_seconds'] += wait
+            if wait > 0:
+                time.sleep(wait)
+
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                status = self.http_status(e)
+                if status not in self.retry_statuses and not isinstance(e, (ConnectionError, TimeoutError)):
+                    # eg a 404, the API is working fine, there just isn't a doc
+                    with self.lock:
+                        self.consecutive_failures = 0
+                    raise
+                delay = self.retry_after(e)
+                with self.lock:
+                    self.counters[f'http_{status}' if status else 'connection_errors'] += 1
+                    if status == 429:
+                        # the quota is used up, so hold back all the calls to the API, not just this one, and slow
+                        # down (once for each pause, the calls already in flight will get 429s too)
+                        bucket = self.buckets[api]
+                        if time.monotonic() >= bucket.paused_until:
+                            bucket.slow_down()
+                        bucket.pause(delay if delay is not None else self.backoff(attempt))
+                    if attempt >= self.max_retries:
+                        self.record_failure()
+                        raise
+                    self.counters['retries'] += 1
+                if delay is None:
+                    delay = self.backoff(attempt)
+                attempt += 1
+                time.sleep(delay)
+                continue
+
+            with self.lock:
+                self.consecutive_failures = 0
+                self.buckets[api].speed_up()
+            return result
+
+    def record_failure(self):
+        """
+        Counts a call that failed even after retrying, and opens the circuit breaker if too many have failed in a row.
+        Must be called with the lock held.
+        """
+        self.counters['failures'] += 1
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= self.failure_threshold:
+            self.open_until = time.monotonic() + self.cooldown
+            # once the cooldown is over, a single failure opens it again, until a call succeeds
+            self.consecutive_failures = self.failure_threshold - 1
+            self.counters['circuit_opened'] += 1
+
+    def is_open(self):
+        """
+        :return: True if the circuit breaker is open, so calls are being rejected
+        """
+        return time.monotonic() < self.open_until
+
+    def summary(self):
+        """
+        :return: a dict of the counters, and the state of the circuit breaker
+        """
+        with self.lock:
+            rates = {f'{api}_per_minute': bucket.rate * 60 for api, bucket in self.buckets.items()}
+            return {**self.counters, **rates, 'circuit_open': self.is_open()}
+
+    def log_summary(self, logger):
+        """
+        Logs the counters, to see how close a run got to the quota
+        """
+        counters = ', '.join(f"{name}={value:.1f}" if isinstance(value, float) else f"{name}={value}"
+                             for name, value in sorted(self.summary().items()))
+        logger.info(f"Google API quota: {counters}")
@@ -6,22 +6,38 @@ __author__ = 'hammer'
 
 from .config import conf
 from . import util
+from . import official
 
 import datetime
+import threading
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, as_completed
 # import pkg_resources as pr
 # from pathlib import Path
 
 
-# TODO: add a load time to each of the doc process requests into config.google.runtime_api or _cache
-def load_register(doc_id=None, tab_name=None, force_refresh=False):
+# the Register columns that show when an official's history doc last changed
+last_sync_col = 'Last sync (seconds since epoch)'
+last_game_col = 'Last Game'
+
+# the worker threads that fetch the history docs, kept between the calls of load_histories(), see worker_pool()
+_workers = None
+_workers_size = 0
+_workers_lock = threading.Lock()
+
+
+def load_register(doc_id=None, tab_name=None, force_refresh=False, with_changes=False):
     """
     Loads the History Register google document, with a specified Google Sheet ID, and loads the doc IDs from the specified
     column. By default this will load the central OffCom History Register.
+    When the Register is refreshed, it's compared with the cached one, and the officials that were removed from it are
+    evicted from the cache. A refreshed Register without any History IDs isn't used, and if more than
+    conf.runtime.max_evict_fraction of the cached officials were removed, none of them are evicted.
     :param doc_id: explicitly set the Google Sheet ID of the History Register
     :param tab_name: explicitly set the Google Sheet tab name of the History Register
     :param force_refresh: if set to True, will force loading from the Google Doc rather than the cache
-    :return: A DataFrame of the entire History Register
+    :param with_changes: if set to True, also return the work list of officials to load, see diff_register()
+    :return: A DataFrame of the entire History Register, or a tuple of (Register, work list) if with_changes is set
     """
     start = datetime.datetime.now()
     last_checkpoint = datetime.datetime.now()
@@ -35,17 +51,16 @@ def load_register(doc_id=None, tab_name=None, force_refresh=False):
         reg_tab = conf.runtime.reg_tab_name
     needs_refresh = force_refresh
 
-    # TODO: turn this into a cache helper function, returns (object from cache, cache_item_stale) tuple
     # load the Register from cache
     cache = conf.caching.cache
     register = cache['register']
+    cached_register = register
     if register.empty:
         needs_refresh = True  # flag for refresh if the cache is not present
         conf.logger.debug("Need to refresh Register because the cache is empty")
 
     # flag for refresh if the Register cache is too old
-    stale_threshold_date = datetime.datetime.now() - datetime.timedelta(days=conf.runtime.stale_days)
-    if 'register' not in cache['metadata'].index or cache['metadata'].loc['register']['last_update'] < stale_threshold_date:
+    if conf.caching.is_stale('register'):
         needs_refresh = True
         conf.logger.debug("Need to refresh Register because the cache is too old")
 
@@ -55,15 +70,25 @@ def load_register(doc_id=None, tab_name=None, force_refresh=False):
     # if flagged for refresh and if there is a service account credential configured, then load the Register from Google and update the cache
     cred_file = conf.google.cred_file
     if needs_refresh and cred_file is not None and cred_file.exists():
-        client = util.authenticate_with_google()  # initialize the API connection to Google Docs
-        reg_wb = client.open_by_key(reg_doc_id)
+        client = conf.google.client
+        if not client:
+            client = util.authenticate_with_google()  # initialize the API connection to Google Docs
+        with conf.metrics.timer('open_by_key', source='sheet'):
+            reg_wb = conf.quota.call(client.open_by_key, reg_doc_id)
         register = util.read_tab_as_df(reg_wb, reg_tab, num_columns=len(conf.caching.reg_tab_list))
-        conf.caching.cache['register'] = register  # update the register cache in-memory
-        conf.caching.cache['metadata'] = pd.DataFrame({'last_update': datetime.datetime.now()}, index=['Register'])  # update the metadata cache in-memory
-        conf.caching.persist_cache()  # update the in-memory cache on disk
-        conf.logger.debug(f"Refreshing Register and saving {len(register)} to {conf.caching.file}")
+        if not len(register_ids(register)):
+            # eg the tab was truncated, so don't take it as every official having left the Register
+            conf.logger.warning(f"The refreshed Register has no History IDs, so the cached Register with "
+                                f"{len(cached_register)} items is kept")
+            register = cached_register
+        else:
+            conf.caching.cache['register'] = register  # update the register cache in-memory
+            conf.caching.mark_dirty('register')
+            conf.caching.touch('register')  # record when the Register was refreshed, in the metadata cache
+            conf.caching.persist_cache()  # update the in-memory cache on disk
+            conf.logger.debug(f"Refreshing Register and saving {len(register)} to {conf.caching.file}")
         time_to_load = datetime.datetime.now() - last_checkpoint
-        conf.google.runtime_api.append(time_to_load)
+        conf.metrics.observe('register', time_to_load, source='sheet')
         conf.logger.debug(f"Loading the Register from doc took {time_to_load.total_seconds():.2f}s")
     elif needs_refresh and cred_file is None:
         conf.logger.warning("Need to refresh Register but no Google credential file was available")
@@ -72,50 +97,195 @@ def load_register(doc_id=None, tab_name=None, force_refresh=False):
     else:
         conf.logger.debug(f"Using the cached Register with {len(register)} items")
 
+    work = diff_register(cached_register, register)
+    removed = work.index[work['change'] == 'removed']
+    num_cached = len(register_ids(cached_register))
+    if len(removed) > conf.runtime.max_evict_fraction * num_cached:
+        conf.logger.warning(f"The refreshed Register would remove {len(removed)} of the {num_cached} cached officials, "
+                            f"more than conf.runtime.max_evict_fraction, so they weren't evicted from the cache")
+    elif len(removed):
+        # the officials are no longer in the Register, so drop their cached data
+        for cache_key in ['officials', 'game_data', 'metadata']:
+            conf.caching.evict(cache_key, removed)
+        conf.caching.persist_cache()
+    conf.logger.debug(f"Register changes: {work['change'].value_counts().to_dict()}")
+
     conf.logger.info(f"Finished {__name__} in {(datetime.datetime.now() - start).total_seconds():.2f}s")
 
+    if with_changes:
+        return register, work
     return register
-#
-#
-# def load_histories(id_list: pd.Series):
-#     """
-#     Loads the history docs for the officials passed in to the function.
-#     The docs will be loaded from the cache, if present and current. Any missing officials will be loaded via the API, if
-#     there are credentials present, otherwise they will be omitted from the results.
-#     A tuple will be returned containing a DataFrame for the officials' general data, and another DataFrame of the combined
-#     Game History data (multi-indexed by date and official's ID).
-#     :param id_list: an array-like list of OHD Google Doc IDs
-#     :return: a tuple: (DataFrame of Officials data, DataFrame of Game History data)
-#     """
-#     start = datetime.datetime.now()
-#     logger.debug(f"Starting to load the history data")
-#
-#     officials = pd.DataFrame(columns=config.data['history_officials_data_list'])
-#     games = pd.DataFrame(columns=config.data['history_tab_list'])
-#
-#     # TODO load the cache (probably needs a helper function, included in the above) - possibly in read_tab_as_df()
-#     client = config.google['client']
-#     if not client:
-#         client = util.authenticate_with_google()
-#
-#     last_checkpoint = datetime.datetime.now()
-#     for index, item in id_list.items():
-#         logger.debug(f"Attempting to load Official ID {item}")
-#         try:
-#             off_wb = client.open_by_key(item)
-#             off_gh = util.read_tab_as_df(off_wb, 'Game History', num_columns=len(config.data['history_tab_list']))
-#
-#             officials.loc[item] = item
-#             if not off_gh.empty:
-#                 logger.debug(f"ID = {item}, shape = {off_gh.shape}")
-#                 games.loc[item] = off_gh
-#             else:
-#                 logger.warning(f"Couldn't add game history for {item}. Length = {len(off_gh)} and columns are {off_gh.columns}")
-#         except Exception as e:
-#             logger.warning(f"Couldn't load document {item} because of {e}")
-#             continue
-#         time_to_load = datetime.datetime.now() - last_checkpoint
-#         config.google['runtime_api'].append(time_to_load)
-#
-#     logger.info(f"Finished {__name__} in {(datetime.datetime.now() - start).total_seconds():.2f}s")
-#     return officials, games
+
+
+def register_ids(register):
+    """
+    :param register: a History Register DataFrame
+    :return: an Index of the History IDs in the Register, without blanks or duplicates
+    """
+    if 'History ID' not in register.columns:
+        return pd.Index([])
+    ids = register['History ID']
+    return pd.Index(ids[ids.notna() & ids.astype(str).str.strip().astype(bool)].unique())
+
+
+def register_sync_times(register):
+    """
+    Works out when each official's history doc last changed, according to the Register: the later of its last sync and
+    its last game.
+    :param register: a History Register DataFrame
+    :return: a Series of naive local datetimes (NaT if unknown), indexed by History ID
+    """
+    register = register.set_index('History ID')
+    local_tz = datetime.datetime.now().astimezone().tzinfo
+    seconds = pd.to_numeric(register[last_sync_col], errors='coerce').dropna()
+    last_sync = pd.to_datetime(seconds, unit='s', utc=True).dt.tz_convert(local_tz).dt.tz_localize(None)
+    last_sync = last_sync.reindex(register.index)
+    last_game = pd.to_datetime(register[last_game_col], errors='coerce')
+    return pd.concat([last_sync, last_game], axis=1).max(axis=1)
+
+
+def diff_register(old, new):
+    """
+    Compares a freshly loaded History Register with the cached one, and the cached metadata, to work out which officials
+    need to be loaded:
+    - added: officials that are new to the Register
+    - changed: officials whose last sync or last game changed, or is later than when their doc was last cached
+    - uncached: officials that are in both Registers, but aren't in the cache
+    - removed: officials that are no longer in the Register
+    Each official is given a priority: how many days the Register is ahead of the cache (inf if the official has never
+    been cached). Officials that are up to date aren't included.
+    :param old: the cached History Register DataFrame
+    :param new: the freshly loaded History Register DataFrame
+    :return: a DataFrame indexed by History ID, with 'change' and 'priority' columns, with the highest priority first
+    """
+    cols = ['History ID', last_sync_col, last_game_col]
+    old = old.reindex(columns=cols)
+    new = new.reindex(columns=cols)
+    old = old[old['History ID'].astype(bool) & old['History ID'].notna()].drop_duplicates('History ID', keep='last')
+    new = new[new['History ID'].astype(bool) & new['History ID'].notna()].drop_duplicates('History ID', keep='last')
+    old = old.set_index('History ID')
+    ids = pd.Index(new['History ID'])
+
+    metadata = conf.caching.cache['metadata']
+    last_update = metadata['last_update'].reindex(ids)
+    behind = (register_sync_times(new) - last_update) / pd.Timedelta(days=1)
+    priority = behind.clip(lower=0).where(last_update.notna(), float('inf'))
+
+    change = pd.Series(None, index=ids, dtype=object)
+    added = ~ids.isin(old.index)
+    change[added] = 'added'
+    # blank cells (NaN, eg a column missing from one of the Registers, or '') are equal, NaN != NaN would mark every
+    # official as changed
+    previous = old.reindex(ids).fillna('').astype(str)
+    current = new.set_index('History ID').fillna('').astype(str)
+    changed = ~added & (previous.ne(current).any(axis=1) | (behind > 0).values)
+    change[changed] = 'changed'
+    change[~added & ~changed & last_update.isna().values] = 'uncached'
+
+    work = pd.DataFrame({'change': change, 'priority': priority})
+    work = work[work['change'].notna()]
+    removed = old.index[~old.index.isin(ids)]
+    removed = pd.DataFrame({'change': 'removed', 'priority': 0.0}, index=removed)
+    work = pd.concat([work, removed]).sort_values('priority', ascending=False, kind='mergesort')
+    work.index.name = 'History ID'
+    return work
+
+
+def worker_pool(max_workers):
+    """
+    The worker threads are started once and used again by every call, so their clients and connections are too
+    :param max_workers: the number of worker threads
+    :return: the ThreadPoolExecutor of the worker threads, a new one if the number of workers has changed
+    """
+    global _workers, _workers_size
+    with _workers_lock:
+        if _workers is None or _workers_size != max_workers:
+            if _workers is not None:
+                _workers.shutdown(wait=False)
+            _workers = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='ohd-fetch')
+            _workers_size = max_workers
+        return _workers
+
+
+def load_histories(id_list, max_workers=8, persist_every=50, refresh=()):
+    """
+    Loads the history docs for the officials passed in to the function.
+    The docs will be loaded from the cache, if present and current. Any missing officials will be fetched via the API on
+    a pool of worker threads (kept between calls, see worker_pool()) that share the authorized client (see
+    util.thread_client()), in the order of id_list. The fetched docs are staged for the cache by this (the calling)
+    thread only, and committed and persisted every persist_every docs.
+    To load just the officials that changed in the Register, pass in its work list:
+    reg, work = load_register(with_changes=True)
+    load_histories(work.index[work['change'] != 'removed'], refresh=work.index[work['change'] == 'changed'])
+    :param id_list: an array-like list of OHD Google Doc IDs
+    :param max_workers: the max number of docs to fetch from Google at the same time
+    :param persist_every: the number of fetched docs to stage between each commit and persist
+    :param refresh: doc IDs to check with Google even if they're current in the cache (they are still only fetched if
+    they have been modified since they were cached)
+    :return: a tuple: (dict of doc ID: (official's information, game data, source (sheet/cache/stale/error)), summary dict)
+    """
+    start = datetime.datetime.now()
+    conf.logger.debug(f"Starting to load {len(id_list)} history docs")
+
+    results = dict()
+    to_fetch = list()
+    refresh = set(refresh)
+    for doc_id in dict.fromkeys(id_list):
+        cached = None if doc_id in refresh else official.fetch_cached_history_doc(doc_id)
+        if cached is not None:
+            results[doc_id] = (cached[0], cached[1], 'stale' if cached[2] else 'cache')
+        else:
+            to_fetch.append(doc_id)
+    conf.logger.debug(f"Found {len(results)} docs in the cache, {len(to_fetch)} to fetch")
+
+    client = conf.google.client
+    if to_fetch and not client and conf.google.cred_file is not None:
+        client = util.authenticate_with_google()
+    if to_fetch and not client:
+        conf.logger.warning(f"Need to fetch {len(to_fetch)} history docs but no Google credentials were available")
+        for doc_id in to_fetch:
+            cached = official.fetch_cached_history_doc(doc_id) if doc_id in refresh else None
+            if cached is not None:
+                results[doc_id] = (cached[0], cached[1], 'stale' if cached[2] else 'cache')
+            else:
+                results[doc_id] = (pd.DataFrame(columns=conf.caching.history_officials_data_list),
+                                   pd.DataFrame(columns=conf.caching.history_tab_list), 'error')
+    elif to_fetch:
+        # skip the docs that haven't been modified since they were cached
+        unchanged, modified = official.revalidate_history_docs(to_fetch, client)
+        for doc_id in unchanged:
+            cached = official.fetch_cached_history_doc(doc_id)
+            results[doc_id] = (cached[0], cached[1], 'cache')
+        to_fetch = [doc_id for doc_id in to_fetch if doc_id not in results]
+
+        unpersisted = 0
+        pool = worker_pool(max_workers)
+        futures = {pool.submit(official.fetch_history_doc, doc_id, client): doc_id for doc_id in to_fetch}
+        try:
+            for future in as_completed(futures):
+                doc_id = futures[future]
+                off_info, games, source = future.result()
+                if source != 'error':
+                    games = official.store_history_doc(doc_id, off_info, games, datetime.datetime.now(),
+                                                       modified.get(doc_id))
+                    unpersisted += 1
+                    if unpersisted >= persist_every:
+                        conf.caching.commit()
+                        conf.caching.persist_cache()
+                        unpersisted = 0
+                results[doc_id] = (off_info, games, source)
+        finally:
+            # the pool outlives this call, so don't leave it fetching docs nobody is waiting for
+            for future in futures:
+                future.cancel()
+        if unpersisted or unchanged:
+            conf.caching.commit()
+            conf.caching.persist_cache()
+
+    summary = {'requested': len(id_list), 'cache': 0, 'stale': 0, 'sheet': 0, 'error': 0}
+    for _, _, source in results.values():
+        summary[source] += 1
+    summary['runtime'] = datetime.datetime.now() - start
+    conf.logger.info(f"Finished {__name__} in {summary['runtime'].total_seconds():.2f}s: {summary['sheet']} from Google, "
+                     f"{summary['cache']} from cache, {summary['stale']} stale from cache, {summary['error']} errors")
+    return results, summary
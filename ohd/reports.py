@@ -0,0 +1,140 @@
+"""
+This module contains the reports on the officials and their games, run on the cached game_data and officials partitions.
+Each report works on the whole partition at once (groupby and aggregation, no loops over officials), and its results
+are memoized against the versions of the partitions it uses, so running a report again is free until the cache changes.
+The reports return copies, so they can be changed without affecting the memoized results.
+
+Usage:
+last = ohd.reports.last_games()
+inactive = ohd.reports.inactive_officials(datetime.datetime(2018, 1, 1))
+counts = ohd.reports.games_by(['Association', 'Position'], period='Y')
+"""
+__author__ = 'hammer'
+
+from .config import conf
+
+import functools
+import pandas as pd
+
+# the memoized results of each report: report name -> (partition versions, {arguments: result})
+_results = dict()
+
+
+def _hashable(value):
+    """
+    :return: the value, with any lists (eg of column names) turned into tuples so it can be used as a dict key
+    """
+    if isinstance(value, (list, tuple)):
+        return tuple(_hashable(v) for v in value)
+    return value
+
+
+def memoized(*partitions):
+    """
+    Decorator that memoizes a report, against the versions of the cache partitions it uses. The results of a report
+    are all dropped as soon as one of the partitions changes.
+    :param partitions: the names of the cache partitions the report uses
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            versions = tuple(conf.caching.version(key) for key in partitions)
+            key = (_hashable(args), _hashable(tuple(sorted(kwargs.items()))))
+            cached_versions, results = _results.get(func.__name__, (None, None))
+            if cached_versions != versions:
+                results = dict()
+                _results[func.__name__] = (versions, results)
+            if key not in results:
+                results[key] = func(*args, **kwargs)
+            return results[key].copy()
+        return wrapper
+    return decorator
+
+
+def clear():
+    """
+    Drops all the memoized report results
+    """
+    _results.clear()
+
+
+@memoized('game_data', 'officials')
+def last_games():
+    """
+    :return: a DataFrame of every official with a history doc in the cache, indexed by History ID, with their preferred
+    name, number of games, and first and last game dates (NaT for officials without any games)
+    """
+    games = conf.caching.cache['game_data']
+    officials = conf.caching.cache['officials']
+    dates = pd.Series(games.index.get_level_values('Date'), index=games.index.get_level_values(0))
+    stats = dates.groupby(level=0, sort=False).agg(['size', 'min', 'max'])
+    stats.columns = ['Games', 'First Game', 'Last Game']
+
+    ids = officials.index.union(stats.index)
+    report = stats.reindex(ids)
+    report.insert(0, 'Name', officials['Name_Preferred_raw'].reindex(ids))
+    report['Games'] = report['Games'].fillna(0).astype(int)
+    report.index.name = 'off_id'
+    return report
+
+
+@memoized('game_data', 'officials')
+def inactive_officials(since, include_no_games=True):
+    """
+    :param since: the cutoff date, officials whose last game was before it are inactive
+    :param include_no_games: if True, officials without any games are included too
+    :return: a DataFrame of the inactive officials, as in last_games(), the longest inactive first
+    """
+    report = last_games()
+    inactive = report['Last Game'] < pd.Timestamp(since)
+    if include_no_games:
+        inactive |= report['Games'] == 0
+    return report[inactive].sort_values('Last Game', na_position='first', kind='mergesort')
+
+
+@memoized('game_data')
+def games_by(by=(), period=None):
+    """
+    Counts the games, grouped by columns of game_data and/or by period. Games with a blank value in a column are
+    counted in a NaN group, rather than dropped.
+    :param by: a list of game_data columns (eg 'Association', 'Position', 'Game Type') or 'off_id' to group by
+    :param period: group by the period of the game dates too, a pandas period alias, eg 'M', 'Q' or 'Y'
+    :return: a Series of the number of games in each group
+    """
+    games = conf.caching.cache['game_data']
+    if isinstance(by, str):
+        by = [by]
+    keys = [games.index.get_level_values(0) if col == 'off_id' else games[col] for col in by]
+    if period:
+        keys.append(games.index.get_level_values('Date').to_period(period).rename('Period'))
+    if not keys:
+        return pd.Series([len(games)], index=pd.Index(['All'], name='Games'), name='Games')
+    return games.groupby(keys, observed=True, dropna=False).size().rename('Games')
+
+
+def games_by_period(period='Y'):
+    """
+    :return: a Series of the number of games in each period, eg year
+    """
+    return games_by(period=period)
+
+
+def games_by_association(period=None):
+    """
+    :return: a Series of the number of games of each association, optionally by period too
+    """
+    return games_by(['Association'], period=period)
+
+
+def games_by_position(period=None):
+    """
+    :return: a Series of the number of games officiated in each (primary) position, optionally by period too
+    """
+    return games_by(['Position'], period=period)
+
+
+def games_by_type(period=None):
+    """
+    :return: a Series of the number of games of each game type, optionally by period too
+    """
+    return games_by(['Game Type'], period=period)
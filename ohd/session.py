@@ -0,0 +1,239 @@
+"""
+SESSION:
+The one authorized Google session that the whole process shares, so the auth and connection setup is done once per
+process, not once per call.
+- the service account credentials are authorized once, and the access token is cached in the data dir until it
+  expires, so the next run doesn't need a token exchange either. It's refreshed a few minutes before it expires, by one
+  thread at a time
+- the client's HTTP transport keeps its connections open between calls, in a bounded pool that each request checks
+  a connection out of (an httplib2 connection can't be shared between threads), so the client itself can be shared
+  by all the threads
+- the client doesn't retry failed requests itself (pygsheets would sleep for 100s on a 429, and googleapiclient
+  retries 429s and 5xx errors), so the errors go straight to the quota governor, which does the retrying, see quota.py
+
+This module imports the Google client stack, so it's only imported when a client is needed.
+
+Usage:
+client = conf.google.get_client()
+"""
+__author__ = 'hammer'
+
+from .config import conf
+
+import os
+import copy
+import json
+import datetime
+import threading
+import httplib2
+import pygsheets
+from google.oauth2 import service_account
+
+scopes = ('https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive')
+token_file_name = 'google-token.json'  # the cached access token, in the data dir
+
+
+def utcnow():
+    """
+    :return: the current UTC time, as a naive datetime, the way google-auth keeps the token expiry
+    """
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
+class CachedCredentials(service_account.Credentials):
+    """
+    Service account credentials that save their access token to a file, so it can be used again until it expires, and
+    that refresh it ahead of time, one thread at a time
+    """
+    refresh_margin = datetime.timedelta(minutes=5)  # how long before it expires the token is refreshed
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.token_file = None
+        self.refresh_lock = threading.Lock()
+        self.refreshes = 0
+
+    @property
+    def expired(self):
+        return self.expiry is not None and utcnow() >= self.expiry - self.refresh_margin
+
+    def refresh(self, request):
+        with self.refresh_lock:
+            if self.valid:
+                return  # another thread refreshed it while this one was waiting
+            with conf.metrics.timer('token_refresh', source='sheet'):
+                super().refresh(request)
+            self.refreshes += 1
+            conf.logger.debug(f"Refreshed the access token of {self.service_account_email}, "
+                              f"it expires at {self.expiry}")
+            self.save_token()
+
+    def load_token(self):
+        """
+        Uses the cached access token, if it's for this service account and isn't about to expire
+        :return: True if the cached token is used
+        """
+        if self.token_file is None or not self.token_file.exists():
+            return False
+        try:
+            cached = json.loads(self.token_file.read_text())
+            expiry = datetime.datetime.fromisoformat(cached['expiry'])
+        except (ValueError, KeyError, TypeError) as error:
+            conf.logger.warning(f"Ignoring the unreadable access token cache {self.token_file}: {error}")
+            return False
+        if cached.get('service_account') != self.service_account_email or utcnow() >= expiry - self.refresh_margin:
+            return False
+        self.token, self.expiry = cached['token'], expiry
+        conf.logger.debug(f"Using the cached access token, it expires at {expiry}")
+        return True
+
+    def save_token(self):
+        """
+        Saves the access token to the cache file, readable by this user only
+        """
+        if self.token_file is None or self.token is None:
+            return
+        cached = {'service_account': self.service_account_email, 'token': self.token,
+                  'expiry': self.expiry.isoformat()}
+        temp_file = self.token_file.with_name(f"{self.token_file.name}.tmp")
+        try:
+            with open(os.open(temp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as out:
+                json.dump(cached, out)
+            os.replace(temp_file, self.token_file)
+        except OSError as error:
+            conf.logger.warning(f"Couldn't cache the access token in {self.token_file}: {error}")
+
+
+class PooledHttp:
+    """
+    An httplib2 transport that keeps its connections open between requests. An httplib2.Http (and its connections) can
+    only be used by one thread at a time, so each request checks one out of a pool of idle ones, or makes a new one if
+    they're all in use, and returns it when it's done. At most max_idle of them are kept, the rest are closed, so the
+    open connections are bounded by the number of requests made at the same time, not by the number of threads.
+    The settings, eg the timeout, are kept on a template Http that's copied for each new one.
+    """
+    own_attributes = ('template', 'idle', 'lock', 'max_idle', 'closed')
+
+    def __init__(self, timeout=60, max_idle=8):
+        """
+        :param timeout: the socket timeout of the connections, in seconds
+        :param max_idle: the max number of httplib2.Http kept open between requests
+        """
+        self.template = httplib2.Http(timeout=timeout)
+        self.idle = list()
+        self.lock = threading.Lock()
+        self.max_idle = max_idle
+        self.closed = False
+
+    def checkout(self):
+        """
+        :return: an idle httplib2.Http, or a new one if there aren't any, for the current thread to use until it's
+        returned with checkin()
+        """
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+        http = copy.copy(self.template)
+        http.connections = dict()
+        http.authorizations = list()
+        return http
+
+    def checkin(self, http):
+        """
+        Returns an httplib2.Http to the pool, or closes it if the pool is full or closed
+        """
+        with self.lock:
+            if not self.closed and len(self.idle) < self.max_idle:
+                self.idle.append(http)
+                return
+        http.close()
+
+    def request(self, *args, **kwargs):
+        http = self.checkout()
+        try:
+            return http.request(*args, **kwargs)
+        finally:
+            self.checkin(http)
+
+    def __getattr__(self, name):
+        # the other httplib2.Http attributes, eg follow_redirects, are the template's
+        if name in self.own_attributes:
+            raise AttributeError(name)
+        return getattr(self.template, name)
+
+    def __setattr__(self, name, value):
+        if name in self.own_attributes:
+            super().__setattr__(name, value)
+            return
+        # a changed setting only applies to new Http, so the idle ones are dropped
+        setattr(self.template, name, value)
+        with self.lock:
+            idle, self.idle = self.idle, list()
+        for http in idle:
+            http.close()
+
+    def close(self):
+        """
+        Closes the idle connections, and the ones in use as they're returned
+        """
+        with self.lock:
+            idle, self.idle = self.idle, list()
+            self.closed = True
+        for http in idle:
+            http.close()
+
+
+class Session:
+    """
+    Keeps one authorized pygsheets client for the process, safe to use from multiple threads
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.client = None
+        self.cred_file = None
+        self.credentials = None
+        self.http = None
+
+    def get_client(self, cred_file=None, token_file=None):
+        """
+        :param cred_file: the service account credentials file, by default conf.google.cred_file
+        :param token_file: the file the access token is cached in, by default token_file_name in the data dir
+        :return: the authorized client, connecting it the first time (or if the credentials file has changed)
+        """
+        cred_file = str(cred_file or conf.google.cred_file)
+        with self.lock:
+            if self.client is None or cred_file != self.cred_file:
+                self.connect(cred_file, token_file)
+            return self.client
+
+    def connect(self, cred_file, token_file=None):
+        """
+        Authorizes the client, must be called with the lock held
+        """
+        if token_file is None and conf.runtime.data_dir is not None:
+            token_file = conf.runtime.data_dir / token_file_name
+        with conf.metrics.timer('auth', source='sheet'):
+            credentials = CachedCredentials.from_service_account_file(cred_file, scopes=scopes)
+            credentials.token_file = token_file
+            credentials.load_token()
+            if self.http is not None:
+                self.http.close()
+            self.http = PooledHttp()
+            self.client = pygsheets.authorize(custom_credentials=credentials, http=self.http, retries=0, check=False)
+            self.client.drive.retries = 0
+        self.cred_file = cred_file
+        self.credentials = credentials
+        conf.logger.debug(f"Authorized {credentials.service_account_email} using the credentials in {cred_file}")
+
+    def close(self):
+        """
+        Closes the client's connections, the next get_client() connects it again
+        """
+        with self.lock:
+            if self.http is not None:
+                self.http.close()
+            self.client = self.credentials = self.cred_file = self.http = None
+
+
+# the session shared by the whole process
+session = Session()
@@ -0,0 +1,267 @@
+"""
+STORAGE:
+The on-disk backends for the cache. Each backend stores the cache partitions defined in Conf.Cache.cache_defs, and
+can write just the changed items of a partition.
+"""
+__author__ = 'hammer'
+
+from .config import conf
+
+import collections
+import pandas as pd
+
+# the changes to a stored partition: the rows of the changed items (all the rows, if keys is None), the changed item
+# keys, the number of rows in the whole partition, and a function that returns the whole partition, for a backend that
+# has to rewrite it. All of them are in the stored format, see Conf.Cache.encode()
+Change = collections.namedtuple('Change', ['rows', 'keys', 'size', 'full'])
+
+
+class Storage:
+    """
+    The interface of a cache backend
+    """
+    extension = None  # the file extension of the cache file
+
+    def __init__(self, file, cache_defs):
+        """
+        :param file: the path of the cache file
+        :param cache_defs: the definitions of the cache partitions, from Conf.Cache.cache_defs
+        """
+        self.file = file
+        self.cache_defs = cache_defs
+
+    def key_col(self, key):
+        """
+        The name of the column the items of a partition are keyed by
+        :param key: the partition of the cache
+        """
+        return self.cache_defs[key].get('index', ['index'])[0]
+
+    def has_partition(self, key):
+        """
+        :param key: the partition of the cache
+        :return: True if the partition has been stored
+        """
+        raise NotImplementedError
+
+    def read(self, key):
+        """
+        Reads a whole partition
+        :param key: the partition of the cache
+        :return: the partition DataFrame
+        """
+        raise NotImplementedError
+
+    def read_items(self, key, items):
+        """
+        Reads some of the items of a partition
+        :param key: the partition of the cache
+        :param items: a list of the item keys to read
+        :return: a DataFrame of the items' rows
+        """
+        raise NotImplementedError
+
+    def write(self, changes):
+        """
+        Writes the changes to the cache partitions
+        :param changes: a dict of partition: Change. If the changed keys is None, the whole partition is rewritten with
+        the rows. Changed keys without any rows are deleted.
+        """
+        raise NotImplementedError
+
+    @staticmethod
+    def changed_rows(df, keys):
+        """
+        :return: the rows of the DataFrame that belong to the given item keys
+        """
+        if isinstance(df.index, pd.MultiIndex):
+            return df[df.index.get_level_values(0).isin(keys)]
+        return df[df.index.isin(keys)]
+
+
+class SQLiteStorage(Storage):
+    """
+    Stores each partition as a row oriented SQLite table
+    """
+    extension = 'db'
+    chunk_size = 500  # the max number of keys per SQL statement, SQLite has a limit on bound parameters
+
+    def __init__(self, file, cache_defs):
+        super().__init__(file, cache_defs)
+        import sqlalchemy  # only needed by this backend
+        self.engine = sqlalchemy.create_engine(f"sqlite:///{file}")
+
+    def has_partition(self, key):
+        return self.engine.has_table(key)
+
+    def read(self, key):
+        index_col = self.cache_defs[key].get('index', 'index')
+        return pd.read_sql_table(key, self.engine, index_col=index_col, parse_dates=self.cache_defs[key]['dates'])
+
+    def read_items(self, key, items):
+        index_col = self.cache_defs[key].get('index', 'index')
+        key_col = self.key_col(key)
+        items = list(items)
+        frames = list()
+        for i in range(0, len(items), self.chunk_size):
+            chunk = items[i:i + self.chunk_size]
+            params = ','.join('?' * len(chunk))
+            frames.append(pd.read_sql_query(f'SELECT * FROM "{key}" WHERE "{key_col}" IN ({params})', self.engine,
+                                            params=tuple(chunk), index_col=index_col,
+                                            parse_dates=self.cache_defs[key]['dates']))
+        return pd.concat(frames) if frames else None
+
+    def write(self, changes):
+        # all the changes are written in a single transaction
+        with self.engine.begin() as db:
+            for key, (rows, keys, size, full) in changes.items():
+                key_col = self.key_col(key)
+                if keys is None or not db.dialect.has_table(db, key):
+                    df = rows if keys is None else full()
+                    if df.empty:
+                        continue
+                    conf.logger.debug(f"Persisting all of {key} to the cache")
+                    df.to_sql(key, db, if_exists='replace')
+                    db.execute(f'CREATE INDEX IF NOT EXISTS "ix_{key}_{key_col}" ON "{key}" ("{key_col}")')
+                    continue
+
+                conf.logger.debug(f"Persisting {len(keys)} changed items of {key} to the cache")
+                keys = list(keys)
+                for i in range(0, len(keys), self.chunk_size):
+                    chunk = keys[i:i + self.chunk_size]
+                    params = ','.join('?' * len(chunk))
+                    db.execute(f'DELETE FROM "{key}" WHERE "{key_col}" IN ({params})', tuple(chunk))
+                if not rows.empty:
+                    rows.to_sql(key, db, if_exists='append')
+
+
+class HDFStorage(Storage):
+    """
+    Stores each partition as a column oriented, compressed HDF5 table (using PyTables), with native datetime columns.
+    The category columns are stored as their codes in the column's dictionary, see Conf.Cache.encode().
+    The tables are append only: changed items are appended with the number of the write, and a small table of the
+    latest write of each item says which rows are current. So persisting new or changed officials never rewrites the
+    old data, until there are more superseded rows than current ones and the table is compacted.
+    """
+    extension = 'h5'
+    chunk_size = 30  # the max number of keys per where clause, bigger lists get filtered in memory by pandas
+    min_string_size = 64  # the minimum width of a string column, longer strings will rewrite the partition
+    write_col = '_write'  # the column with the number of the write that added the row
+    complib = 'blosc'
+    complevel = 5
+
+    @staticmethod
+    def writes_key(key):
+        """
+        :return: the name of the table of the latest write of each item of a partition
+        """
+        return f"{key}_writes"
+
+    def has_partition(self, key):
+        with pd.HDFStore(self.file, mode='a') as store:
+            return key in store
+
+    def current_rows(self, df, writes):
+        """
+        Drops the superseded rows, and the write column
+        """
+        item_keys = df.index.get_level_values(0) if isinstance(df.index, pd.MultiIndex) else df.index
+        latest = writes.reindex(item_keys).values
+        return df[df[self.write_col].values == latest].drop(columns=self.write_col)
+
+    def read(self, key):
+        with pd.HDFStore(self.file, mode='a') as store:
+            return self.current_rows(store.select(key), store.select(self.writes_key(key)))
+
+    def read_items(self, key, items):
+        items = list(items)
+        frames = list()
+        with pd.HDFStore(self.file, mode='a') as store:
+            writes = store.select(self.writes_key(key))
+            for i in range(0, len(items), self.chunk_size):
+                chunk = items[i:i + self.chunk_size]
+                frames.append(self.current_rows(store.select(key, where=f"{self.key_col(key)}={chunk!r}"), writes))
+        return pd.concat(frames) if frames else None
+
+    def prepare(self, key, df):
+        """
+        Converts a partition to types that can be stored in a HDF5 table: the dates are datetimes, and all the other
+        object columns are strings.
+        """
+        df = df.copy()
+        for col in df.columns:
+            if col in self.cache_defs[key]['dates']:
+                df[col] = pd.to_datetime(df[col], errors='coerce')
+            elif df[col].dtype == object:
+                df[col] = df[col].where(df[col].isna(), df[col].astype(str))
+        if not isinstance(df.index, pd.MultiIndex) and df.index.dtype == object:
+            df.index = df.index.astype(str)
+        return df
+
+    def string_sizes(self, df):
+        """
+        :return: the min_itemsize of the string columns (as one block) and the index, with some head room
+        """
+        longest = 0
+        for col in df.columns:
+            if df[col].dtype == object:
+                col_longest = df[col].dropna().str.len().max()
+                if pd.notna(col_longest):
+                    longest = max(longest, int(col_longest))
+        sizes = {'values': max(self.min_string_size, 2 * longest)}
+        for name in df.index.names:
+            sizes[name or 'index'] = self.min_string_size
+        return sizes
+
+    def put(self, store, key, df):
+        """
+        Rewrites the whole partition as write 0
+        """
+        for table in [key, self.writes_key(key)]:
+            if table in store:
+                store.remove(table)
+        if df.empty:
+            return
+        item_keys = df.index.get_level_values(0) if isinstance(df.index, pd.MultiIndex) else df.index
+        df[self.write_col] = 0
+        store.put(key, df, format='table', index=False, min_itemsize=self.string_sizes(df), complib=self.complib,
+                  complevel=self.complevel)
+        store.put(self.writes_key(key), pd.Series(0, index=item_keys.unique()))
+
+    def write(self, changes):
+        with pd.HDFStore(self.file, mode='a') as store:
+            for key, (rows, keys, size, full) in changes.items():
+                if keys is None or key not in store:
+                    conf.logger.debug(f"Persisting all of {key} to the cache")
+                    self.put(store, key, self.prepare(key, rows if keys is None else full()))
+                    continue
+
+                conf.logger.debug(f"Persisting {len(keys)} changed items of {key} to the cache")
+                writes = store.select(self.writes_key(key))
+                write = int(writes.max()) + 1 if len(writes) else 1
+                rows = self.prepare(key, rows)
+                rows[self.write_col] = write
+                # deleted items have no current write
+                writes = writes.reindex(writes.index.union(pd.Index(list(keys))))
+                writes[list(keys)] = -1
+                writes[rows.index.get_level_values(0).unique() if isinstance(rows.index, pd.MultiIndex)
+                       else rows.index] = write
+                stored_rows = store.get_storer(key).nrows + len(rows)
+                if stored_rows > 2 * size:
+                    conf.logger.debug(f"Compacting {key} in the cache")
+                    self.put(store, key, self.prepare(key, full()))
+                    continue
+                try:
+                    if not rows.empty:
+                        store.append(key, rows, format='table', index=False, complib=self.complib,
+                                     complevel=self.complevel)
+                except ValueError as e:
+                    # the new rows don't fit the stored table (eg a longer string), so rewrite it
+                    conf.logger.debug(f"Rewriting {key} in the cache because {e}")
+                    self.put(store, key, self.prepare(key, full()))
+                    continue
+                store.put(self.writes_key(key), writes.astype(int))
+
+
+# the available cache backends, by name
+backends = {'sqlite': SQLiteStorage, 'hdf': HDFStorage}
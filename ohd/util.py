@@ -4,8 +4,14 @@ __author__ = "hammer"
 # from . import config
 from .config import conf
 from pathlib import Path
-import pygsheets
 # import datetime
+import re
+import math
+import difflib
+import weakref
+import threading
+import collections
+import numpy as np
 import pandas as pd
 # import sqlite3
 
@@ -13,16 +19,18 @@ import pandas as pd
 def authenticate_with_google(cred_file=None):
     """
     Authenticate the service account with google and return a credentialed connection.
-    Adds the authorized connection to the config object
+    Adds the authorized connection to the config object. The connection is the process's shared session (see
+    session.py), so only the first call for a credentials file authorizes.
     :param cred_file: the file containing the Google credentials to use to authenticate
     :return: the authorized connection (in case someone really needs it)
     """
     if cred_file is None:
         cred_file = conf.google.cred_file
     conn = None
-    if Path(cred_file).exists():
+    if cred_file is not None and Path(cred_file).exists():
         conf.logger.debug(f"Authenticating using credentials in {cred_file}")
-        conn = pygsheets.authorize(service_file=cred_file)
+        from .session import session  # the Google client stack is slow to import, so only load it when it's needed
+        conn = session.get_client(cred_file)
         conf.google.client = conn
     else:
         conf.logger.debug(f"Provided credentials file doesn't exist: {cred_file}")
@@ -30,7 +38,40 @@ def authenticate_with_google(cred_file=None):
     return conn
 
 
-def read_tab_as_df(workbook, tab_name, num_columns=None, raw=False):
+_thread_clients = threading.local()  # each thread's copies of the clients, see thread_client()
+
+
+def thread_client(client):
+    """
+    The pygsheets client makes its requests with an httplib2 connection, which can't be shared between threads, so each
+    worker thread gets its own copy of the client, with the same credentials and settings but its own connection.
+    The copies are made once per thread, and go when the thread does. The session's client checks a connection out of
+    its pool for each request, so it's already safe to share, see session.PooledHttp.
+    :param client: the authorized client shared by the threads
+    :return: the current thread's copy of the client, or the client itself if it's the session's client or isn't a
+    pygsheets client (eg a fake)
+    """
+    credentials = getattr(client, 'oauth', None)
+    if credentials is None:
+        return client
+    from .session import session
+    if client is session.client:
+        return client
+    clients = getattr(_thread_clients, 'clients', None)
+    if clients is None:
+        clients = _thread_clients.clients = weakref.WeakKeyDictionary()
+    if client not in clients:
+        # the Google client stack is slow to import, so only load it when it's needed
+        import httplib2
+        from pygsheets.client import Client
+        sheet = client.sheet
+        clients[client] = Client(credentials, http=httplib2.Http(), retries=sheet.retries, check=sheet.check,
+                                 seconds_per_quota=sheet.seconds_per_quota)
+        clients[client].drive.retries = client.drive.retries
+    return clients[client]
+
+
+def read_tab_as_df(workbook, tab_name, num_columns=None, raw=False, schema=None):
     """
     Read the named tab from the given Google Sheets workbook, and return the tab as a DataFrame that has been trimmed
     to remove empty/blank cells.
@@ -38,14 +79,276 @@ def read_tab_as_df(workbook, tab_name, num_columns=None, raw=False):
     :param tab_name: name of the tab to load
     :param num_columns: the number of columns to return
     :param raw: if set to True, then return the full tab as is
+    :param schema: the types of the columns, see values_as_df()
+    :return: a DataFrame
+    """
+    with conf.metrics.timer('worksheet', source='sheet'):
+        worksheet = conf.quota.call(workbook.worksheet_by_title, tab_name)
+    with conf.metrics.timer('tab_read', source='sheet'):
+        values = conf.quota.call(worksheet.get_all_values, include_tailing_empty=False,
+                                 include_tailing_empty_rows=False)
+    return values_as_df(values, num_columns=num_columns, raw=raw, schema=schema)
+
+
+def batch_get_values(client, doc_id, ranges):
+    """
+    Read several ranges from a Google Sheets workbook in a single API request, without loading the workbook's metadata.
+    :param client: the authorized pygsheets client
+    :param doc_id: the Google Sheets ID
+    :param ranges: a list of ranges in A1 notation, eg "'Game History'!A:N"
+    :return: a list with the rows (list of lists of strings) of each range, in the same order as the ranges
+    """
+    with conf.metrics.timer('tab_read', source='sheet'):
+        value_ranges = conf.quota.call(client.sheet.values_batch_get, doc_id, ranges)
+    return [vr.get('values', []) for vr in value_ranges]
+
+
+def column_values(values, length):
+    """
+    Flatten the rows of a single column range into a list, padding the missing (empty) cells with ''
+    :param values: the rows of the range, as returned by batch_get_values()
+    :param length: the number of cells in the range
+    :return: a list of the cell values
+    """
+    cells = [row[0] if row else '' for row in values[:length]]
+    return cells + [''] * (length - len(cells))
+
+
+def values_as_df(values, num_columns=None, raw=False, schema=None):
+    """
+    Turn the rows of a range, with the first row as the header, into a DataFrame that has been trimmed to remove
+    empty/blank rows. The rows are padded and trimmed as a single array, rather than cell by cell.
+    :param values: the rows of the range, as returned by batch_get_values()
+    :param num_columns: the number of columns to return
+    :param raw: if set to True, then return the full range as is
+    :param schema: the types of the columns, eg one of conf.caching.cache_defs: the columns listed in its 'dates' are
+    parsed as dates, all the others are left as strings
     :return: a DataFrame
     """
-    df = workbook.worksheet_by_title(tab_name).get_as_df()
-    if not raw and not df.empty:
-        df.replace('', pd.np.nan, inplace=True)
-        df.dropna(how='all', inplace=True)
-        if num_columns:
-            df = df.iloc[:, :num_columns]
-        df.fillna('', inplace=True)
+    if not values:
+        return pd.DataFrame()
+    header = values[0]
+    width = len(header)
+    if not raw and num_columns:
+        width = min(width, num_columns)
+        header = header[:width]
+    cells = np.array([row[:width] + [''] * (width - len(row)) for row in values[1:]], dtype=object).reshape(-1, width)
+    if not raw:
+        cells = cells[(cells != '').any(axis=1)]
+    df = pd.DataFrame(cells, columns=header)
+    if schema is not None:
+        for col in schema.get('dates', []):
+            if col in df.columns:
+                df[col] = parse_dates(df[col])
 
     return df
+
+
+def parse_dates(values, formats=('%Y-%m-%d', '%m/%d/%Y')):
+    """
+    Parse a column of date strings, trying each of the explicit formats in turn (fast, as they're parsed as a whole
+    column), and falling back to parsing the rest one by one. Blank or unparseable values become NaT.
+    :param values: a Series of date strings
+    :param formats: the date formats to try, in order, before falling back
+    :return: a Series of datetimes
+    """
+    blank = values == ''
+    dates = pd.to_datetime(values, format=formats[0], errors='coerce')
+    todo = dates.isna() & ~blank
+    for date_format in formats[1:]:
+        if not todo.any():
+            return dates
+        dates[todo] = pd.to_datetime(values[todo], format=date_format, errors='coerce')
+        todo &= dates.isna()
+    if todo.any():
+        dates[todo] = values[todo].map(lambda value: pd.to_datetime(value, errors='coerce'))
+        unparsed = todo & dates.isna()
+        if unparsed.any():
+            conf.logger.debug(f"Couldn't parse {unparsed.sum()} dates, eg {values[unparsed].iloc[0]!r}")
+    return dates
+
+
+def get_modified_times(client, doc_ids, batch_size=100):
+    """
+    Look up when each of the docs was last modified, using batched Drive metadata requests (much cheaper than reading
+    the docs themselves).
+    :param client: the authorized pygsheets client
+    :param doc_ids: a list of Google Doc IDs
+    :param batch_size: the number of docs per batch request, Drive allows up to 100
+    :return: a dict of doc ID: modified time (as a naive UTC Timestamp), docs that couldn't be looked up are left out
+    """
+    modified = dict()
+
+    def collect(request_id, response, exception):
+        if exception is not None:
+            conf.logger.debug(f"Couldn't get the modified time of {request_id} because of {exception}")
+            return
+        modified[request_id] = pd.Timestamp(response['modifiedTime']).tz_convert(None)
+
+    drive = client.drive.service
+    doc_ids = list(doc_ids)
+    for i in range(0, len(doc_ids), batch_size):
+        batch = drive.new_batch_http_request(callback=collect)
+        batch_ids = doc_ids[i:i + batch_size]
+        for doc_id in batch_ids:
+            batch.add(drive.files().get(fileId=doc_id, fields='id,modifiedTime', supportsAllDrives=True),
+                      request_id=doc_id)
+        with conf.metrics.timer('drive_metadata', source='sheet'):
+            conf.quota.call(batch.execute, api='drive', cost=len(batch_ids))
+
+    return modified
+
+
+def load_locations(doc_id=None, tab_name=None, cred_file=None):
+    """
+    Load the league locations sheet, and keep it in conf.runtime.locations
+    :param doc_id: the Google Sheet ID of the locations, by default conf.runtime.locations_id
+    :param tab_name: the name of the locations tab, by default conf.runtime.locations_tab_name
+    :param cred_file: the file containing the Google credentials to use, if not already authenticated
+    :return: a dict of league name: the league's row (a list of the values in conf.runtime.locations_tab_list order)
+    """
+    doc_id = doc_id or conf.runtime.locations_id
+    tab_name = tab_name or conf.runtime.locations_tab_name
+    if doc_id is None:
+        raise Exception("The Google Sheet ID of the league locations (conf.runtime.locations_id) hasn't been set")
+    client = conf.google.client or authenticate_with_google(cred_file)
+    workbook = conf.quota.call(client.open_by_key, doc_id)
+    df = read_tab_as_df(workbook, tab_name, num_columns=len(conf.runtime.locations_tab_list))
+    rows = df.to_numpy().tolist()
+    locations = {row[0].strip(): row for row in rows if row[0].strip()}
+    conf.logger.debug(f"Loaded {len(locations)} league locations")
+    conf.runtime.locations = locations
+    return locations
+
+
+def locations_frame(locations=None):
+    """
+    :param locations: the league locations, as returned by load_locations(), by default conf.runtime.locations
+    :return: the locations as a DataFrame indexed by league name, with the conf.runtime.locations_tab_list columns, and
+    the Latitude and Longitude as numbers (NaN where they're blank)
+    """
+    if locations is None:
+        locations = conf.runtime.locations or dict()
+    cols = conf.runtime.locations_tab_list
+    df = pd.DataFrame([list(row[:len(cols)]) + [''] * (len(cols) - len(row)) for row in locations.values()],
+                      index=pd.Index(list(locations), dtype=object), columns=cols)
+    for col in ['Latitude', 'Longitude']:
+        df[col] = pd.to_numeric(df[col], errors='coerce')
+    return df
+
+
+class LeagueIndex:
+    """
+    An inverted index of the tokens of league names, to find the leagues that share words with a name without scoring
+    every league, with the matches memoized by normalized name
+    """
+    # words so common in league names they don't help tell leagues apart
+    common_words = {'derby', 'girls', 'rollers', 'roller', 'rollergirls'}
+    max_candidates = 5  # the number of leagues (with the most shared words) that are scored for each name
+
+    def __init__(self, names):
+        """
+        :param names: the league names to match against
+        """
+        self.names = list(names)
+        self.tokens = [self.tokenize(name) for name in self.names]
+        self.postings = collections.defaultdict(list)
+        for number, tokens in enumerate(self.tokens):
+            for token in tokens:
+                self.postings[token].append(number)
+        # rarer words count for more when picking the candidates
+        self.idf = {token: math.log(len(self.names) / len(numbers)) + 1 for token, numbers in self.postings.items()}
+        # names that are the same once normalized don't need scoring
+        self.exact = dict()
+        for name, tokens in zip(self.names, self.tokens):
+            self.exact.setdefault(' '.join(sorted(tokens)), name)
+        self.matches = dict()
+
+    @classmethod
+    def tokenize(cls, name):
+        """
+        :return: the set of lower case words of a name, without the common words (unless that's all there are)
+        """
+        words = set(re.findall(r'\w+', str(name).lower()))
+        return words - cls.common_words or words
+
+    @staticmethod
+    def ratio(a, b):
+        """
+        :return: the similarity of two strings, from 0 to 100
+        """
+        return difflib.SequenceMatcher(None, a, b).ratio() * 100
+
+    def token_set_ratio(self, a, b):
+        """
+        :return: the similarity of two sets of tokens, from 0 to 100, the same as fuzzywuzzy's token_set_ratio
+        """
+        shared = ' '.join(sorted(a & b))
+        only_a = (shared + ' ' + ' '.join(sorted(a - b))).strip()
+        only_b = (shared + ' ' + ' '.join(sorted(b - a))).strip()
+        return max(self.ratio(shared, only_a), self.ratio(shared, only_b), self.ratio(only_a, only_b))
+
+    def match(self, name, min_score=60):
+        """
+        :param name: a league name, eg from an official's profile
+        :param min_score: the lowest similarity score (0-100) that counts as a match
+        :return: a tuple of the best matching league name (or None) and its score
+        """
+        tokens = self.tokenize(name)
+        normalized = ' '.join(sorted(tokens))
+        if normalized in self.exact:
+            return self.exact[normalized], 100.0
+        key = (normalized, min_score)
+        if key not in self.matches:
+            shared = collections.Counter()
+            for token in tokens:
+                for number in self.postings.get(token, []):
+                    shared[number] += self.idf[token]
+            best = (None, 0)
+            for number, _ in shared.most_common(self.max_candidates):
+                score = self.token_set_ratio(tokens, self.tokens[number])
+                if score > best[1]:
+                    best = (self.names[number], score)
+            self.matches[key] = best if best[1] >= min_score else (None, best[1])
+        return self.matches[key]
+
+
+_league_index = None
+
+
+def league_index(locations=None):
+    """
+    :param locations: the league locations, as returned by load_locations(), by default conf.runtime.locations
+    :return: the LeagueIndex of the locations, only built again if the locations change
+    """
+    global _league_index
+    if locations is None:
+        locations = conf.runtime.locations or dict()
+    if _league_index is None or _league_index[0] is not locations or _league_index[1] != len(locations):
+        _league_index = (locations, len(locations), LeagueIndex(locations))
+    return _league_index[2]
+
+
+def match_league(league, locations=None, min_score=60):
+    """
+    Find the league in the locations that best matches a league name, ignoring case, punctuation and the common words
+    :param league: a league name
+    :param locations: the league locations, as returned by load_locations(), by default conf.runtime.locations
+    :param min_score: the lowest similarity score (0-100) that counts as a match
+    :return: the matching league name in the locations, or None if there isn't a good enough match
+    """
+    return league_index(locations).match(league, min_score)[0]
+
+
+def match_leagues(leagues, locations=None, min_score=60):
+    """
+    Find the best matching league for each of a list of league names, see match_league()
+    :param leagues: a list (or Series) of league names
+    :return: a Series of the matching league names (None where there isn't a good enough match), indexed like leagues
+    """
+    index = league_index(locations)
+    leagues = pd.Series(leagues, dtype=object)
+    # each distinct name is only matched once
+    names = leagues.fillna('').unique()
+    matches = {name: index.match(name, min_score)[0] for name in names}
+    return leagues.fillna('').map(matches)
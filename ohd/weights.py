@@ -0,0 +1,203 @@
+"""
+This module contains the experience weighting engine, which scores each official's experience in each position, and
+each family of positions, from their game history.
+The scores come from a table of rules, eg a tab in a Google Sheet, with a row for each rule:
+| Rule | Include | Exclude | Months | Weight 1 | ... | Weight N |
+- Include / Exclude: the games the rule applies to, as query filters (see query.py) written as
+  key=value,value;key=value, eg "standard=True; assn=WFTDA,MRDA"
+- Months: the length of each age period
+- Weight 1 to N: the weight of a game in each age period, the most recent first. Games older than the last period with a
+  weight aren't counted.
+Each game is weighted by the first rule it matches, so more specific rules should come first, and the weights of an
+official's games are added up by the position they worked.
+
+The rules are compiled into masks over the whole game_data partition, so all the officials are scored at once, and the
+scores are kept, so only the officials whose games have changed are scored again.
+
+Usage:
+scorer = ohd.weights.Scorer(ohd.weights.load_rules(doc_id, 'Weights'))
+positions = scorer.position_scores()
+families = scorer.family_scores()
+"""
+__author__ = 'hammer'
+
+from .config import conf
+from . import query
+
+import collections
+import numpy as np
+import pandas as pd
+
+# the families of positions that scores are added up by, any other position is in the Other family
+position_families = {'Ref': ['HR', 'IPR', 'JR', 'OPR', 'ALTR', 'THR', 'ATHR'],
+                     'NSO': ['HNSO', 'JT', 'SO', 'SK', 'PBM', 'PBT', 'PW', 'IWB', 'JW', 'PLT', 'LT', 'ALTN', 'THNSO',
+                             'ATHNSO']}
+
+Rule = collections.namedtuple('Rule', ['name', 'include', 'exclude', 'months', 'weights'])
+
+
+def parse_filter(text):
+    """
+    :param text: a query filter written as key=value,value;key=value, eg "standard=True; assn=WFTDA,MRDA"
+    :return: the filter dict, eg {'standard': [True], 'assn': ['WFTDA', 'MRDA']}
+    """
+    criteria = dict()
+    for term in str(text or '').split(';'):
+        if not term.strip():
+            continue
+        key, _, values = term.partition('=')
+        values = [value.strip() for value in values.split(',') if value.strip()]
+        criteria[key.strip()] = [{'true': True, 'false': False}.get(value.lower(), value) for value in values]
+    return criteria
+
+
+def compile_rules(table):
+    """
+    Compiles the rule table, checking that the filters are valid
+    :param table: a DataFrame of the rules, in the format of the rules sheet
+    :return: a list of Rules
+    """
+    weight_cols = [col for col in table.columns if str(col).startswith('Weight')]
+    rules = list()
+    for number, row in enumerate(table.to_dict('records')):
+        weights = pd.to_numeric(pd.Series([row[col] for col in weight_cols], dtype=object), errors='coerce')
+        # the periods end at the first blank weight
+        blank = np.flatnonzero(weights.isna().to_numpy())
+        weights = weights.to_numpy(dtype=float)[:blank[0] if len(blank) else len(weights)]
+        rule = Rule(name=row.get('Rule') or f"Rule {number + 1}",
+                    include=parse_filter(row.get('Include')),
+                    exclude=parse_filter(row.get('Exclude')),
+                    months=int(row.get('Months') or 12),
+                    weights=weights)
+        query.compile_filter(rule.include)
+        query.compile_filter(rule.exclude)
+        rules.append(rule)
+    conf.logger.debug(f"Compiled {len(rules)} weighting rules")
+    return rules
+
+
+def load_rules(doc_id, tab_name='Weights'):
+    """
+    Loads the rule table from a Google Sheet
+    :param doc_id: the Google Sheet ID of the rules sheet
+    :param tab_name: the name of the tab with the rules
+    :return: a list of Rules
+    """
+    from . import util
+
+    client = conf.google.client
+    if not client:
+        client = util.authenticate_with_google()
+    workbook = conf.quota.call(client.open_by_key, doc_id)
+    return compile_rules(util.read_tab_as_df(workbook, tab_name))
+
+
+def game_weights(games, rules, start):
+    """
+    :param games: game_data, or some of its rows
+    :param rules: a list of Rules
+    :param start: the end of the most recent age period
+    :return: an array of the weight of each game, by the first rule it matches
+    """
+    dates = games.index.get_level_values('Date')
+    weights = np.zeros(len(games))
+    unmatched = np.ones(len(games), dtype=bool)
+    for rule in rules:
+        if not len(rule.weights):
+            continue
+        mask = unmatched & query.filter_mask(games, rule.include)
+        if rule.exclude:
+            mask &= ~query.filter_mask(games, rule.exclude)
+        periods = query.interval_buckets(dates, start, rule.months, len(rule.weights))
+        mask &= periods >= 0
+        weights[mask] = rule.weights[periods[mask]]
+        unmatched &= ~mask
+    return weights
+
+
+def score_games(games, rules, start):
+    """
+    :param games: game_data, or the rows of some officials
+    :param rules: a list of Rules
+    :param start: the end of the most recent age period
+    :return: a DataFrame of the scores of the officials with games, indexed by History ID, with a column for each
+    position
+    """
+    weights = game_weights(games, rules, start)
+    positions = games['Position'].cat
+    if isinstance(games.index, pd.MultiIndex):
+        officials = games.index.levels[0]
+        off_codes = np.asarray(games.index.codes[0], dtype=np.int64)
+    else:
+        officials, off_codes = pd.Index([]), np.zeros(0, dtype=np.int64)
+    # add up the weights of each official's games in each position with one bincount, blank positions (code -1) going
+    # in the first column, which is dropped
+    num_cols = len(positions.categories) + 1
+    sums = np.bincount(off_codes * num_cols + positions.codes.to_numpy() + 1, weights=weights,
+                       minlength=len(officials) * num_cols)
+    scores = pd.DataFrame(sums.reshape(len(officials), num_cols)[:, 1:], index=officials,
+                          columns=pd.Index(positions.categories, dtype=object))
+    scores = scores[np.bincount(off_codes, minlength=len(officials)) > 0]
+    scores.index.name = 'off_id'
+    return scores
+
+
+class Scorer:
+    """
+    Scores the officials with a set of rules, keeping the scores and only scoring the officials whose games changed
+    since the last time again
+    """
+    def __init__(self, rules, start=None):
+        """
+        :param rules: a list of Rules, see load_rules()
+        :param start: the end of the most recent age period, by default today
+        """
+        self.rules = rules
+        self.start = start
+        self.scores = None
+        self.version = None  # the game_data version the scores are for
+        self.scored_start = None  # the start the scores are for
+
+    def update(self):
+        """
+        Brings the scores up to date with the cache
+        """
+        caching = conf.caching
+        version = caching.version('game_data')
+        start = pd.Timestamp(self.start) if self.start is not None else pd.Timestamp.now().normalize()
+        if self.scores is not None and start == self.scored_start:
+            if version == self.version:
+                return
+            changed = caching.changed_since('game_data', self.version)
+        else:
+            changed = None
+
+        games = caching.cache['game_data']
+        if changed is None:
+            self.scores = score_games(games, self.rules, start)
+            conf.logger.debug(f"Scored {len(self.scores)} officials")
+        elif changed:
+            rescored = score_games(caching.read_games(changed), self.rules, start)
+            scores = pd.concat([self.scores[~self.scores.index.isin(changed)], rescored], sort=False)
+            self.scores = scores.fillna(0.0)
+            conf.logger.debug(f"Scored {len(rescored)} officials whose games changed")
+        self.version = version
+        self.scored_start = start
+
+    def position_scores(self):
+        """
+        :return: a DataFrame of the scores of every official with games, indexed by History ID, with a column for each
+        position
+        """
+        self.update()
+        return self.scores.copy()
+
+    def family_scores(self):
+        """
+        :return: a DataFrame of the scores of every official with games, indexed by History ID, with a column for each
+        family of positions
+        """
+        self.update()
+        family_of = {position: family for family, positions in position_families.items() for position in positions}
+        families = [family_of.get(position, 'Other') for position in self.scores.columns]
+        return self.scores.T.groupby(families, sort=False).sum().T
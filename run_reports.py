@@ -1,11 +1,12 @@
 """
-This loads the officials from the Register and runs some reports/stats on them
+This runs some reports/stats on the officials in the cache. Run load_register.py first to bring the cache up to date.
 """
 __author__ = 'hammer'
 
 import ohd
+import os
 import datetime
-from functools import reduce
+import pandas as pd
 
 
 if __name__ == '__main__':
@@ -13,26 +14,22 @@ if __name__ == '__main__':
     # get the location info
     # locations = util.load_locations(cred_file='../service-account.json')
 
-    doc_id = '1vrvYjcNLTdWypfeWjMUyMuo3LVtX80CKMRY-3SegdDw'  # production register
-    # doc_id = '1mH2Sui25qqrGt0x8k_KuL1BONsZ3rOPCIurECnX3Jxw'  # real test register
-    # tab_name = 'Test History Register'
-    tab_name = 'History Register'
-    ohd.config.google_api_delay = 10.0
-    ohd.config.cred_file = './service-account.json'
+    runtime_env = os.getenv('OHD_RUNTIME', 'ProdTest')
+    inactive_since = datetime.datetime.fromisoformat(os.getenv('OHD_INACTIVE_SINCE', '2018-01-01'))
+    conf = ohd.config.conf
+    conf.init_env(runtime_env)
+    conf.logger.info(f"Starting reports in the {runtime_env} environment")
 
-    olist = ohd.load_register(doc_id=doc_id, tab_name=tab_name)
-    officials = list()
-    for history in ohd.ohd_conn_generator(olist):
-        officials.append(ohd.register.load_official(history))
-        print(f"Processing {len(officials)} took {datetime.datetime.now() - start}")
+    last = ohd.reports.last_games()
+    inactive = ohd.reports.inactive_officials(inactive_since)
+    conf.logger.info(f"{len(inactive)} of {len(last)} officials haven't officiated since {inactive_since.date()} "
+                     f"({(inactive['Games'] == 0).sum()} without any games)")
 
-    inactive_list = list()
-    for o in officials:
-        if len(o.games) > 0:
-            g = reduce(lambda a, b: a.gdate > b.gdate and a or b, o.games)
-            if g.gdate < datetime.date(2018, 1, 1):
-                inactive_list.append([o.pref_name, g.gdate])
-        else:
-            # add the history docs without any games to the list
-            inactive_list.append([o.pref_name, 0])
-    print(inactive_list)
+    pd.set_option('display.width', 200)
+    print(inactive[['Name', 'Games', 'Last Game']].to_string())
+    print(ohd.reports.games_by_period('Y').to_string())
+    print(ohd.reports.games_by_association().to_string())
+    print(ohd.reports.games_by_position().to_string())
+    print(ohd.reports.games_by_type().to_string())
+
+    conf.logger.info(f"Total runtime {(datetime.datetime.now() - start).total_seconds():.2f}s")